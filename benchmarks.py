@@ -0,0 +1,225 @@
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_all_start_methods, get_context
+from urllib.parse import parse_qs, urlparse
+
+import common_utiles as cu
+import instrumentation as inst
+
+'''
+Benchmarks of the pipeline stages over a synthetic corpus (see synthetic_corpus.py), reported as rows/sec and peak RSS.
+Every benchmark runs in a new process (so the peak RSS is its own) in the corpus dir, and the fetcher runs against a
+local mock of twitter's endpoint
+'''
+
+BENCHMARKS_CORPUS_DIR = "benchmarks_corpus"
+BENCHMARKS_RESULTS_FNAME = "benchmarks_results.json"
+FETCHER_BENCHMARK_DATA_FNAME = "tweets_stance_sentiment_4outof4.csv"
+FETCHER_BENCHMARK_OUT_DIR = "benchmarks_fetcher_out"
+MOCK_ENDPOINT_LATENCY_SECONDS = 0.005
+MOCK_CREATED_AT = "2017-01-01T00:00:00.000Z"
+
+
+class MockTweetsEndpointHandler(BaseHTTPRequestHandler):
+    '''
+    Answers tweets lookups like twitter does: every 10th id isn't found, every 20th (of the others) isn't authorized and
+    the rest are returned with a fixed date and text
+    '''
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        time.sleep(MOCK_ENDPOINT_LATENCY_SECONDS)
+        data, errors = [], []
+        for tweet_id in query["ids"][0].split(","):
+            if int(tweet_id) % 10 == 0:
+                errors.append({"resource_id": tweet_id, "detail": f'Could not find tweet with ids: [{tweet_id}].'})
+            elif int(tweet_id) % 20 == 1:
+                errors.append({"resource_id": tweet_id, "title": "Authorization Error"})
+            else:
+                data.append({"id": tweet_id, "created_at": MOCK_CREATED_AT, "author_id": "1", "text": f'#brexit {tweet_id}'})
+        body = json.dumps({"data": data, "errors": errors}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_mock_endpoint():
+    '''
+    Returns the server (shut it down when done) and its search url
+    '''
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockTweetsEndpointHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/2/tweets'
+
+
+def count_data_rows():
+    rows_num = 0
+    for i in range(1, 5):
+        with open(os.path.join(cu.DATA_FOLDER, f'tweets_stance_sentiment_{i}outof4.csv'), "rb") as f:
+            rows_num += sum(1 for _ in f) - (1 if i == 1 else 0)
+    return rows_num
+
+
+def count_shard_rows():
+    import shard_manifest as sm
+    return sum(sm.get_shard_manifest(full_fname)["rows"] for full_fname in cu.list_shard_files())
+
+
+def read_fetched_texts():
+    texts = []
+    for fname in sorted(glob.glob(os.path.join("out*", "tweets_ids_to_creation_time", "*.json"))):
+        with open(fname) as f:
+            texts.extend(v["text"] for v in json.load(f).values() if isinstance(v, dict))
+    return texts
+
+
+def clear_shard_aggregates_cache():
+    import shard_aggregates_cache as sac
+    shutil.rmtree(sac.SHARD_AGGREGATES_CACHE_DIR, ignore_errors=True)
+
+
+def benchmark_generate_synthetic_corpus(tweets_per_file, users_num, seed):
+    import synthetic_corpus
+    synthetic_corpus.generate_synthetic_corpus(tweets_per_file, users_num, seed)
+    return 4 * tweets_per_file
+
+
+def benchmark_extract_hash_tags():
+    import hashtags_analysis as ha
+    texts = read_fetched_texts()
+    return len([ha.extract_hash_tags(text) for text in texts])
+
+
+def benchmark_extract_hash_tags_batch():
+    '''
+    Also checks that the batch version extracts the same tags as extract_hash_tags() (raises if it doesn't)
+    '''
+    import hashtags_analysis as ha
+    texts = read_fetched_texts()
+    batch_tags = ha.extract_hash_tags_batch(texts)
+    mismatches_num = sum(sorted(tags) != sorted(ha.extract_hash_tags(text)) for text, tags in zip(texts, batch_tags))
+    if mismatches_num > 0:
+        raise ValueError(f'extract_hash_tags_batch() differs from extract_hash_tags() in {mismatches_num}/{len(texts)} texts')
+    return len(texts)
+
+
+def benchmark_final_report_data_generator():
+    import final_report_generator as frg
+    shutil.rmtree(frg.FETCHED_TWEETS_STORE_DIR, ignore_errors=True)
+    shutil.rmtree(cu.FINAL_REPORT_DATA_FOLDER, ignore_errors=True)
+    os.makedirs(cu.FINAL_REPORT_DATA_FOLDER)
+    frg.final_report_data_generator()
+    return count_data_rows()
+
+
+def benchmark_get_sentiment_aggregated_data(workers_num, is_cached):
+    import final_report_generator as frg
+    if not is_cached:
+        clear_shard_aggregates_cache()
+    frg.get_sentiment_aggregated_data(workers_num=workers_num)
+    return count_shard_rows()
+
+
+def benchmark_calculate_hashtags_counter(workers_num, is_cached):
+    import hashtags_analysis as ha
+    if not is_cached:
+        clear_shard_aggregates_cache()
+    ha.calculate_hashtags_counter(workers_num=workers_num)
+    return count_shard_rows()
+
+
+def benchmark_fetcher(workers_num):
+    '''
+    workers_num 0 is the serial fetcher (cu.request_tweets_ids_from_csv())
+    '''
+    import concurrent_fetcher as cf
+    shutil.rmtree(FETCHER_BENCHMARK_OUT_DIR, ignore_errors=True)
+    server, search_url = start_mock_endpoint()
+    try:
+        if workers_num == 0:
+            cu.SEARCH_URL = search_url
+            cu.request_tweets_ids_from_csv(FETCHER_BENCHMARK_DATA_FNAME, "bearer_token", FETCHER_BENCHMARK_OUT_DIR)
+        else:
+            cf.request_tweets_ids_from_csv_concurrently(FETCHER_BENCHMARK_DATA_FNAME, "bearer_token",
+                                                        FETCHER_BENCHMARK_OUT_DIR, workers_num=workers_num,
+                                                        search_url=search_url,
+                                                        token_bucket=cf.RateLimitTokenBucket(requests_per_window=10 ** 9))
+    finally:
+        server.shutdown()
+    with open(os.path.join(cu.DATA_FOLDER, FETCHER_BENCHMARK_DATA_FNAME), "rb") as f:
+        return sum(1 for _ in f)
+
+
+def measure(corpus_dir, benchmark_func, args):
+    '''
+    Runs the benchmark in corpus_dir. Returns the number of rows it processed, its wall and CPU times (CPU time of this
+    process only) and the peak RSS
+    '''
+    os.chdir(corpus_dir)
+    start_time, start_cpu_time = time.perf_counter(), time.process_time()
+    rows_num = benchmark_func(*args)
+    return {"rows": rows_num, "seconds": time.perf_counter() - start_time, "cpu_seconds": time.process_time() - start_cpu_time,
+            "peak_rss_mb": inst.get_peak_rss_mb()}
+
+
+def run_benchmark(name, corpus_dir, benchmark_func, args=()):
+    # Forked where possible - a spawned process would spawn the shard workers too (each one importing everything again)
+    mp_context = get_context("fork" if "fork" in get_all_start_methods() else "spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+        result = executor.submit(measure, corpus_dir, benchmark_func, args).result()
+    result["name"] = name
+    result["rows_per_sec"] = result["rows"] / result["seconds"] if result["seconds"] > 0 else None
+    inst.log(f'{name}: {result["rows"]} rows in {result["seconds"]:.2f} seconds '
+          f'({result["rows_per_sec"]:,.0f} rows/sec), peak RSS: {result["peak_rss_mb"]} MB')
+    return result
+
+
+def run_benchmarks(corpus_dir=BENCHMARKS_CORPUS_DIR, tweets_per_file=10 ** 5, users_num=10 ** 4, seed=0,
+                   workers_nums=(1, cu.SHARD_WORKERS_NUM), fetcher_workers_nums=(0, 8), regenerate_corpus=False):
+    '''
+    Generates the synthetic corpus in corpus_dir (unless it's there already) and benchmarks every stage on it, with every
+    number of workers in workers_nums (the fetchers with every one of fetcher_workers_nums, 0 is the serial one).
+    The shard aggregations are measured without and with their cached partials. Returns the results (also written as
+    json to BENCHMARKS_RESULTS_FNAME in corpus_dir)
+    '''
+    corpus_dir = os.path.abspath(corpus_dir)
+    if regenerate_corpus:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+    results = []
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+        results.append(run_benchmark("generate_synthetic_corpus", corpus_dir, benchmark_generate_synthetic_corpus,
+                                     (tweets_per_file, users_num, seed)))
+    results.append(run_benchmark("extract_hash_tags", corpus_dir, benchmark_extract_hash_tags))
+    results.append(run_benchmark("extract_hash_tags_batch", corpus_dir, benchmark_extract_hash_tags_batch))
+    results.append(run_benchmark("final_report_data_generator", corpus_dir, benchmark_final_report_data_generator))
+    for workers_num in sorted(set(workers_nums)):
+        for is_cached in [False, True]:
+            name_suffix = f' ({workers_num} workers{", cached" if is_cached else ""})'
+            results.append(run_benchmark(f'get_sentiment_aggregated_data{name_suffix}', corpus_dir,
+                                         benchmark_get_sentiment_aggregated_data, (workers_num, is_cached)))
+            results.append(run_benchmark(f'calculate_hashtags_counter{name_suffix}', corpus_dir,
+                                         benchmark_calculate_hashtags_counter, (workers_num, is_cached)))
+    for workers_num in fetcher_workers_nums:
+        name = "fetcher (serial)" if workers_num == 0 else f'fetcher ({workers_num} workers)'
+        results.append(run_benchmark(name, corpus_dir, benchmark_fetcher, (workers_num,)))
+
+    with open(os.path.join(corpus_dir, BENCHMARKS_RESULTS_FNAME), "w") as f:
+        json.dump(results, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    inst.log(f'Start')
+    run_benchmarks()
+    inst.log(f'FIN')
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from processed_ids_index import write_npy_atomically
+
+BOT_SCORES_STORE_DIR = "bot_scores_store"
+USER_IDS_FNAME = "user_ids.npy"  # Sorted unique int64 user ids
+BOT_SCORES_FNAME = "bot_scores.npy"  # float64, bot_scores[i] is the score of user_ids[i] (NaN if it has none)
+TWEETS_NUMS_FNAME = "tweets_nums.npy"  # float64, total tweets of user_ids[i] in the dataset (NaN if unknown)
+SOURCE_FINGERPRINT_FNAME = "source_fingerprint.npy"  # (size, mtime_ns) of the csv the store was built from, and its format
+STORE_FORMAT_VERSION = 2  # Stores of an older format (e.g. without the users that have no bot score) are rebuilt
+USERS_CSV_COLS = ["user_id", "user_sentiment", "user_stance", "bot_score", "bot_fetch_time", "tweets_num"]
+
+
+class BotScoresStore:
+    '''
+    Read only bot scores of users, as two memory-mapped arrays: sorted user ids and their scores. It's built once from
+    the users csv (see build()), so opening it in every worker process is near instant and lookups are binary searches
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.user_ids = np.load(os.path.join(store_dir, USER_IDS_FNAME), mmap_mode="r")
+        self.bot_scores = np.load(os.path.join(store_dir, BOT_SCORES_FNAME), mmap_mode="r")
+        self.tweets_nums = np.load(os.path.join(store_dir, TWEETS_NUMS_FNAME), mmap_mode="r")
+
+    @staticmethod
+    def exists(store_dir):
+        return all(os.path.isfile(os.path.join(store_dir, f)) for f in
+                   [USER_IDS_FNAME, BOT_SCORES_FNAME, TWEETS_NUMS_FNAME, SOURCE_FINGERPRINT_FNAME])
+
+    @staticmethod
+    def is_up_to_date(store_dir, source_fingerprint):
+        return tuple(np.load(os.path.join(store_dir, SOURCE_FINGERPRINT_FNAME))) == tuple(source_fingerprint) + (STORE_FORMAT_VERSION,)
+
+    @staticmethod
+    def build(store_dir, users_csv_fname, source_fingerprint):
+        '''
+        Users without a bot score are kept with a NaN score (so their tweets_num is kept). If a user appears more than
+        once, its first row with a score is kept (or its first row, if none of them has a score)
+        '''
+        df = pd.read_csv(users_csv_fname, sep="~", names=USERS_CSV_COLS, usecols=["user_id", "bot_score", "tweets_num"])
+        df = df.iloc[np.argsort(df["bot_score"].isna().values, kind="stable")].drop_duplicates(subset=["user_id"])
+        order = np.argsort(df["user_id"].values, kind="stable")
+        os.makedirs(store_dir, exist_ok=True)
+        write_npy_atomically(os.path.join(store_dir, USER_IDS_FNAME), df["user_id"].values[order].astype(np.int64))
+        write_npy_atomically(os.path.join(store_dir, BOT_SCORES_FNAME), df["bot_score"].values[order].astype(np.float64))
+        write_npy_atomically(os.path.join(store_dir, TWEETS_NUMS_FNAME),
+                             pd.to_numeric(df["tweets_num"], errors="coerce").values[order].astype(np.float64))
+        # Written last, so a partially built store isn't considered up to date
+        write_npy_atomically(os.path.join(store_dir, SOURCE_FINGERPRINT_FNAME),
+                             np.array(tuple(source_fingerprint) + (STORE_FORMAT_VERSION,), dtype=np.int64))
+        return BotScoresStore(store_dir)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def get_values(self, values, user_ids):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        res = np.full(len(user_ids), np.nan)
+        if len(self.user_ids) == 0:
+            return res
+        positions = np.searchsorted(self.user_ids, user_ids)
+        positions[positions == len(self.user_ids)] = 0
+        is_found = self.user_ids[positions] == user_ids
+        res[is_found] = values[positions[is_found]]
+        return res
+
+    def get_scores(self, user_ids):
+        '''
+        Bot scores of user_ids (an int array), NaN for users without a score
+        '''
+        return self.get_values(self.bot_scores, user_ids)
+
+    def get_tweets_nums(self, user_ids):
+        '''
+        Total tweets of user_ids in the dataset (as listed in the users csv), NaN for unknown users
+        '''
+        return self.get_values(self.tweets_nums, user_ids)
+
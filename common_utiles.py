@@ -5,20 +5,30 @@ import math
 import os
 import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
+from functools import lru_cache
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import requests
 
+import fetcher_log
+import instrumentation as inst
+from bot_scores_store import BOT_SCORES_STORE_DIR, BotScoresStore
+from processed_ids_index import PROCESSED_IDS_INDEX_DIR, COMPACTION_MIN_JOURNAL_IDS, ProcessedIdsIndex
+
+try:
+    import pyarrow.parquet  # Optional - only needed for the parquet shard format
+except ImportError:
+    pyarrow = None
+
 BASE_OUT_DIR = "out"
 DATA_FOLDER = "dataverse_files"
 FINAL_REPORT_FOLDER = "final_report"
 FINAL_REPORT_DATA_FOLDER = os.path.join(FINAL_REPORT_FOLDER, "data")
 DATE_FORMAT = "%Y-%m-%d"  # i.e: "YYYY-MM-DD"
 MAX_IDS_ALLOWED_BY_TWITTER = 100
-RECORDS_PER_FILE = 10 ** 5
 
 PLOTS_DATA_FOLDER = os.path.join("plots", "data_for_plots")
 PLOTS_IMG_FOLDER = os.path.join("plots", "images")
@@ -27,7 +37,16 @@ LEAVE_COLOR = "red"
 OTHER_STANCE_COLOR = "green"
 
 SEARCH_URL = "https://api.twitter.com/2/tweets"
-BOT_SCORES_DF = None
+BOT_SCORES_CSV_FNAME = os.path.join(DATA_FOLDER, "users_stance_sentiment_botscore_tweetcounts.csv")
+
+SHARD_FNAME_PREFIX = "tweets_stance_sentiment_incl_date_and_text"
+SHARD_FORMAT_CSV = "csv"
+SHARD_FORMAT_PARQUET = "parquet"
+SHARD_FORMATS_TO_EXTENSION = {SHARD_FORMAT_CSV: ".csv", SHARD_FORMAT_PARQUET: ".parquet"}
+SHARD_CATEGORICAL_COLS = ["t_sentiment", "t_stance"]
+SHARD_DTYPES = {"t_id": "int64", "user_id": "int64", "t_sentiment": "category", "t_stance": "category"}  # t_date is parsed to datetimes
+SHARD_ROWS_PER_CHUNK = 5 * 10 ** 5  # Row budget of a chunk of iter_shard_chunks() - bounds the memory of the shard readers
+SHARD_WORKERS_NUM = os.cpu_count() or 1  # Worker processes for map_reduce_shards() (1 means serial, in this process)
 
 
 class Sentiment(Enum):
@@ -38,23 +57,33 @@ class Sentiment(Enum):
 
 
 def remove_bots_by_threshold(df, bot_score_threshold):
-    df.set_index("user_id", inplace=True)
-    BOT_SCORES_DF.set_index("user_id", inplace=True)
+    bot_scores = get_bot_scores(df["user_id"])
+    return df[np.logical_or(bot_scores.isna(), bot_scores <= bot_score_threshold)]
 
-    df = df.join(BOT_SCORES_DF)
 
-    df.reset_index(inplace=True)
-    BOT_SCORES_DF.reset_index(inplace=True)
+def get_bot_scores(user_ids):
+    '''
+    Returns the bot score of every user id in the given series (NaN for users without a score), aligned to its index
+    '''
+    return pd.Series(get_bot_scores_store().get_scores(user_ids.values), index=user_ids.index)
 
-    df = df[np.logical_or(df["bot_score"].isin([np.nan]), df["bot_score"] <= bot_score_threshold)]
-    df.drop(columns=["bot_score"], inplace=True)
-    return df
+
+@lru_cache(maxsize=None)
+def get_bot_scores_store(users_csv_fname=BOT_SCORES_CSV_FNAME, store_dir=os.path.join(DATA_FOLDER, BOT_SCORES_STORE_DIR)):
+    '''
+    Opens the (read only, memory-mapped) bot scores store, building it from users_csv_fname if it's missing or older than
+    the csv. It's opened once per process
+    '''
+    source_fingerprint = get_file_fingerprint(users_csv_fname)
+    if BotScoresStore.exists(store_dir) and BotScoresStore.is_up_to_date(store_dir, source_fingerprint):
+        return BotScoresStore(store_dir)
+    inst.log(f'Reading {users_csv_fname} (building bot scores store in {store_dir})')
+    return BotScoresStore.build(store_dir, users_csv_fname, source_fingerprint)
 
 
 def handle_bots(bot_score_threshold):
     should_filter_bots = False
     bot_msg_suffix = ""
-    global BOT_SCORES_DF
     if not bot_score_threshold is None:
         if not 0 <= bot_score_threshold <= 1:
             warnings.warn(
@@ -62,15 +91,7 @@ def handle_bots(bot_score_threshold):
         else:
             bot_msg_suffix = f" (bot score threshold {bot_score_threshold})"
             should_filter_bots = True
-            if BOT_SCORES_DF is None:
-                full_fname = os.path.join(DATA_FOLDER, "users_stance_sentiment_botscore_tweetcounts.csv")
-                print(f'{get_cur_formatted_time()} Reading {full_fname}')
-                BOT_SCORES_DF = pd.read_csv(full_fname, sep="~",
-                                            names=["user_id", "user_sentiment", "user_stance", "bot_score",
-                                                   "bot_fetch_time", "tweets_num"])
-                BOT_SCORES_DF.drop(columns=["user_sentiment", "user_stance", "bot_fetch_time", "tweets_num"],
-                                   inplace=True)
-                BOT_SCORES_DF = BOT_SCORES_DF[~BOT_SCORES_DF['bot_score'].isin([np.nan])]
+            get_bot_scores_store()  # Builds the store (if needed) before any worker process opens it
 
     return should_filter_bots, bot_msg_suffix
 
@@ -79,14 +100,237 @@ def df_to_csv_plus_create_dir(df, outdir, file_name, index_flag=False):
     if outdir and not os.path.exists(outdir):
         os.mkdir(outdir)
     fullname = os.path.join(outdir, file_name)
-    print(f'{get_cur_formatted_time()} Writing {len(df.index)} records to {fullname} (index={index_flag})')
+    inst.log(f'Writing {len(df.index)} records to {fullname} (index={index_flag})')
     df.to_csv(fullname, index=index_flag)
 
-def save_fig(f_name, f_format="png"):
-    path = os.path.join(PLOTS_IMG_FOLDER, f'{f_name}.{f_format}')
-    print(f'{get_cur_formatted_time()} Saving plot {path}')
-    plt.savefig(path)
-    plt.clf()
+def is_parquet_supported():
+    return pyarrow is not None
+
+
+def get_shard_format_or_default(shard_format):
+    if shard_format == SHARD_FORMAT_PARQUET and not is_parquet_supported():
+        warnings.warn(f'pyarrow is not installed - writing {SHARD_FORMAT_CSV} shards instead of {SHARD_FORMAT_PARQUET}')
+        return SHARD_FORMAT_CSV
+    if shard_format not in SHARD_FORMATS_TO_EXTENSION:
+        warnings.warn(f'Unknown shard format {shard_format} - using {SHARD_FORMAT_CSV}')
+        return SHARD_FORMAT_CSV
+    return shard_format
+
+
+def list_shard_files(folder=FINAL_REPORT_DATA_FOLDER):
+    '''
+    Returns the full names of the report shards in folder (sorted). If a shard exists both as csv and as parquet, only
+    the parquet one is returned
+    '''
+    shards = {}
+    for fname in os.listdir(folder):
+        no_extension_name, extension = os.path.splitext(fname)
+        if not (fname.startswith(SHARD_FNAME_PREFIX) and extension in SHARD_FORMATS_TO_EXTENSION.values()):
+            continue
+        if no_extension_name in shards and extension != SHARD_FORMATS_TO_EXTENSION[SHARD_FORMAT_PARQUET]:
+            continue
+        shards[no_extension_name] = os.path.join(folder, fname)
+    return [shards[k] for k in sorted(shards)]
+
+
+def map_reduce_shards(map_func, reduce_func, map_args=(), shard_fnames=None, workers_num=None):
+    '''
+    Runs map_func(full_fname, *map_args) on every shard and merges the partial results with reduce_func(partial_results).
+    The shards are mapped in a pool of workers_num processes (default SHARD_WORKERS_NUM), or serially in this process if
+    it's 1 - useful for debugging. map_func and map_args have to be picklable. The rows and bytes the workers read (and
+    their counters) are added to the current stage
+    '''
+    if shard_fnames is None:
+        shard_fnames = list_shard_files()
+    if workers_num is None:
+        workers_num = SHARD_WORKERS_NUM
+    workers_num = min(workers_num, len(shard_fnames))
+    if workers_num <= 1:
+        partial_results = [map_func(full_fname, *map_args) for full_fname in shard_fnames]
+    else:
+        inst.log(f'Mapping {len(shard_fnames)} shards with {workers_num} worker processes')
+        with ProcessPoolExecutor(max_workers=workers_num) as executor:
+            results_and_metrics = list(executor.map(inst.call_in_worker, [map_func] * len(shard_fnames), shard_fnames,
+                                                    *[[arg] * len(shard_fnames) for arg in map_args]))
+        partial_results = [result for result, _ in results_and_metrics]
+        for _, worker_metrics in results_and_metrics:
+            inst.add_worker_metrics(worker_metrics)
+    return reduce_func(partial_results)
+
+
+def iter_mapped_shards(map_func, map_args=(), shard_fnames=None, workers_num=None):
+    '''
+    Same as map_reduce_shards(), but yields the partial results one by one as their shards are mapped (in the order they
+    complete, not the shards' order), so a reducer can fold each one in and drop it instead of holding all of them
+    '''
+    if shard_fnames is None:
+        shard_fnames = list_shard_files()
+    if workers_num is None:
+        workers_num = SHARD_WORKERS_NUM
+    workers_num = min(workers_num, len(shard_fnames))
+    if workers_num <= 1:
+        for full_fname in shard_fnames:
+            yield map_func(full_fname, *map_args)
+        return
+    inst.log(f'Mapping {len(shard_fnames)} shards with {workers_num} worker processes')
+    with ProcessPoolExecutor(max_workers=workers_num) as executor:
+        futures = {executor.submit(inst.call_in_worker, map_func, full_fname, *map_args) for full_fname in shard_fnames}
+        for future in as_completed(futures):
+            futures.discard(future)  # So the future (and its result) is released once it's yielded
+            result, worker_metrics = future.result()
+            inst.add_worker_metrics(worker_metrics)
+            yield result
+
+
+def to_naive_datetime(series):
+    datetime_series = pd.to_datetime(series)
+    if datetime_series.dt.tz is not None:
+        datetime_series = datetime_series.dt.tz_localize(None)
+    return datetime_series
+
+
+def to_tweet_date_strings(datetime_series):
+    '''
+    The (naive, UTC) datetimes in twitter's format, as they are in the fetched tweets (e.g. '2016-06-23T10:00:00.000Z')
+    '''
+    return datetime_series.dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z"
+
+
+def to_typed_shard_df(df):
+    '''
+    Ids as int64, stance and sentiment as categoricals and dates as (naive) datetimes - of the columns df has
+    '''
+    df = df.astype({col: dtype for col, dtype in SHARD_DTYPES.items() if col in df.columns})
+    if "t_date" in df.columns:
+        df["t_date"] = to_naive_datetime(df["t_date"])
+    return df
+
+
+def get_shard_csv_dtypes(columns=None):
+    return {col: dtype for col, dtype in SHARD_DTYPES.items() if columns is None or col in columns}
+
+
+def write_shard(df, out_fname_no_extension, shard_format=SHARD_FORMAT_CSV):
+    shard_format = get_shard_format_or_default(shard_format)
+    out_fname = f'{out_fname_no_extension}{SHARD_FORMATS_TO_EXTENSION[shard_format]}'
+    inst.log(f'Writing {len(df.index)} records to {out_fname}')
+    if shard_format == SHARD_FORMAT_PARQUET:
+        to_typed_shard_df(df).to_parquet(out_fname, index=False)
+    else:
+        df.to_csv(path_or_buf=out_fname, index=False)
+    return out_fname
+
+
+def is_parquet_shard(full_fname):
+    return full_fname.endswith(SHARD_FORMATS_TO_EXTENSION[SHARD_FORMAT_PARQUET])
+
+
+def read_shard(full_fname, columns=None):
+    '''
+    Reads a single report shard (csv or parquet), typed (see to_typed_shard_df()). If columns is given, only these
+    columns are loaded. The whole shard is held in memory - see iter_shard_chunks() for a bounded read
+    '''
+    if is_parquet_shard(full_fname):
+        df = pd.read_parquet(full_fname, columns=columns)
+    else:
+        df = pd.read_csv(full_fname, usecols=columns, dtype=get_shard_csv_dtypes(columns))
+    inst.add_rows(len(df.index))
+    inst.add_bytes(os.path.getsize(full_fname))
+    return to_typed_shard_df(df)
+
+
+def iter_shard_chunks(full_fname, columns=None, rows_per_chunk=None):
+    '''
+    Yields the shard (only columns, if given) in typed chunks of up to rows_per_chunk rows, indexed by their row numbers
+    in the shard (rows_per_chunk defaults to SHARD_ROWS_PER_CHUNK). An empty shard yields a single empty chunk. The
+    categories of the categorical columns may differ between chunks (see concat_shard_chunks())
+    '''
+    if rows_per_chunk is None:
+        rows_per_chunk = SHARD_ROWS_PER_CHUNK
+    inst.add_bytes(os.path.getsize(full_fname))
+    if is_parquet_shard(full_fname):
+        parquet_file, start_row = pyarrow.parquet.ParquetFile(full_fname), 0
+        for batch in parquet_file.iter_batches(batch_size=rows_per_chunk, columns=columns):
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(start_row, start_row + len(df.index))
+            start_row += len(df.index)
+            inst.add_rows(len(df.index))
+            yield to_typed_shard_df(df)
+        if start_row == 0:
+            yield to_typed_shard_df(parquet_file.schema_arrow.empty_table().select(columns or parquet_file.schema_arrow.names).to_pandas())
+    else:
+        with pd.read_csv(full_fname, usecols=columns, dtype=get_shard_csv_dtypes(columns), chunksize=rows_per_chunk) as reader:
+            for df in reader:  # The row numbers continue from chunk to chunk
+                inst.add_rows(len(df.index))
+                yield to_typed_shard_df(df)
+
+
+def concat_shard_chunks(chunks):
+    '''
+    Concatenates typed chunks (or parts of them), keeping the categorical columns categorical
+    '''
+    return to_typed_shard_df(pd.concat(chunks))
+
+
+def read_shard_rows(full_fname, rows, columns=None, rows_per_chunk=None):
+    '''
+    Reads only the given (sorted) rows of the shard, chunk by chunk - so only these rows and one chunk are held in memory.
+    The shard is read only up to the chunk of the last row
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    parts = []
+    for df in iter_shard_chunks(full_fname, columns, rows_per_chunk):
+        start, end = np.searchsorted(rows, [df.index[0], df.index[-1] + 1]) if len(df.index) > 0 else (0, 0)
+        parts.append(df.loc[rows[start:end]])
+        if end == len(rows):
+            break
+    return concat_shard_chunks(parts)
+
+
+def get_file_fingerprint(fname):
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def encode_strings(strings):
+    '''
+    Packs strings to a utf-8 blob and an offsets array (string i is blob[offsets[i]:offsets[i+1]]) - a compact, non
+    pickled way to store them with np.save/np.savez
+    '''
+    encoded = [s.encode("utf-8", errors="surrogatepass") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(blob, offsets):
+    blob = bytes(blob)
+    offsets = offsets.tolist()
+    return [blob[start:end].decode("utf-8", errors="surrogatepass") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def convert_csv_shards_to_parquet(folder=FINAL_REPORT_DATA_FOLDER, remove_csv=False):
+    if not is_parquet_supported():
+        warnings.warn(f'pyarrow is not installed - can\'t convert shards in {folder} to {SHARD_FORMAT_PARQUET}')
+        return
+    for full_fname in list_shard_files(folder):
+        if not full_fname.endswith(SHARD_FORMATS_TO_EXTENSION[SHARD_FORMAT_CSV]):
+            continue
+        out_fname = f'{os.path.splitext(full_fname)[0]}{SHARD_FORMATS_TO_EXTENSION[SHARD_FORMAT_PARQUET]}'
+        inst.log(f'Converting {full_fname} to {out_fname}')
+        writer = None
+        for df in iter_shard_chunks(full_fname):  # Chunk by chunk, to a single row group each
+            if writer is None:
+                table = pyarrow.Table.from_pandas(df, preserve_index=False)
+                writer = pyarrow.parquet.ParquetWriter(out_fname, table.schema)
+            else:
+                table = pyarrow.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+        if remove_csv:
+            os.remove(full_fname)
+            inst.log(f'Deleted {full_fname}')
 
 
 def get_cur_formatted_time(datetime_format="%Y-%m-%d %H:%M:%S"):
@@ -100,7 +344,7 @@ def write_to_json_file_if_not_empty(data, fname, add_epoch_suffix=False, escape_
         no_extension_name, extension = os.path.splitext(fname)
         epoch_time = int(time.time())
         fname = f'{no_extension_name}_{epoch_time}{extension}'
-    print(f'{get_cur_formatted_time()} Writing {len(data)} records to {fname}')
+    inst.log(f'Writing {len(data)} records to {fname}')
     if escape_html_chars:
         with open(fname, "w") as write_file:
             json.dump(data, write_file, indent=4)
@@ -117,152 +361,184 @@ def get_trinary_sentiment(cur_stance, cur_sentiment):
     return Sentiment.OTHER
 
 
+def count_fetcher_response(status_code):
+    inst.increment(inst.FETCHER_REQUESTS)
+    if status_code == 429:
+        inst.increment(inst.FETCHER_TOO_MANY_REQUESTS_RESPONSES)
+    elif status_code == 503:
+        inst.increment(inst.FETCHER_SERVICE_UNAVAILABLE_RESPONSES)
+    elif status_code != 200:
+        inst.increment(inst.FETCHER_OTHER_ERROR_RESPONSES)
+
+
+def fetcher_sleep(seconds):
+    inst.increment(inst.FETCHER_SLEEP_SECONDS, seconds)
+    time.sleep(seconds)
+
+
 def connect_to_endpoint(params, headers):
     response = requests.request("GET", SEARCH_URL, headers=headers, params=params)
+    count_fetcher_response(response.status_code)
     if response.status_code != 200:
-        print(f'{get_cur_formatted_time()} {response.status_code}: {response.text}')
+        inst.log(f'{response.status_code}: {response.text}')
         return response.status_code
     return response.json()
 
 
+def get_tweets_query_params(tweet_ids, request_text):
+    text_req_suffix = ",text" if request_text else ""
+    return {'ids': ",".join(tweet_ids),
+            'tweet.fields': f'created_at,author_id{text_req_suffix}',
+            'expansions': 'author_id',
+            'user.fields': 'created_at'}
+
+
+def add_tweets_response_to_buffers(json_response, request_text, tweets_ids_to_creation_time, tweet_ids_not_found,
+                                   tweet_ids_not_authorized):
+    if "data" in json_response:
+        for d_item in json_response["data"]:
+            if request_text:
+                tweets_ids_to_creation_time[d_item["id"]] = {"created_at": d_item["created_at"],
+                                                             "text": d_item["text"]}
+            else:
+                tweets_ids_to_creation_time[d_item["id"]] = d_item["created_at"]
+    if "errors" in json_response:
+        for err_item in json_response["errors"]:
+            if "detail" in err_item and "Could not find tweet with ids" in err_item[
+                "detail"] and "resource_id" in err_item:
+                tweet_ids_not_found.append(err_item["resource_id"])
+            elif "title" in err_item and err_item["title"] in "Authorization Error":
+                tweet_ids_not_authorized.append(err_item["resource_id"])
+
+
 def get_existing_ids(out_dir):
     existing_ids = set()
     dir = os.path.join(out_dir, "tweet_ids_not_found")
-    for filename in os.listdir(dir):
+    for filename in os.listdir(dir) if os.path.isdir(dir) else []:
         if filename.startswith("tweet_ids_not_found") and filename.endswith(".json"):
             with open(os.path.join(dir, filename), "r") as f:
                 cur_list = json.load(f)
                 existing_ids.update(set(cur_list))
     dir = os.path.join(out_dir, "tweet_ids_not_authorized")
-    for filename in os.listdir(dir):
+    for filename in os.listdir(dir) if os.path.isdir(dir) else []:
         if filename.startswith("tweet_ids_not_authorized") and filename.endswith(".json"):
             with open(os.path.join(dir, filename), "r") as f:
                 cur_list = json.load(f)
                 existing_ids.update(set(cur_list))
     dir = os.path.join(out_dir, "tweets_ids_to_creation_time")
-    for filename in os.listdir(dir):
+    for filename in os.listdir(dir) if os.path.isdir(dir) else []:
         if filename.startswith("tweets_ids_to_creation_time") and filename.endswith(".json"):
             with open(os.path.join(dir, filename), "r") as f:
                 cur_dict = json.load(f)
                 existing_ids.update(set(cur_dict.keys()))
+    for _, _, record in fetcher_log.replay(os.path.join(out_dir, fetcher_log.FETCHER_LOG_DIR)):
+        existing_ids.update(get_fetcher_log_record_ids(record))
 
     return existing_ids
 
 
+def get_processed_ids_index(out_dir):
+    '''
+    Opens the persistent index of the ids the fetcher already processed in out_dir. The first time, it's built from the
+    existing json files (see get_existing_ids())
+    '''
+    index_dir = os.path.join(out_dir, PROCESSED_IDS_INDEX_DIR)
+    if ProcessedIdsIndex.exists(index_dir):
+        processed_ids_index = ProcessedIdsIndex(index_dir)
+        processed_ids_index.compact(min_journal_ids=COMPACTION_MIN_JOURNAL_IDS)
+    else:
+        inst.log(f'No processed ids index found in {index_dir}, building it from json files and the fetcher log')
+        processed_ids_index = ProcessedIdsIndex.create(index_dir, get_existing_ids(out_dir))
+    return processed_ids_index
+
+
+def get_fetcher_log_record(json_response, request_text):
+    '''
+    The fetcher log record of a response: the fetched tweets (id -> date and text, or just date) and the ids that weren't
+    found or that we weren't authorized to get
+    '''
+    record = {"data": {}, "not_found": [], "not_authorized": []}
+    add_tweets_response_to_buffers(json_response, request_text, record["data"], record["not_found"], record["not_authorized"])
+    return record
+
+
+def get_fetcher_log_record_ids(record):
+    return list(record["data"].keys()) + record["not_found"] + record["not_authorized"]
+
+
+def write_response_to_fetcher_log(json_response, request_text, log_writer, processed_ids_index):
+    record = get_fetcher_log_record(json_response, request_text)
+    log_writer.append(record)
+    processed_ids_index.add(get_fetcher_log_record_ids(record))
+
+
+def open_fetcher_log_writer(out_dir):
+    return fetcher_log.FetcherLogWriter(os.path.join(out_dir, fetcher_log.FETCHER_LOG_DIR))
+
+
+@inst.timed_stage()
 def request_tweets_ids_from_csv(data_fname, bearer_token, out_dir, request_text=True, skip_first_line=False):
     data_file = os.path.join(DATA_FOLDER, data_fname)
-    existing_ids = get_existing_ids(out_dir)
-    print(f'{get_cur_formatted_time()} Found {len(existing_ids)} existing tweets ids (dir {out_dir})')
-    print(f'{get_cur_formatted_time()} Reading {data_file}')
-    line_count = 0
-
-    with open(data_file) as infile:
-        tweets_ids_to_creation_time = {}
-        tweet_ids_not_found = []
-        tweet_ids_not_authorized = []
-        cur_tweets_ids = []
-        if skip_first_line:
-            infile.readline()
-            line_count += 1
-        for line in infile:
-            line_count += 1
-            if line_count % 250000 == 0:
-                print(f'{get_cur_formatted_time()} line no. {line_count}')
-            tweet_id = line.split('~')[0]
-            if str(tweet_id) in existing_ids:
-                continue
-            cur_tweets_ids.append(str(tweet_id))
-            if len(cur_tweets_ids) >= MAX_IDS_ALLOWED_BY_TWITTER:
-                headers = {"Authorization": "Bearer {}".format(bearer_token)}
-                num_of_requests = math.ceil(len(cur_tweets_ids) / MAX_IDS_ALLOWED_BY_TWITTER)
-                tweets_ids_per_request = np.array_split(list(cur_tweets_ids), num_of_requests)
-
-                if request_text:
-                    text_req_suffix = ",text"
-                    ids_to_creation_fname = os.path.join(out_dir, "tweets_ids_to_creation_time",
-                                                         "tweets_ids_to_creation_time_and_text.json")
-                else:
-                    text_req_suffix = ""
-                    ids_to_creation_fname = os.path.join(out_dir, "tweets_ids_to_creation_time",
-                                                         "tweets_ids_to_creation_time.json")
-                ids_not_found_fname = os.path.join(out_dir, "tweet_ids_not_found", "tweet_ids_not_found.json")
-                ids_not_authorized_fname = os.path.join(out_dir, "tweet_ids_not_authorized",
-                                                        "tweet_ids_not_authorized.json")
-
-                for i, cur_tweets_in_requests in enumerate(tweets_ids_per_request):
-                    query_params = {'ids': ",".join(cur_tweets_in_requests),
-                                    'tweet.fields': f'created_at,author_id{text_req_suffix}',
-                                    'expansions': 'author_id',
-                                    'user.fields': 'created_at'}
-                    should_send_req = True
-                    iteration_counter = 0
-                    while should_send_req:
-                        should_send_req = False
-                        iteration_counter += 1
-                        try:
-                            json_response = connect_to_endpoint(query_params, headers)
-                            if json_response in [429, 503]:
+    # Closed also when a request fails or the run is interrupted, so the log and the ids journal are flushed
+    with get_processed_ids_index(out_dir) as existing_ids, open_fetcher_log_writer(out_dir) as log_writer:
+        inst.log(f'Found {len(existing_ids)} existing tweets ids (dir {out_dir})')
+        inst.log(f'Reading {data_file} (writing responses to {log_writer.log_dir})')
+        line_count = 0
+
+        with open(data_file) as infile:
+            cur_tweets_ids = []
+            if skip_first_line:
+                infile.readline()
+                line_count += 1
+            for line in infile:
+                line_count += 1
+                if line_count % 250000 == 0:
+                    inst.log(f'line no. {line_count}')
+                tweet_id = line.split('~')[0]
+                if str(tweet_id) in existing_ids:
+                    continue
+                cur_tweets_ids.append(str(tweet_id))
+                if len(cur_tweets_ids) >= MAX_IDS_ALLOWED_BY_TWITTER:
+                    headers = {"Authorization": "Bearer {}".format(bearer_token)}
+                    num_of_requests = math.ceil(len(cur_tweets_ids) / MAX_IDS_ALLOWED_BY_TWITTER)
+                    tweets_ids_per_request = np.array_split(list(cur_tweets_ids), num_of_requests)
+
+                    for i, cur_tweets_in_requests in enumerate(tweets_ids_per_request):
+                        query_params = get_tweets_query_params(cur_tweets_in_requests, request_text)
+                        should_send_req = True
+                        iteration_counter = 0
+                        while should_send_req:
+                            should_send_req = False
+                            iteration_counter += 1
+                            try:
+                                json_response = connect_to_endpoint(query_params, headers)
+                                if json_response in [429, 503]:
+                                    should_send_req = True
+                                    inst.log(
+                                        f'Sleeping for {"1" if json_response == 429 else ""}5 minutes (batch {i + 1} out of {num_of_requests}, iteration no.: {iteration_counter})')
+                                    if json_response == 429:
+                                        fetcher_sleep(60 * 15)
+                                    else:
+                                        fetcher_sleep(60 * 5)
+                                    inst.log(f'Woke up')
+                            except requests.exceptions.ConnectionError:
                                 should_send_req = True
-                                write_to_json_file_if_not_empty(tweets_ids_to_creation_time, ids_to_creation_fname,
-                                                                True)
-                                tweets_ids_to_creation_time = {}
-                                write_to_json_file_if_not_empty(tweet_ids_not_found, ids_not_found_fname, True)
-                                tweet_ids_not_found = []
-                                write_to_json_file_if_not_empty(tweet_ids_not_authorized, ids_not_authorized_fname,
-                                                                True)
-                                tweet_ids_not_authorized = []
-                                print(
-                                    f'{get_cur_formatted_time()} Sleeping for {"1" if json_response == 429 else ""}5 minutes (batch {i + 1} out of {num_of_requests}, iteration no.: {iteration_counter})')
-                                if json_response == 429:
-                                    time.sleep(60 * 15)
-                                else:
-                                    time.sleep(60 * 5)
-                                print(f'{get_cur_formatted_time()} Woke up')
-                        except requests.exceptions.ConnectionError:
-                            should_send_req = True
-                            write_to_json_file_if_not_empty(tweets_ids_to_creation_time, ids_to_creation_fname, True)
-                            tweets_ids_to_creation_time = {}
-                            write_to_json_file_if_not_empty(tweet_ids_not_found, ids_not_found_fname, True)
-                            tweet_ids_not_found = []
-                            write_to_json_file_if_not_empty(tweet_ids_not_authorized, ids_not_authorized_fname, True)
-                            tweet_ids_not_authorized = []
-                            print(
-                                f'{get_cur_formatted_time()} Got connection error, going to sleep for 10 minutes (iteration no.: {iteration_counter})')
-                            time.sleep(60 * 10)
-
-                    if type(json_response) == int:
-                        continue  # This means we got a response code that isn't 429 nor 200
-                    if "data" in json_response:
-                        for d_item in json_response["data"]:
-                            if request_text:
-                                tweets_ids_to_creation_time[d_item["id"]] = {"created_at": d_item["created_at"],
-                                                                             "text": d_item["text"]}
-                            else:
-                                tweets_ids_to_creation_time[d_item["id"]] = d_item["created_at"]
-
-                        if len(tweets_ids_to_creation_time) >= RECORDS_PER_FILE:
-                            write_to_json_file_if_not_empty(tweets_ids_to_creation_time, ids_to_creation_fname, True)
-                            tweets_ids_to_creation_time = {}
-                    if "errors" in json_response:
-                        for err_item in json_response["errors"]:
-                            if "detail" in err_item and "Could not find tweet with ids" in err_item[
-                                "detail"] and "resource_id" in err_item:
-                                tweet_ids_not_found.append(err_item["resource_id"])
-                            elif "title" in err_item and err_item["title"] in "Authorization Error":
-                                tweet_ids_not_authorized.append(err_item["resource_id"])
-                        if len(tweet_ids_not_found) >= RECORDS_PER_FILE:
-                            write_to_json_file_if_not_empty(tweet_ids_not_found, ids_not_found_fname, True)
-                            tweet_ids_not_found = []
-                        if len(tweet_ids_not_authorized) >= RECORDS_PER_FILE:
-                            write_to_json_file_if_not_empty(tweet_ids_not_authorized, ids_not_authorized_fname, True)
-                            tweet_ids_not_authorized = []
-                cur_tweets_ids = []
+                                inst.increment(inst.FETCHER_CONNECTION_ERRORS)
+                                inst.log(
+                                    f'Got connection error, going to sleep for 10 minutes (iteration no.: {iteration_counter})')
+                                fetcher_sleep(60 * 10)
+
+                        if type(json_response) == int:
+                            continue  # This means we got a response code that isn't 429 nor 200
+                        write_response_to_fetcher_log(json_response, request_text, log_writer, existing_ids)
+                    cur_tweets_ids = []
+        inst.add_rows(line_count)
 
 
 def write_csv_file_if_data_not_empty(fname, data, header):
     if len(data) == 0:
         return
-    print(f'{get_cur_formatted_time()} Writing {len(data)} records to {fname}')
+    inst.log(f'Writing {len(data)} records to {fname}')
     with open(fname, 'w', newline='', encoding="utf-8") as csv_file:
         writer = csv.writer(csv_file)
         writer.writerow(header)
@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+import common_utiles as cu
+import instrumentation as inst
+
+FETCH_WORKERS_NUM = 8
+MAX_BATCHES_IN_FLIGHT_PER_WORKER = 2
+RATE_LIMIT_WINDOW_SECONDS = 60 * 15
+DEFAULT_REQUESTS_PER_WINDOW = 300  # Tweets lookup limit per app (see: https://developer.twitter.com/en/docs/twitter-api/rate-limits)
+RATE_LIMIT_RESET_SLACK_SECONDS = 1  # To avoid waking up a moment before the window resets on twitter's side
+SERVICE_UNAVAILABLE_SLEEP_SECONDS = 60 * 5
+CONNECTION_ERROR_SLEEP_SECONDS = 60 * 10
+REQUEST_TIMEOUT_SECONDS = (10, 60)  # (connect, read) - so a stalled connection doesn't hold a worker forever
+
+
+class RateLimitTokenBucket:
+    '''
+    Thread safe token bucket that follows twitter's rate limit window: the tokens are the requests left in the current
+    window. They're corrected by the x-rate-limit-* headers of every response and refilled when the window resets.
+    Every acquire() returns a ticket (a running number) that's passed back with the response headers - a response's
+    remaining count doesn't include the requests that were sent after it, so these are deducted from it
+    '''
+
+    def __init__(self, requests_per_window=DEFAULT_REQUESTS_PER_WINDOW, window_seconds=RATE_LIMIT_WINDOW_SECONDS):
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.tokens = requests_per_window
+        self.reset_time = time.time() + window_seconds
+        self.is_reset_time_known = False  # Until the first response arrives, reset_time is only an estimate
+        self.last_ticket = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now >= self.reset_time:
+                    self.tokens = self.requests_per_window
+                    self.reset_time = now + self.window_seconds
+                    self.is_reset_time_known = False
+                if self.tokens > 0:
+                    self.tokens -= 1
+                    self.last_ticket += 1
+                    return self.last_ticket
+                sleep_seconds = self.reset_time - now + RATE_LIMIT_RESET_SLACK_SECONDS
+            inst.log(f'Rate limit reached, sleeping for {sleep_seconds:.0f} seconds (until the window resets)')
+            cu.fetcher_sleep(sleep_seconds)
+
+    def update_from_headers(self, headers, ticket):
+        with self.lock:
+            if "x-rate-limit-limit" in headers:
+                self.requests_per_window = int(headers["x-rate-limit-limit"])
+            if not "x-rate-limit-remaining" in headers:
+                return
+            remaining = int(headers["x-rate-limit-remaining"]) - (self.last_ticket - ticket)
+            reset_time = float(headers["x-rate-limit-reset"]) if "x-rate-limit-reset" in headers else self.reset_time
+            if reset_time > self.reset_time or not self.is_reset_time_known:
+                # A response from a new window (or the first one we got) - it holds the real state of the bucket
+                self.reset_time = reset_time
+                self.tokens = remaining
+                self.is_reset_time_known = "x-rate-limit-reset" in headers
+            else:
+                # Responses of the same window can arrive out of order, the lowest remaining count is the most recent
+                self.tokens = min(self.tokens, remaining)
+
+    def on_rate_limited(self, headers):
+        with self.lock:
+            self.tokens = 0
+            if "x-rate-limit-reset" in headers:
+                self.reset_time = float(headers["x-rate-limit-reset"])
+                self.is_reset_time_known = True
+            else:
+                self.reset_time = max(self.reset_time, time.time() + self.window_seconds)
+
+
+def create_session(workers_num=FETCH_WORKERS_NUM):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers_num)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_tweets_batch(session, token_bucket, query_params, headers, search_url=cu.SEARCH_URL):
+    '''
+    Sends a single batch request, retrying it until it gets a final response (requests that fail or time out are
+    retried too). Returns the json response, or the status code for responses that aren't 200, 429 nor 503 (same as
+    cu.connect_to_endpoint())
+    '''
+    iteration_counter = 0
+    while True:
+        iteration_counter += 1
+        ticket = token_bucket.acquire()
+        try:
+            response = session.get(search_url, headers=headers, params=query_params, timeout=REQUEST_TIMEOUT_SECONDS)
+        except requests.exceptions.RequestException as e:
+            inst.increment(inst.FETCHER_CONNECTION_ERRORS)
+            inst.log(f'Got {type(e).__name__}, going to sleep for {CONNECTION_ERROR_SLEEP_SECONDS} seconds (iteration no.: {iteration_counter})')
+            cu.fetcher_sleep(CONNECTION_ERROR_SLEEP_SECONDS)
+            continue
+        cu.count_fetcher_response(response.status_code)
+
+        if response.status_code == 429:
+            token_bucket.on_rate_limited(response.headers)
+            continue
+        token_bucket.update_from_headers(response.headers, ticket)
+        if response.status_code == 503:
+            inst.log(f'Service unavailable, sleeping for {SERVICE_UNAVAILABLE_SLEEP_SECONDS} seconds (iteration no.: {iteration_counter})')
+            cu.fetcher_sleep(SERVICE_UNAVAILABLE_SLEEP_SECONDS)
+            continue
+        if response.status_code != 200:
+            inst.log(f'{response.status_code}: {response.text}')
+            return response.status_code
+        return response.json()
+
+
+def iter_tweets_ids_batches(data_file, processed_ids_index, skip_first_line=False, lines_per_check=10 ** 5):
+    '''
+    Yields batches of (up to) MAX_IDS_ALLOWED_BY_TWITTER ids from data_file that aren't in processed_ids_index. The ids
+    are checked against the index in vectorized chunks of lines_per_check lines
+    '''
+    cur_tweets_ids = []
+    with open(data_file) as infile:
+        if skip_first_line:
+            infile.readline()
+        lines = []
+        for line_count, line in enumerate(infile, start=2 if skip_first_line else 1):
+            if line_count % 250000 == 0:
+                inst.log(f'line no. {line_count}')
+            lines.append(line)
+            if len(lines) < lines_per_check:
+                continue
+            inst.add_rows(len(lines))
+            cur_tweets_ids.extend(get_unprocessed_tweets_ids(lines, processed_ids_index))
+            lines = []
+            while len(cur_tweets_ids) >= cu.MAX_IDS_ALLOWED_BY_TWITTER:
+                yield cur_tweets_ids[:cu.MAX_IDS_ALLOWED_BY_TWITTER]
+                cur_tweets_ids = cur_tweets_ids[cu.MAX_IDS_ALLOWED_BY_TWITTER:]
+        inst.add_rows(len(lines))
+        cur_tweets_ids.extend(get_unprocessed_tweets_ids(lines, processed_ids_index))
+    for i in range(0, len(cur_tweets_ids), cu.MAX_IDS_ALLOWED_BY_TWITTER):
+        yield cur_tweets_ids[i:i + cu.MAX_IDS_ALLOWED_BY_TWITTER]
+
+
+def get_unprocessed_tweets_ids(lines, processed_ids_index):
+    '''
+    Lines whose first field isn't a tweet id (e.g. blank lines) are skipped
+    '''
+    tweets_ids = pd.Series([line.split('~', 1)[0].strip() for line in lines], dtype=object)
+    # Only whole numbers are parsed, so the ids aren't parsed as floats (which would round them)
+    tweets_ids = tweets_ids[tweets_ids.str.fullmatch(r"\d+")]
+    parsed_ids = pd.to_numeric(tweets_ids, errors="coerce")
+    if len(tweets_ids) < len(lines):
+        inst.log(f'Skipping {len(lines) - len(tweets_ids)} lines without a tweet id')
+    if len(tweets_ids) == 0:
+        return []
+    is_processed = processed_ids_index.contains(parsed_ids.values.astype(np.int64))
+    return [tweet_id for tweet_id, processed in zip(tweets_ids, is_processed) if not processed]
+
+
+@inst.timed_stage()
+def request_tweets_ids_from_csv_concurrently(data_fname, bearer_token, out_dir, request_text=True,
+                                             skip_first_line=False, workers_num=FETCH_WORKERS_NUM,
+                                             search_url=cu.SEARCH_URL, token_bucket=None):
+    '''
+    Concurrent version of cu.request_tweets_ids_from_csv(): keeps several batches in flight over a pooled session and
+    sleeps only until the rate limit window resets. Writes the responses to the same fetcher log
+    '''
+    data_file = os.path.join(cu.DATA_FOLDER, data_fname)
+    # Closed also when a request fails or the run is interrupted, so the log and the ids journal are flushed
+    with cu.get_processed_ids_index(out_dir) as processed_ids_index, cu.open_fetcher_log_writer(out_dir) as log_writer:
+        inst.log(f'Found {len(processed_ids_index)} existing tweets ids (dir {out_dir})')
+        inst.log(f'Reading {data_file} ({workers_num} workers, writing responses to {log_writer.log_dir})')
+
+        if token_bucket is None:
+            token_bucket = RateLimitTokenBucket()
+        headers = {"Authorization": "Bearer {}".format(bearer_token)}
+
+        def handle_done_requests(done_futures):
+            for future in done_futures:
+                json_response = future.result()
+                if type(json_response) == int:
+                    continue  # This means we got a response code that isn't 429 nor 200
+                cu.write_response_to_fetcher_log(json_response, request_text, log_writer, processed_ids_index)
+
+        with create_session(workers_num) as session, ThreadPoolExecutor(max_workers=workers_num) as executor:
+            in_flight = set()
+            for tweets_ids in iter_tweets_ids_batches(data_file, processed_ids_index, skip_first_line):
+                if len(in_flight) >= workers_num * MAX_BATCHES_IN_FLIGHT_PER_WORKER:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    handle_done_requests(done)
+                query_params = cu.get_tweets_query_params(tweets_ids, request_text)
+                in_flight.add(executor.submit(fetch_tweets_batch, session, token_bucket, query_params, headers, search_url))
+            handle_done_requests(wait(in_flight).done)
@@ -0,0 +1,407 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import common_utiles as cu
+import fetcher_log
+import instrumentation as inst
+from processed_ids_index import ID_DTYPE, to_ids_array, write_npy_atomically
+
+FETCHER_OUT_DIRS = [cu.BASE_OUT_DIR + ("" if i == 1 else f'{i}') for i in range(1, 5)]
+FETCHED_TWEETS_STORE_DIR = os.path.join(cu.FINAL_REPORT_FOLDER, "fetched_tweets_store")
+FETCHED_TWEETS_DATES_STORE_DIR = os.path.join(cu.FINAL_REPORT_FOLDER, "fetched_tweets_dates_store")  # Fragments without text
+CURRENT_GENERATION_FNAME = "CURRENT"  # Holds the name of the generation dir with the latest compaction
+SEGMENTS_FNAME = "segments.json"  # Names of the generation's segment dirs (under the store dir), oldest first
+COMPACTED_FRAGMENTS_FNAME = "compacted_fragments.json"  # Fragment full name -> its fingerprint when it was compacted
+COMPACTED_LOG_OFFSETS_FNAME = "compacted_log_offsets.json"  # Fetcher log segment full name -> offset compacted up to
+STORE_ARRAYS = ["ids", "dates", "texts_blob", "text_starts", "text_ends", "not_found_ids", "not_authorized_ids"]
+MAX_STORE_SEGMENTS = 8  # When a compaction would pass this many segments, they're all merged into one
+DATE_UNIT = "ms"  # Dates are kept as int64 epochs in this unit (twitter's created_at has milliseconds)
+
+FRAGMENT_KIND_TWEETS = "tweets"
+FRAGMENT_KIND_NOT_FOUND = "not_found"
+FRAGMENT_KIND_NOT_AUTHORIZED = "not_authorized"
+
+
+class FetchedTweetsStore:
+    '''
+    The fetched tweets (id, date and text), indexed for joins: a sorted array of unique ids, their dates (int64 epochs)
+    and, for the i'th id, the [starts[i], ends[i]) slice of its text in a utf-8 blob. Probing a column of ids is a binary
+    search, and texts are decoded only for the ids that were found. Also holds the (sorted, unique) ids that the fetcher
+    couldn't find or wasn't authorized to get, as listed in the fragments and in the fetcher logs
+    '''
+
+    def __init__(self, ids, dates, texts_blob, text_starts, text_ends, not_found_ids=None, not_authorized_ids=None):
+        self.ids = ids
+        self.dates = dates
+        self.texts_blob = texts_blob
+        self.text_starts = text_starts
+        self.text_ends = text_ends
+        self.not_found_ids = not_found_ids if not_found_ids is not None else np.empty(0, ID_DTYPE)
+        self.not_authorized_ids = not_authorized_ids if not_authorized_ids is not None else np.empty(0, ID_DTYPE)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def probe(self, ids):
+        '''
+        Returns the position of every id in the store, -1 for ids that aren't in it
+        '''
+        ids = to_ids_array(ids)
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self.ids, ids)
+        positions[positions == len(self.ids)] = 0
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def get_dates(self, positions):
+        '''
+        Dates in twitter's created_at format (e.g. 2016-04-04T12:43:04.000Z)
+        '''
+        return epochs_to_dates(np.asarray(self.dates)[positions])
+
+    def get_texts(self, positions):
+        return decode_slices(self.texts_blob, np.asarray(self.text_starts)[positions], np.asarray(self.text_ends)[positions])
+
+    def save(self, generation_dir):
+        os.makedirs(generation_dir, exist_ok=True)
+        for name in STORE_ARRAYS:
+            write_npy_atomically(os.path.join(generation_dir, f'{name}.npy'), np.asarray(getattr(self, name)))
+
+    @staticmethod
+    def load(generation_dir):
+        arrays = {name: np.load(os.path.join(generation_dir, f'{name}.npy'), mmap_mode="r") for name in STORE_ARRAYS}
+        return FetchedTweetsStore(**arrays)
+
+
+class SegmentedFetchedTweetsStore:
+    '''
+    A store made of FetchedTweetsStore segments (the oldest first), each one with the tweets of one compaction. Has the
+    same interface as a FetchedTweetsStore: a position is the position in the segment plus the number of tweets in the
+    segments before it. If an id is in more than one segment, its first one is kept (same as in the builder)
+    '''
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.segment_starts = np.cumsum([0] + [len(segment.ids) for segment in segments])
+        self._ids, self._not_found_ids, self._not_authorized_ids = None, None, None
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = self.get_unique_ids("ids")
+        return self._ids
+
+    @property
+    def not_found_ids(self):
+        if self._not_found_ids is None:
+            self._not_found_ids = self.get_unique_ids("not_found_ids")
+        return self._not_found_ids
+
+    @property
+    def not_authorized_ids(self):
+        if self._not_authorized_ids is None:
+            self._not_authorized_ids = self.get_unique_ids("not_authorized_ids")
+        return self._not_authorized_ids
+
+    def get_unique_ids(self, name):
+        if len(self.segments) == 1:
+            return getattr(self.segments[0], name)  # Already sorted and unique
+        return unique_ids([np.asarray(getattr(segment, name)) for segment in self.segments])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def probe(self, ids):
+        '''
+        Returns the position of every id in the store, -1 for ids that aren't in it. Each segment is probed only for the
+        ids that weren't found in the segments before it
+        '''
+        ids = to_ids_array(ids)
+        positions = np.full(len(ids), -1, dtype=np.int64)
+        for segment, segment_start in zip(self.segments, self.segment_starts):
+            is_missing = positions < 0
+            if not is_missing.any():
+                break
+            segment_positions = segment.probe(ids[is_missing])
+            positions[is_missing] = np.where(segment_positions >= 0, segment_positions + segment_start, -1)
+        return positions
+
+    def get_dates(self, positions):
+        return self.gather(positions, FetchedTweetsStore.get_dates)
+
+    def get_texts(self, positions):
+        return self.gather(positions, FetchedTweetsStore.get_texts)
+
+    def gather(self, positions, get_values):
+        '''
+        Returns get_values(segment, positions in the segment) of every segment, in the order of positions
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        segment_indexes = np.searchsorted(self.segment_starts, positions, side="right") - 1
+        values = np.empty(len(positions), dtype=object)
+        for i, (segment, segment_start) in enumerate(zip(self.segments, self.segment_starts)):
+            is_in_segment = segment_indexes == i
+            if is_in_segment.any():
+                values[is_in_segment] = get_values(segment, positions[is_in_segment] - segment_start)
+        return values.tolist()
+
+
+class FetchedTweetsStoreBuilder:
+    '''
+    Collects fetched tweets in batches (already encoded, so there's no python object per tweet) and builds a
+    FetchedTweetsStore out of them. If an id was added more than once, its first date and text are kept
+    '''
+
+    def __init__(self):
+        self.batches = []  # (ids, dates, texts_blob, text_starts, text_ends)
+        self.not_found_ids, self.not_authorized_ids = [], []
+
+    def add(self, ids, dates, texts):
+        texts_blob, text_offsets = cu.encode_strings(texts)
+        self.add_encoded(to_ids_array(ids), dates_to_epochs(dates), texts_blob, text_offsets[:-1], text_offsets[1:])
+
+    def add_encoded(self, ids, dates, texts_blob, text_starts, text_ends):
+        self.batches.append((ids, dates, texts_blob, text_starts, text_ends))
+
+    def add_store(self, store):
+        self.add_encoded(np.asarray(store.ids), np.asarray(store.dates), np.asarray(store.texts_blob),
+                         np.asarray(store.text_starts), np.asarray(store.text_ends))
+        self.add_not_found(np.asarray(store.not_found_ids))
+        self.add_not_authorized(np.asarray(store.not_authorized_ids))
+
+    def add_not_found(self, ids):
+        self.not_found_ids.append(to_ids_array(ids))
+
+    def add_not_authorized(self, ids):
+        self.not_authorized_ids.append(to_ids_array(ids))
+
+    def __len__(self):
+        return sum(len(batch[0]) for batch in self.batches)
+
+    def build(self):
+        if len(self.batches) == 0:
+            ids, dates = np.empty(0, ID_DTYPE), np.empty(0, np.int64)
+            texts_blob, text_starts, text_ends = np.empty(0, np.uint8), np.empty(0, np.int64), np.empty(0, np.int64)
+        else:
+            blob_sizes = np.array([len(batch[2]) for batch in self.batches], dtype=np.int64)
+            blob_starts = np.concatenate([[0], np.cumsum(blob_sizes)[:-1]])
+            ids = np.concatenate([batch[0] for batch in self.batches])
+            dates = np.concatenate([batch[1] for batch in self.batches])
+            texts_blob = np.concatenate([batch[2] for batch in self.batches])
+            text_starts = np.concatenate([batch[3] + blob_start for batch, blob_start in zip(self.batches, blob_starts)])
+            text_ends = np.concatenate([batch[4] + blob_start for batch, blob_start in zip(self.batches, blob_starts)])
+        sorted_ids, first_positions = np.unique(ids, return_index=True)  # return_index gives the first occurrences
+        return FetchedTweetsStore(sorted_ids, dates[first_positions], texts_blob, text_starts[first_positions],
+                                  text_ends[first_positions], unique_ids(self.not_found_ids),
+                                  unique_ids(self.not_authorized_ids))
+
+
+def unique_ids(ids_list):
+    return np.unique(np.concatenate(ids_list)) if len(ids_list) > 0 else np.empty(0, ID_DTYPE)
+
+
+def dates_to_epochs(dates):
+    return pd.to_datetime(pd.Series(dates, dtype=object), utc=True, format="ISO8601").values.astype(f'datetime64[{DATE_UNIT}]').astype(np.int64)
+
+
+def epochs_to_dates(epochs):
+    return [f'{d}Z' for d in np.datetime_as_string(np.asarray(epochs, dtype=np.int64).astype(f'datetime64[{DATE_UNIT}]'), unit=DATE_UNIT)]
+
+
+def decode_slices(blob, starts, ends):
+    blob = memoryview(blob)
+    return [bytes(blob[start:end]).decode("utf-8", errors="surrogatepass") for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def list_fragments(out_dirs=FETCHER_OUT_DIRS, only_files_with_text=True):
+    '''
+    Returns (full fname, kind) of all the json fragments the fetcher wrote to out_dirs
+    '''
+    tweets_fname_prefix = "tweets_ids_to_creation_time_and_text" if only_files_with_text else "tweets_ids_to_creation_time"
+    dir_to_prefix_and_kind = {"tweets_ids_to_creation_time": (tweets_fname_prefix, FRAGMENT_KIND_TWEETS),
+                              "tweet_ids_not_found": ("tweet_ids_not_found", FRAGMENT_KIND_NOT_FOUND),
+                              "tweet_ids_not_authorized": ("tweet_ids_not_authorized", FRAGMENT_KIND_NOT_AUTHORIZED)}
+    fragments = []
+    for out_dir in out_dirs:
+        for sub_dir, (fname_prefix, kind) in dir_to_prefix_and_kind.items():
+            cur_dir = os.path.join(out_dir, sub_dir)
+            if not os.path.isdir(cur_dir):
+                continue
+            for filename in sorted(os.listdir(cur_dir)):
+                if filename.startswith(fname_prefix) and filename.endswith(".json"):
+                    fragments.append((os.path.join(cur_dir, filename), kind))
+    return fragments
+
+
+def parse_fragment(full_fname, kind):
+    '''
+    Returns the content of a fragment as arrays: (ids, dates, texts blob, text offsets) for tweets fragments and (ids,)
+    for the not found/authorized ones
+    '''
+    with open(full_fname, "r") as f:
+        content = json.load(f)
+    if kind != FRAGMENT_KIND_TWEETS:
+        return (np.array(content, dtype=object).astype(ID_DTYPE),)
+    return parse_fragment_values(list(content.keys()), list(content.values()))
+
+
+def parse_fragment_values(ids, values):
+    values = [(v["created_at"], v["text"]) if isinstance(v, dict) else (v, "") for v in values]
+    texts_blob, text_offsets = cu.encode_strings([v[1] for v in values])
+    return np.array(ids, dtype=object).astype(ID_DTYPE), dates_to_epochs([v[0] for v in values]), texts_blob, text_offsets
+
+
+def list_log_segments(out_dirs=FETCHER_OUT_DIRS):
+    return [segment_fname for out_dir in out_dirs for segment_fname in
+            fetcher_log.list_segments(os.path.join(out_dir, fetcher_log.FETCHER_LOG_DIR))]
+
+
+def parse_log_segment(segment_fname, start_offset, only_files_with_text=True):
+    '''
+    Returns the complete records of the segment from start_offset on as (tweets arrays as in parse_fragment(), not found
+    ids, not authorized ids, offset after the last record). Without only_files_with_text, tweets that were fetched
+    without their text are also taken
+    '''
+    ids, values, not_found_ids, not_authorized_ids = [], [], [], []
+    end_offset = start_offset
+    for record, end_offset in fetcher_log.read_segment(segment_fname, start_offset):
+        for tweet_id, value in record["data"].items():
+            if isinstance(value, dict) or not only_files_with_text:
+                ids.append(tweet_id)
+                values.append(value)
+        not_found_ids.extend(record["not_found"])
+        not_authorized_ids.extend(record["not_authorized"])
+    return (parse_fragment_values(ids, values), np.array(not_found_ids, dtype=object).astype(ID_DTYPE),
+            np.array(not_authorized_ids, dtype=object).astype(ID_DTYPE), end_offset)
+
+
+def get_current_generation_dir(store_dir):
+    current_fname = os.path.join(store_dir, CURRENT_GENERATION_FNAME)
+    if not os.path.isfile(current_fname):
+        return None
+    with open(current_fname) as f:
+        return os.path.join(store_dir, f.read().strip())
+
+
+def load_segments(store_dir, segment_names):
+    return SegmentedFetchedTweetsStore([FetchedTweetsStore.load(os.path.join(store_dir, name)) for name in segment_names])
+
+
+@inst.timed_stage()
+def compact_fetched_tweets(out_dirs=FETCHER_OUT_DIRS, store_dir=FETCHED_TWEETS_STORE_DIR, only_files_with_text=True,
+                           workers_num=None):
+    '''
+    Merges the fetcher's json fragments and logs into the store in store_dir. Only fragments that weren't compacted
+    before, and the records that were appended to the logs since, are parsed (in a pool of workers_num processes) and
+    written as a new segment of the store - the existing segments aren't read nor rewritten, unless there are already
+    MAX_STORE_SEGMENTS of them and they're merged with the new one. If a compacted fragment changed or was removed (or a
+    log segment was truncated or removed), the store is rebuilt from all of them.
+    Every compaction is written to a new generation dir (that lists the store's segments) and then made current, so a
+    crash leaves the previous one intact. Returns the (memory-mapped) store
+    '''
+    generation_dir = get_current_generation_dir(store_dir)
+    segment_names, compacted_fragments, compacted_log_offsets = [], {}, {}
+    if generation_dir is not None and not os.path.isfile(os.path.join(generation_dir, SEGMENTS_FNAME)):
+        inst.log(f'{generation_dir} was written before the store had segments, rebuilding {store_dir}')
+        generation_dir = None
+    if generation_dir is not None:
+        with open(os.path.join(generation_dir, SEGMENTS_FNAME)) as f:
+            segment_names = json.load(f)
+        with open(os.path.join(generation_dir, COMPACTED_FRAGMENTS_FNAME)) as f:
+            compacted_fragments = json.load(f)
+        compacted_log_offsets_fname = os.path.join(generation_dir, COMPACTED_LOG_OFFSETS_FNAME)
+        if os.path.isfile(compacted_log_offsets_fname):
+            with open(compacted_log_offsets_fname) as f:
+                compacted_log_offsets = json.load(f)
+
+    fragments = list_fragments(out_dirs, only_files_with_text)
+    fragment_to_fingerprint = {full_fname: list(cu.get_file_fingerprint(full_fname)) for full_fname, _ in fragments}
+    segment_to_size = {segment_fname: os.path.getsize(segment_fname) for segment_fname in list_log_segments(out_dirs)}
+    if any(fragment_to_fingerprint.get(full_fname) != fingerprint for full_fname, fingerprint in compacted_fragments.items()) or \
+            any(segment_to_size.get(segment_fname, -1) < offset for segment_fname, offset in compacted_log_offsets.items()):
+        inst.log(f'Compacted fragments or logs changed or were removed, rebuilding {store_dir}')
+        generation_dir, segment_names, compacted_fragments, compacted_log_offsets = None, [], {}, {}
+    new_fragments = [(full_fname, kind) for full_fname, kind in fragments if not full_fname in compacted_fragments]
+    new_log_segments = [(segment_fname, compacted_log_offsets.get(segment_fname, 0), only_files_with_text) for
+                        segment_fname, size in segment_to_size.items() if size > compacted_log_offsets.get(segment_fname, 0)]
+    if generation_dir is not None and len(new_fragments) == 0 and len(new_log_segments) == 0:
+        return load_segments(store_dir, segment_names)
+
+    inst.log(f'Compacting {len(new_fragments)} new fragments ({len(compacted_fragments)} were compacted before) and {len(new_log_segments)} log segments')
+    if workers_num is None:
+        workers_num = cu.SHARD_WORKERS_NUM
+    workers_num = min(workers_num, max(len(new_fragments), len(new_log_segments)))
+    if workers_num <= 1:
+        parsed_fragments = [parse_fragment(full_fname, kind) for full_fname, kind in new_fragments]
+        parsed_log_segments = [parse_log_segment(*args) for args in new_log_segments]
+    else:
+        with ProcessPoolExecutor(max_workers=workers_num) as executor:
+            parsed_fragments = list(executor.map(parse_fragment, *zip(*new_fragments), chunksize=16)) if len(new_fragments) > 0 else []
+            parsed_log_segments = list(executor.map(parse_log_segment, *zip(*new_log_segments))) if len(new_log_segments) > 0 else []
+    if generation_dir is not None and len(new_fragments) == 0 and \
+            all(parsed[-1] == start_offset for (_, start_offset, _), parsed in zip(new_log_segments, parsed_log_segments)):
+        return load_segments(store_dir, segment_names)  # Only partial records (that are being written) were appended
+
+    builder = FetchedTweetsStoreBuilder()
+    if len(segment_names) >= MAX_STORE_SEGMENTS:
+        inst.log(f'Merging the {len(segment_names)} segments of {store_dir} into the new one')
+        for segment in load_segments(store_dir, segment_names).segments:
+            builder.add_store(segment)  # Older segments first, so their tweets are kept over the new ones
+        segment_names = []
+    inst.add_bytes(sum(os.path.getsize(full_fname) for full_fname, _ in new_fragments) +
+                   sum(segment_to_size[segment_fname] - start_offset for segment_fname, start_offset, _ in new_log_segments))
+    for (_, kind), parsed_fragment in zip(new_fragments, parsed_fragments):
+        inst.add_rows(len(parsed_fragment[0]))
+        if kind == FRAGMENT_KIND_TWEETS:
+            ids, dates, texts_blob, text_offsets = parsed_fragment
+            builder.add_encoded(ids, dates, texts_blob, text_offsets[:-1], text_offsets[1:])
+        elif kind == FRAGMENT_KIND_NOT_FOUND:
+            builder.add_not_found(parsed_fragment[0])
+        else:
+            builder.add_not_authorized(parsed_fragment[0])
+    for (segment_fname, _, _), parsed_log_segment in zip(new_log_segments, parsed_log_segments):
+        (ids, dates, texts_blob, text_offsets), not_found_ids, not_authorized_ids, end_offset = parsed_log_segment
+        inst.add_rows(len(ids) + len(not_found_ids) + len(not_authorized_ids))
+        builder.add_encoded(ids, dates, texts_blob, text_offsets[:-1], text_offsets[1:])
+        builder.add_not_found(not_found_ids)
+        builder.add_not_authorized(not_authorized_ids)
+        compacted_log_offsets[segment_fname] = end_offset
+    segment = builder.build()
+
+    compaction_time_ns = time.time_ns()
+    new_segment_name, new_generation_name = f'segment_{compaction_time_ns}', f'generation_{compaction_time_ns}'
+    segment.save(os.path.join(store_dir, new_segment_name))
+    segment_names = segment_names + [new_segment_name]
+    new_generation_dir = os.path.join(store_dir, new_generation_name)
+    os.makedirs(new_generation_dir, exist_ok=True)
+    with open(os.path.join(new_generation_dir, SEGMENTS_FNAME), "w") as f:
+        json.dump(segment_names, f)
+    with open(os.path.join(new_generation_dir, COMPACTED_FRAGMENTS_FNAME), "w") as f:
+        json.dump({full_fname: fragment_to_fingerprint[full_fname] for full_fname, _ in fragments}, f)
+    with open(os.path.join(new_generation_dir, COMPACTED_LOG_OFFSETS_FNAME), "w") as f:
+        json.dump(compacted_log_offsets, f)
+    current_tmp_fname = os.path.join(store_dir, f'{CURRENT_GENERATION_FNAME}.tmp')
+    with open(current_tmp_fname, "w") as f:
+        f.write(new_generation_name)
+    os.replace(current_tmp_fname, os.path.join(store_dir, CURRENT_GENERATION_FNAME))
+
+    for name in os.listdir(store_dir):
+        if (name.startswith("generation_") and name != new_generation_name) or \
+                (name.startswith("segment_") and not name in segment_names):
+            shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)  # Older generations and merged segments
+    store = load_segments(store_dir, segment_names)
+    inst.log(f'Compacted {len(segment)} tweets to {new_segment_name} ({len(store)} tweets in {len(segment_names)} segments of {store_dir})')
+    return store
+
+
+if __name__ == "__main__":
+    inst.log(f'Start')
+    with inst.run("compact_fetched_tweets"):
+        compact_fetched_tweets()
+    inst.log(f'FIN')
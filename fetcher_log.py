@@ -0,0 +1,144 @@
+import json
+import os
+import time
+
+FETCHER_LOG_DIR = "fetcher_log"
+SEGMENT_FNAME_PREFIX = "segment_"
+SEGMENT_FNAME_EXTENSION = ".ndjson"
+MAX_SEGMENT_BYTES = 64 * 2 ** 20  # The active segment is rotated once it's bigger than this
+FSYNC_EVERY_RECORDS = 64
+FSYNC_EVERY_SECONDS = 5
+TAIL_POLL_SECONDS = 1
+READ_BLOCK_BYTES = 2 ** 20
+
+
+def get_segment_fname(log_dir, segment_num):
+    return os.path.join(log_dir, f'{SEGMENT_FNAME_PREFIX}{segment_num:08d}{SEGMENT_FNAME_EXTENSION}')
+
+
+def get_segment_num(segment_fname):
+    return int(os.path.basename(segment_fname)[len(SEGMENT_FNAME_PREFIX):-len(SEGMENT_FNAME_EXTENSION)])
+
+
+def list_segments(log_dir):
+    if not os.path.isdir(log_dir):
+        return []
+    return [os.path.join(log_dir, fname) for fname in sorted(os.listdir(log_dir)) if
+            fname.startswith(SEGMENT_FNAME_PREFIX) and fname.endswith(SEGMENT_FNAME_EXTENSION)]
+
+
+def truncate_partial_record(segment_fname):
+    '''
+    A crash in the middle of a write leaves a partial last line - drops it, so appending starts from a clean record
+    '''
+    with open(segment_fname, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            block_start = max(0, pos - READ_BLOCK_BYTES)
+            f.seek(block_start)
+            block = f.read(pos - block_start)
+            last_newline = block.rfind(b"\n")
+            if last_newline >= 0:
+                pos = block_start + last_newline + 1
+                break
+            pos = block_start
+        if pos < end:
+            f.truncate(pos)
+
+
+class FetcherLogWriter:
+    '''
+    Append-only log of the fetcher's responses: every record is a json line, written (and flushed to the OS) as soon as
+    the response arrives. fsync is batched (every fsync_every_records records or fsync_every_seconds seconds) and the log
+    is split to segments of about max_segment_bytes, so old segments are never rewritten
+    '''
+
+    def __init__(self, log_dir, max_segment_bytes=MAX_SEGMENT_BYTES, fsync_every_records=FSYNC_EVERY_RECORDS,
+                 fsync_every_seconds=FSYNC_EVERY_SECONDS):
+        self.log_dir = log_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync_every_records = fsync_every_records
+        self.fsync_every_seconds = fsync_every_seconds
+        os.makedirs(log_dir, exist_ok=True)
+        segments = list_segments(log_dir)
+        if len(segments) > 0:
+            truncate_partial_record(segments[-1])
+        self.open_segment(get_segment_num(segments[-1]) if len(segments) > 0 else 0)
+
+    def open_segment(self, segment_num):
+        self.segment_num = segment_num
+        self.file = open(get_segment_fname(self.log_dir, segment_num), "ab")
+        self.records_since_sync = 0
+        self.last_sync_time = time.time()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.file.flush()  # Survives a crash of the process, fsync makes it survive a crash of the machine
+        self.records_since_sync += 1
+        if self.records_since_sync >= self.fsync_every_records or time.time() - self.last_sync_time >= self.fsync_every_seconds:
+            self.sync()
+        if self.file.tell() >= self.max_segment_bytes:
+            self.rotate()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records_since_sync = 0
+        self.last_sync_time = time.time()
+
+    def rotate(self):
+        self.sync()
+        self.file.close()
+        self.open_segment(self.segment_num + 1)
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_segment(segment_fname, start_offset=0):
+    '''
+    Yields (record, offset after it) of the complete records in the segment, starting at start_offset (a record start)
+    '''
+    with open(segment_fname, "rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            if not line.endswith(b"\n"):
+                return  # A record that is being written (or a partial one, after a crash)
+            offset += len(line)
+            yield json.loads(line), offset
+
+
+def replay(log_dir, segment_to_offset=None):
+    '''
+    Yields (segment full fname, offset after the record, record) of all the complete records in the log, in order.
+    segment_to_offset maps segments to the offset to start reading them from (e.g. the offsets that were already
+    processed) - segments that aren't in it are read from their start
+    '''
+    segment_to_offset = segment_to_offset or {}
+    for segment_fname in list_segments(log_dir):
+        for record, offset in read_segment(segment_fname, segment_to_offset.get(segment_fname, 0)):
+            yield segment_fname, offset, record
+
+
+def tail(log_dir, segment_to_offset=None, poll_seconds=TAIL_POLL_SECONDS):
+    '''
+    Same as replay(), but keeps following the log for new records (forever)
+    '''
+    segment_to_offset = dict(segment_to_offset or {})
+    while True:
+        has_new_records = False
+        for segment_fname, offset, record in replay(log_dir, segment_to_offset):
+            segment_to_offset[segment_fname] = offset
+            has_new_records = True
+            yield segment_fname, offset, record
+        if not has_new_records:
+            time.sleep(poll_seconds)
@@ -1,74 +1,55 @@
 import glob
 
 from common_utiles import *
+import instrumentation as inst
+import pipeline as pl
+import plot_rendering as pr
+import shard_aggregates_cache as sac
+import shard_manifest as sm
+from fetched_tweets_store import FETCHED_TWEETS_STORE_DIR, FETCHED_TWEETS_DATES_STORE_DIR, FETCHER_OUT_DIRS, compact_fetched_tweets
+from processed_ids_index import is_in_sorted
 
 DELTA_TIME_IN_DAYS = 14
+GRANULARITY_MONTHLY = "monthly"
+DEFAULT_GRANULARITIES = (1, 7, DELTA_TIME_IN_DAYS, GRANULARITY_MONTHLY)  # Days per date bucket, or calendar months
+POLICY_ALL_TWEETS = "all_tweets"  # Every tweet counts as 1
+POLICY_ONE_PER_USER_DAY_STANCE = "one_per_user_day_stance"  # Every user counts no more than once a day per stance
+POLICY_INVERSE_USER_TOTAL = "inverse_user_total"  # Every tweet counts as 1/(number of tweets of its user)
+POLICY_INVERSE_USER_TIMESPAN = "inverse_user_timespan"  # Every tweet counts as 1/(number of tweets of its user in its date bucket)
+COUNTING_POLICIES = (POLICY_ALL_TWEETS, POLICY_ONE_PER_USER_DAY_STANCE, POLICY_INVERSE_USER_TOTAL, POLICY_INVERSE_USER_TIMESPAN)
+USER_TOTALS_FROM_CORPUS = "corpus"  # Users' tweets counted in the shards
+USER_TOTALS_FROM_USERS_FILE = "users_file"  # tweets_num of the users csv (the corpus count for users missing from it)
+BOT_SCORE_THRESHOLDS = [0.3, 0.5, 0.7, 0.98]  # Probability of an account being a bot (1 is the highest)
 DEF_CSV_HEADER = ('t_id', 'user_id', 't_sentiment', 't_stance', 't_date') #ID~user_id~t_sentiment~t_stance
 CSV_HEADER_INCL_TXT = ('t_id', 'user_id', 't_sentiment', 't_stance', 't_date', 't_text')
 
+@inst.timed_stage()
 def get_existing_tweets_per_category(only_files_with_text):
-    tweets_ids_and_creation_time = []
-    tweets_ids_not_found = set()
-    tweets_ids_not_authorized = set()
-    tweets_ids_so_far = set()
-    for i in range(1,5):
-        out_folder = BASE_OUT_DIR+("" if i == 1 else f'{i}')
-        cur_dir = os.path.join(out_folder, "tweets_ids_to_creation_time")
-        print(f'{get_cur_formatted_time()} {cur_dir}')
-        for filename in os.listdir(cur_dir):
-            if filename.startswith("tweets_ids_to_creation_time") and filename.endswith(".json"):
-                if filename.startswith("tweets_ids_to_creation_time_and_text") or not only_files_with_text:
-                    with open(os.path.join(cur_dir, filename), "r") as f:
-                        cur_dict = json.load(f)
-                        for key in cur_dict:
-                            i_key = int(key)
-                            tweets_ids_so_far.add(i_key)
-                            if isinstance(cur_dict[key], dict) and only_files_with_text:
-                                vals_tuple = tuple(cur_dict[key].values())
-                                tweets_ids_and_creation_time.append((i_key, vals_tuple[0], vals_tuple[1]))
-                            else:
-                                tweets_ids_and_creation_time.append((i_key)+cur_dict.values())
-
-    print(f'{get_cur_formatted_time()} Retrieved dates{" and texts" if only_files_with_text else ""} for {len(tweets_ids_and_creation_time)} tweets')
+    '''
+    Returns the fetched tweets as a SegmentedFetchedTweetsStore, and the sorted ids of the tweets that weren't found and of those
+    that weren't authorized (excluding ids that were eventually fetched). The fetcher's fragments are compacted into the
+    store first - only the fragments that were added since the last compaction are parsed
+    '''
+    store_dir = FETCHED_TWEETS_STORE_DIR if only_files_with_text else FETCHED_TWEETS_DATES_STORE_DIR
+    fetched_tweets = compact_fetched_tweets(store_dir=store_dir, only_files_with_text=only_files_with_text)
+    inst.log(f'Retrieved dates{" and texts" if only_files_with_text else ""} for {len(fetched_tweets)} tweets')
 
-    for i in range(1, 5):
-        out_folder = BASE_OUT_DIR + ("" if i == 1 else f'{i}')
-        cur_dir = os.path.join(out_folder, "tweet_ids_not_found")
-        print(f'{get_cur_formatted_time()} {cur_dir}')
-        for filename in os.listdir(cur_dir):
-            if filename.startswith("tweet_ids_not_found") and filename.endswith(".json"):
-                with open(os.path.join(cur_dir, filename), "r") as f:
-                    cur_list = set(json.load(f))
-                    for t_id in cur_list:
-                        i_t_id = int(t_id)
-                        if not i_t_id in tweets_ids_so_far:
-                            tweets_ids_not_found.add(i_t_id)
-
-    print(f'{get_cur_formatted_time()} Unable to find {len(tweets_ids_not_found)} tweets')
+    tweets_ids_not_found = np.setdiff1d(fetched_tweets.not_found_ids, fetched_tweets.ids)
+    inst.log(f'Unable to find {len(tweets_ids_not_found)} tweets')
 
-    for i in range(1, 5):
-        out_folder = BASE_OUT_DIR + ("" if i == 1 else f'{i}')
-        cur_dir = os.path.join(out_folder, "tweet_ids_not_authorized")
-        print(f'{get_cur_formatted_time()} {cur_dir}')
-        for filename in os.listdir(cur_dir):
-            if filename.startswith("tweet_ids_not_authorized") and filename.endswith(".json"):
-                with open(os.path.join(cur_dir, filename), "r") as f:
-                    cur_list = json.load(f)
-                    for t_id in cur_list:
-                        i_t_id = int(t_id)
-                        if not (i_t_id in tweets_ids_so_far or i_t_id in tweets_ids_not_found):
-                            tweets_ids_not_authorized.add(i_t_id)
-
-    print(f'{get_cur_formatted_time()} Unauthorized to access {len(tweets_ids_not_authorized)} tweets')
-
-    return tweets_ids_and_creation_time, tweets_ids_not_found, tweets_ids_not_authorized
-
-def final_report_data_generator(only_files_with_text = True):
-    max_tweets_per_file = 5*10**6
-    tweets_ids_and_creation_time, tweets_ids_not_found, tweets_ids_not_authorized = get_existing_tweets_per_category(only_files_with_text)
-    cols = ['t_id', 't_date', 't_text'] if only_files_with_text else ['t_id', 't_date']
-    tweets_ids_and_creation_time = pd.DataFrame.from_records(tweets_ids_and_creation_time, columns=cols)
+    tweets_ids_not_authorized = np.setdiff1d(fetched_tweets.not_authorized_ids, np.union1d(fetched_tweets.ids, tweets_ids_not_found))
+    inst.log(f'Unauthorized to access {len(tweets_ids_not_authorized)} tweets')
 
+    return fetched_tweets, tweets_ids_not_found, tweets_ids_not_authorized
+
+@inst.timed_stage()
+def final_report_data_generator(only_files_with_text = True, shard_format=SHARD_FORMAT_CSV):
+    '''
+    Joins the dataverse files with the fetched tweets, chunk by chunk: every chunk's ids are probed in the (sorted)
+    fetched tweets store, so memory is bounded by the chunk size and the compact store
+    '''
+    max_tweets_per_file = 5*10**6
+    fetched_tweets, tweets_ids_not_found, tweets_ids_not_authorized = get_existing_tweets_per_category(only_files_with_text)
 
     for i in range(1, 5):
         removed_files_count = 0
@@ -77,118 +58,371 @@ def final_report_data_generator(only_files_with_text = True):
                 os.remove(os.path.join(FINAL_REPORT_DATA_FOLDER, filename))
                 removed_files_count += 1
         if removed_files_count > 0:
-            print(f'{get_cur_formatted_time()} Deleted {removed_files_count} files from {FINAL_REPORT_DATA_FOLDER}')
+            inst.log(f'Deleted {removed_files_count} files from {FINAL_REPORT_DATA_FOLDER}')
 
         out_file_count = 1
         data_file = os.path.join(DATA_FOLDER, f'tweets_stance_sentiment_{i}outof4.csv')
-        print(f'{get_cur_formatted_time()} Reading {data_file}')
-        tweets_ids_not_requested_yet = set()
+        inst.log(f'Reading {data_file}')
+        tweets_ids_not_requested_yet = []
 
+        inst.add_bytes(os.path.getsize(data_file))
         with pd.read_csv(data_file, chunksize=max_tweets_per_file, sep="~") as reader:
             for chunk in reader:
-                out_fname = os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_stance_sentiment_incl_date_and_text_{i}_{out_file_count}_outof4.csv')
+                inst.add_rows(len(chunk.index))
+                out_fname = os.path.join(FINAL_REPORT_DATA_FOLDER, f'{SHARD_FNAME_PREFIX}_{i}_{out_file_count}_outof4')
                 if i == 1:
                     chunk.rename(columns={'ID': 't_id'}, inplace=True)
                 else:
                     chunk.columns = list(DEF_CSV_HEADER)[:4]
 
-                result = chunk.merge(tweets_ids_and_creation_time, how='inner')
-                print(f'{get_cur_formatted_time()} Writing {len(result.index)} records to {out_fname}')
-                result.to_csv(path_or_buf=out_fname, index=False)
+                positions = fetched_tweets.probe(chunk['t_id'].values)
+                is_fetched = positions >= 0
+                result = chunk[is_fetched].reset_index(drop=True)
+                result['t_date'] = fetched_tweets.get_dates(positions[is_fetched])
+                if only_files_with_text:
+                    result['t_text'] = fetched_tweets.get_texts(positions[is_fetched])
+                sm.write_shard_manifest([result], write_shard(result, out_fname, shard_format))
                 out_file_count += 1
 
-                unfound_tweets_ids = set(chunk['t_id'].tolist())
-                tweets_ids_and_creation_time_set = set(tweets_ids_and_creation_time['t_id'].tolist())
-                tweets_ids_not_found -= tweets_ids_and_creation_time_set
-                tweets_ids_not_authorized -= tweets_ids_and_creation_time_set
-                unfound_tweets_ids = unfound_tweets_ids.difference(tweets_ids_and_creation_time_set, tweets_ids_not_found, tweets_ids_not_authorized)
-                tweets_ids_not_requested_yet.update(unfound_tweets_ids)
+                unfetched_tweets_ids = chunk['t_id'].values[~is_fetched].astype(np.int64)
+                tweets_ids_not_requested_yet.append(unfetched_tweets_ids[~(is_in_sorted(tweets_ids_not_found, unfetched_tweets_ids) | is_in_sorted(tweets_ids_not_authorized, unfetched_tweets_ids))])
 
         cur_existing_tweets_files = glob.glob(os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_yet_requested_{i}*.json'))
         for fname in cur_existing_tweets_files:
             os.remove(fname)
-            print(f'{get_cur_formatted_time()} Deleted {fname}')
+            inst.log(f'Deleted {fname}')
 
-        write_to_json_file_if_not_empty(list(tweets_ids_not_requested_yet), os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_yet_requested_{i}.json'))
+        write_to_json_file_if_not_empty(np.unique(np.concatenate(tweets_ids_not_requested_yet)).tolist() if len(tweets_ids_not_requested_yet) > 0 else [], os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_yet_requested_{i}.json'))
 
-    write_to_json_file_if_not_empty(list(tweets_ids_not_found), os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_found.json'))
-    write_to_json_file_if_not_empty(list(tweets_ids_not_authorized), os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_authorized.json'))
+    write_to_json_file_if_not_empty(tweets_ids_not_found.tolist(), os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_found.json'))
+    write_to_json_file_if_not_empty(tweets_ids_not_authorized.tolist(), os.path.join(FINAL_REPORT_DATA_FOLDER, f'tweets_ids_not_authorized.json'))
 
 def plot_stances_from_counters(aggregated_df, y_col_name, earliest_date, latest_date, name, ylabel):
-    ax = aggregated_df[aggregated_df["t_stance"] == "other"].plot.scatter(x="Date", y=y_col_name, color=OTHER_STANCE_COLOR, label="other")
-    aggregated_df[aggregated_df["t_stance"] == "remain"].plot.scatter(x="Date", y=y_col_name, ax=ax, color=REMAIN_COLOR, label="remain")
-    aggregated_df[aggregated_df["t_stance"] == "leave"].plot.scatter(x="Date", y=y_col_name, ax=ax, color=LEAVE_COLOR, label="leave")
+    fig = pr.new_figure()
+    ax = fig.add_subplot()
+    stance_to_df = dict(list(aggregated_df.groupby("t_stance", observed=True)))  # One pass over the rows, not one per stance
+    for stance, color in [("other", OTHER_STANCE_COLOR), ("remain", REMAIN_COLOR), ("leave", LEAVE_COLOR)]:
+        if stance in stance_to_df:
+            ax.scatter(stance_to_df[stance]["Date"], stance_to_df[stance][y_col_name], color=color, label=stance)
     ax.legend(loc="upper right")
     #Todo - Make the x-axis limits as earliest_date, latest_date (respectively) and not min, max of aggregated_df[""Date"] (respectively)
 
-    plt.title(f"Brexit tweets - {name}")
-    plt.ylabel(ylabel)
+    ax.set_title(f"Brexit tweets - {name}")
+    ax.set_xlabel("Date")
+    ax.set_ylabel(ylabel)
 
     xticks_num = len(ax.xaxis.get_ticklabels())
     n = 7  # Keeps every nth label
     [l.set_visible(False) for (i, l) in enumerate(ax.xaxis.get_ticklabels()) if i % n != 0 and i < xticks_num-1]
-    plt.xticks(rotation=45, ha="right") #Tilt the x ticks lables
-    plt.subplots_adjust(bottom=0.25)
+    for label in ax.xaxis.get_ticklabels():
+        label.set_rotation(45)  # Tilt the x ticks lables
+        label.set_horizontalalignment("right")
+    fig.subplots_adjust(bottom=0.25)
 
-    save_fig(name)
+    pr.save_figure(fig, name)
 
 def add_folder_prefix(fname, folder = PLOTS_DATA_FOLDER):
     return os.path.join(folder, fname)
 
-def get_min_and_max_dates_and_write_to_file(folder = FINAL_REPORT_DATA_FOLDER, read_from_existing_file = True):
-    existing_fname = add_folder_prefix("date_limits.json")
-    if read_from_existing_file and os.path.isfile(existing_fname):
-        with open(existing_fname) as json_file:
-            dates_limits = json.load(json_file)
-            earliest_date = datetime.datetime.strptime(dates_limits["earliest_date"], DATE_FORMAT).replace(tzinfo=None)
-            latest_date = datetime.datetime.strptime(dates_limits["latest_date"], DATE_FORMAT).replace(tzinfo=None)
+DATE_LIMITS_FNAME = add_folder_prefix("date_limits.json")
+
+def read_date_limits(fname=DATE_LIMITS_FNAME):
+    with open(fname) as json_file:
+        dates_limits = json.load(json_file)
+    earliest_date = datetime.datetime.strptime(dates_limits["earliest_date"], DATE_FORMAT).replace(tzinfo=None)
+    latest_date = datetime.datetime.strptime(dates_limits["latest_date"], DATE_FORMAT).replace(tzinfo=None)
+    return earliest_date, latest_date
+
+def get_shard_min_and_max_dates(full_fname):
+    return sm.get_manifest_date_limits(sm.get_shard_manifest(full_fname))
+
+@inst.timed_stage()
+def get_min_and_max_dates_and_write_to_file(folder = FINAL_REPORT_DATA_FOLDER, read_from_existing_file = False, workers_num=None):
+    '''
+    With read_from_existing_file, the existing file is read if the pipeline's stance_aggregates stage (that writes it) is
+    up to date with the shards
+    '''
+    if read_from_existing_file and folder == FINAL_REPORT_DATA_FOLDER and pl.is_stage_up_to_date(get_stance_aggregates_stage()):
+        earliest_date, latest_date = read_date_limits()
     else:
         earliest_date, latest_date = datetime.datetime.strptime("3000-01-01", DATE_FORMAT).replace(tzinfo=None),  datetime.datetime.strptime("1000-01-01", DATE_FORMAT).replace(tzinfo=None)
-        for fname in os.listdir(folder):
-            if not (fname.startswith(f'tweets_stance_sentiment_incl_date_and_text') and fname.endswith(".csv")):
-                continue
-            full_fname = os.path.join(FINAL_REPORT_DATA_FOLDER, fname)
-            print(f'{get_cur_formatted_time()} Reading {full_fname} (for date limits calculation)')
-            data = pd.read_csv(full_fname)
-            datetime_series = pd.to_datetime(data["t_date"], format=DATE_FORMAT)
-            earliest_date = min(earliest_date, min(datetime_series).replace(tzinfo=None))
-            latest_date = max(latest_date, max(datetime_series).replace(tzinfo=None))
+        shards_min_and_max_dates = map_reduce_shards(get_shard_min_and_max_dates, list, shard_fnames=list_shard_files(folder), workers_num=workers_num)
+        for shard_earliest_date, shard_latest_date in shards_min_and_max_dates:
+            if shard_earliest_date is None:
+                continue  # An empty shard
+            earliest_date = min(earliest_date, shard_earliest_date)
+            latest_date = max(latest_date, shard_latest_date)
 
         earliest_date, latest_date = earliest_date.replace(microsecond=0, second=0, minute=0, tzinfo=None), latest_date.replace(microsecond=0, second=0, minute=0, tzinfo=None)
         earliest_date_str, latest_date_str = earliest_date.strftime(DATE_FORMAT), latest_date.strftime(DATE_FORMAT)
-        write_to_json_file_if_not_empty({"earliest_date": earliest_date_str, "latest_date": latest_date_str}, add_folder_prefix("date_limits.json"))
+        write_to_json_file_if_not_empty({"earliest_date": earliest_date_str, "latest_date": latest_date_str}, DATE_LIMITS_FNAME)
 
     return earliest_date, latest_date
 
-def get_sentiment_aggregated_data(bot_score_threshold=None):
-    earliest_date, latest_date = get_min_and_max_dates_and_write_to_file()
+def get_stance_counts_group_cols(per_user=False):
+    return ["user_id", "t_hour", "t_stance"] if per_user else ["t_hour", "t_stance"]
+
+def get_stance_counts_partial_name(bot_score_threshold, per_user=False):
+    return f'{"user_" if per_user else ""}stance_counts_{sac.get_threshold_name(bot_score_threshold)}'
+
+def get_empty_stance_counts(per_user=False):
+    df = pd.DataFrame({"t_hour": pd.Series([], dtype="datetime64[ns]"), "t_stance": pd.Series([], dtype=object),
+                       "size": pd.Series([], dtype=np.int64)})
+    if per_user:
+        df.insert(0, "user_id", pd.Series([], dtype=np.int64))
+    return df
+
+def stance_counts_to_arrays(stance_counts_df):
+    stance_ids, stances = pd.factorize(stance_counts_df["t_stance"].astype(str))
+    stances_blob, stances_blob_offsets = encode_strings(stances)
+    arrays = {"hours": stance_counts_df["t_hour"].values.astype("datetime64[h]").astype(np.int64), "stance_ids": stance_ids,
+              "stances_blob": stances_blob, "stances_blob_offsets": stances_blob_offsets,
+              "counts": stance_counts_df["size"].values.astype(np.int64)}
+    if "user_id" in stance_counts_df.columns:
+        arrays["user_ids"] = stance_counts_df["user_id"].values.astype(np.int64)
+    return arrays
+
+def stance_counts_from_arrays(arrays):
+    stances = np.array(decode_strings(arrays["stances_blob"], arrays["stances_blob_offsets"]), dtype=object)
+    df = pd.DataFrame({"t_hour": arrays["hours"].astype("datetime64[h]").astype("datetime64[ns]"),
+                       "t_stance": stances[arrays["stance_ids"]] if len(stances) > 0 else np.empty(0, dtype=object),
+                       "size": arrays["counts"]})
+    if "user_ids" in arrays:
+        df.insert(0, "user_id", arrays["user_ids"])
+    return df
+
+def count_shard_stances_per_hour(full_fname, threshold_to_should_filter, per_user=False, hours=None, start_date=None,
+                                 end_date=None):
+    '''
+    The shard is read in chunks (see iter_shard_chunks()) and the counts of the chunks are summed, so only a chunk and
+    the counts are held in memory. If hours is given, only the tweets of these hours that are in [start_date, end_date]
+    are counted (see get_boundary_hours())
+    '''
+    any_bots_filter = any(threshold_to_should_filter.values())
+    bot_msg_suffix = f' (bot score thresholds {list(threshold_to_should_filter)})' if any_bots_filter else ""
+    inst.log(f'Parsing {full_fname}{bot_msg_suffix}')
+    cols = ["t_date", "t_stance", "user_id"] if any_bots_filter or per_user else ["t_date", "t_stance"]
+    group_cols = get_stance_counts_group_cols(per_user)
+    threshold_to_dfs = {bot_score_threshold: [] for bot_score_threshold in threshold_to_should_filter}
+    for df in iter_shard_chunks(full_fname, columns=cols):
+        if any_bots_filter:
+            bot_scores = get_bot_scores(df["user_id"])
+        df["t_hour"] = df["t_date"].dt.floor("h")
+        if hours is not None:
+            is_in_range = df["t_hour"].isin(hours)
+            if start_date is not None:
+                is_in_range &= df["t_date"] >= pd.Timestamp(start_date)
+            if end_date is not None:
+                is_in_range &= sm.is_up_to_end_date(df["t_date"], end_date)
+            df = df[is_in_range]
+            if any_bots_filter:
+                bot_scores = bot_scores[is_in_range]
+        df["t_stance"] = df["t_stance"].astype(str)  # The categories differ between chunks
+        for bot_score_threshold, should_filter_bots in threshold_to_should_filter.items():
+            cur_df = df[np.logical_or(bot_scores.isna(), bot_scores <= bot_score_threshold)] if should_filter_bots else df
+            threshold_to_dfs[bot_score_threshold].append(cur_df.groupby(by=group_cols, as_index=False, observed=True).size())
+    threshold_to_df = {}
+    for bot_score_threshold, dfs in threshold_to_dfs.items():
+        df = pd.concat(dfs) if len(dfs) > 0 else get_empty_stance_counts(per_user)
+        threshold_to_df[bot_score_threshold] = df.groupby(by=group_cols, as_index=False).sum() if len(dfs) > 1 else df
+    return threshold_to_df
+
+def aggregate_shard_per_bot_thresholds(full_fname, threshold_to_should_filter, per_user=False):
+    '''
+    Counts the tweets of the shard per (hour, stance) - or per (user, hour, stance) if per_user - for each threshold.
+    The counts are cached per shard (see shard_aggregates_cache) and only the thresholds without valid cached counts are
+    computed, in a single read of the shard. Hours are bucketed to dates only after all the shards are merged, so the
+    cache doesn't depend on the date limits
+    '''
+    threshold_to_df, missing_threshold_to_should_filter = {}, {}
+    for bot_score_threshold, should_filter_bots in threshold_to_should_filter.items():
+        cache_threshold = bot_score_threshold if should_filter_bots else None
+        arrays = sac.load_partial(full_fname, get_stance_counts_partial_name(cache_threshold, per_user),
+                                  sac.get_shard_fingerprint(full_fname, cache_threshold))
+        if arrays is None:
+            missing_threshold_to_should_filter[bot_score_threshold] = should_filter_bots
+        else:
+            threshold_to_df[bot_score_threshold] = stance_counts_from_arrays(arrays)
 
-    aggregated_df = None
-    should_filter_bots, bot_msg_suffix = handle_bots(bot_score_threshold)
+    if len(missing_threshold_to_should_filter) > 0:
+        for bot_score_threshold, df in count_shard_stances_per_hour(full_fname, missing_threshold_to_should_filter, per_user).items():
+            cache_threshold = bot_score_threshold if threshold_to_should_filter[bot_score_threshold] else None
+            sac.save_partial(full_fname, get_stance_counts_partial_name(cache_threshold, per_user),
+                             sac.get_shard_fingerprint(full_fname, cache_threshold), stance_counts_to_arrays(df))
+            threshold_to_df[bot_score_threshold] = df
+    return threshold_to_df
 
-    for fname in os.listdir(FINAL_REPORT_DATA_FOLDER):
-        if not (fname.startswith(f'tweets_stance_sentiment_incl_date_and_text') and fname.endswith(".csv")):
+def merge_shards_aggregations(shards_threshold_to_df, bot_score_thresholds, per_user=False):
+    '''
+    Merges the counts of the shards for each of bot_score_thresholds (empty counts if there are no shards)
+    '''
+    threshold_to_merged_df = {}
+    for bot_score_threshold in bot_score_thresholds:
+        if len(shards_threshold_to_df) == 0:
+            threshold_to_merged_df[bot_score_threshold] = get_empty_stance_counts(per_user)
             continue
-        full_fname = os.path.join(FINAL_REPORT_DATA_FOLDER, fname)
-        print(f'{get_cur_formatted_time()} Parsing {full_fname}{bot_msg_suffix}')
-        df = pd.read_csv(full_fname)
-        if should_filter_bots:
-            df = remove_bots_by_threshold(df, bot_score_threshold)
-
-        df['t_date'] = pd.to_datetime(df['t_date'])
-        df['t_date'] = df['t_date'].apply(lambda d: d.replace(tzinfo=None))
-        df["date_bucket_id"] = (df["t_date"] - earliest_date).apply(lambda t: math.floor(t.days/DELTA_TIME_IN_DAYS))
-        df = df.groupby(by=["date_bucket_id", "t_stance"], as_index=False).size()
-        if aggregated_df is None:
-            aggregated_df = df
-        else:
-            d3 = pd.concat([aggregated_df, df])
-            aggregated_df = d3.groupby(by=["date_bucket_id", "t_stance"], as_index=False).sum()
+        df = pd.concat([threshold_to_df[bot_score_threshold] for threshold_to_df in shards_threshold_to_df])
+        group_cols = [c for c in df.columns if c != "size"]
+        threshold_to_merged_df[bot_score_threshold] = df.groupby(by=group_cols, as_index=False, observed=True).sum()
+    return threshold_to_merged_df
 
+def get_date_buckets(datetimes, earliest_date, granularity=DELTA_TIME_IN_DAYS):
+    '''
+    Returns the start date of the bucket of every datetime (a datetime64 series). granularity is the number of days per
+    bucket (the first bucket starts at earliest_date) or GRANULARITY_MONTHLY for calendar months
+    '''
+    if granularity == GRANULARITY_MONTHLY:
+        return datetimes.dt.to_period("M").dt.to_timestamp()
+    days_since_earliest = (datetimes - earliest_date) // pd.Timedelta(days=1)
+    return earliest_date + pd.to_timedelta((days_since_earliest // granularity) * granularity, unit="D")
+
+def bucket_stance_counts(hourly_df, earliest_date, granularity=DELTA_TIME_IN_DAYS):
+    bucketed_df = pd.DataFrame({"Date": get_date_buckets(hourly_df["t_hour"], earliest_date, granularity),
+                                "t_stance": hourly_df["t_stance"], "size": hourly_df["size"]})
+    aggregated_df = bucketed_df.groupby(by=["Date", "t_stance"], as_index=False, observed=True)["size"].sum()
+    return aggregated_df[["t_stance", "size", "Date"]]
+
+def get_user_totals(user_hourly_df, user_totals_source=USER_TOTALS_FROM_CORPUS):
+    '''
+    Total tweets of the user of every row of user_hourly_df (aligned to its index)
+    '''
+    corpus_user_totals = user_hourly_df.groupby("user_id")["size"].transform("sum")
+    if user_totals_source == USER_TOTALS_FROM_CORPUS:
+        return corpus_user_totals
+    users_file_totals = pd.Series(get_bot_scores_store().get_tweets_nums(user_hourly_df["user_id"].values), index=user_hourly_df.index)
+    return users_file_totals.where(users_file_totals > 0, corpus_user_totals)
+
+def weigh_stance_counts(user_hourly_df, earliest_date, granularity=DELTA_TIME_IN_DAYS, policy=POLICY_ALL_TWEETS,
+                        user_totals_source=USER_TOTALS_FROM_CORPUS):
+    '''
+    Applies a counting policy (see COUNTING_POLICIES) to the counts of tweets per (user, hour, stance).
+    Returns the weighted counts per (hour, stance), ready for bucket_stance_counts()
+    '''
+    df = user_hourly_df
+    if policy == POLICY_ALL_TWEETS:
+        weights = df["size"]
+    elif policy == POLICY_ONE_PER_USER_DAY_STANCE:
+        # The (single) tweet counted for a user's day and stance is in the first hour it tweeted that day
+        df = df.sort_values("t_hour", kind="stable")
+        df = df[~df.assign(t_day=df["t_hour"].dt.floor("D")).duplicated(subset=["user_id", "t_day", "t_stance"])]
+        weights = pd.Series(1.0, index=df.index)
+    elif policy == POLICY_INVERSE_USER_TOTAL:
+        weights = df["size"] / get_user_totals(df, user_totals_source)
+    elif policy == POLICY_INVERSE_USER_TIMESPAN:
+        date_buckets = get_date_buckets(df["t_hour"], earliest_date, granularity)
+        weights = df["size"] / df["size"].groupby([df["user_id"], date_buckets]).transform("sum")
+    else:
+        raise ValueError(f'Unknown counting policy {policy} (should be one of {COUNTING_POLICIES})')
+    return pd.DataFrame({"t_hour": df["t_hour"], "t_stance": df["t_stance"], "size": weights})
+
+def get_boundary_hours(start_date=None, end_date=None):
+    '''
+    The hours that only some of their tweets may be in [start_date, end_date] - those of start_date (unless it's on the
+    hour) and of end_date (unless it's date-only, since end_date is inclusive)
+    '''
+    boundary_hours = set()
+    if start_date is not None and pd.Timestamp(start_date) != pd.Timestamp(start_date).floor("h"):
+        boundary_hours.add(pd.Timestamp(start_date).floor("h"))
+    if end_date is not None and not sm.is_date_only(end_date):
+        boundary_hours.add(pd.Timestamp(end_date).floor("h"))
+    return sorted(boundary_hours)
+
+@inst.timed_stage()
+def get_hourly_stance_counts_per_bot_thresholds(bot_score_thresholds=(None,), workers_num=None, start_date=None,
+                                                end_date=None, stances=None, per_user=False):
+    '''
+    Counts the tweets per (hour, stance) - or per (user, hour, stance) if per_user - of all the shards in a single pass,
+    for several bot score thresholds at once
+    (None means no bot filtering). Every row's bot score is looked up once and the row is counted in each threshold it
+    passes. Only tweets in [start_date, end_date] and of stances are counted (None means no restriction) - shards without
+    such tweets are skipped by their manifests (if none is left, the counts are empty). A date-only end_date (e.g.
+    '2016-06-23') includes the whole day (see sm.is_up_to_end_date()). The cached counts are per hour, so the hours that
+    start_date or end_date fall inside are counted again from the tweets' exact dates.
+    Returns a dict from threshold to its hourly counts df
+    '''
+    threshold_to_should_filter = {}
+    for bot_score_threshold in bot_score_thresholds:
+        threshold_to_should_filter[bot_score_threshold], _ = handle_bots(bot_score_threshold)
+
+    shard_fnames = sm.prune_shard_files(start_date=start_date, end_date=end_date, stances=stances)
+    if len(shard_fnames) == 0:
+        warnings.warn(f'No shards with tweets in the requested date range/stances ({start_date} - {end_date}, {stances})')
+        return {bot_score_threshold: get_empty_stance_counts(per_user) for bot_score_threshold in bot_score_thresholds}
+    threshold_to_hourly_df = map_reduce_shards(aggregate_shard_per_bot_thresholds,
+                                               lambda shards_threshold_to_df: merge_shards_aggregations(
+                                                   shards_threshold_to_df, threshold_to_should_filter, per_user),
+                                               (threshold_to_should_filter, per_user), shard_fnames, workers_num)
+    boundary_hours = get_boundary_hours(start_date, end_date)
+    if len(boundary_hours) > 0:
+        boundary_shard_fnames = sm.prune_shard_files(shard_fnames, start_date=boundary_hours[0],
+                                                     end_date=boundary_hours[-1] + pd.Timedelta(hours=1) - pd.Timedelta(1, "ns"))
+        threshold_to_boundary_df = map_reduce_shards(count_shard_stances_per_hour,
+                                                     lambda shards_threshold_to_df: merge_shards_aggregations(
+                                                         shards_threshold_to_df, threshold_to_should_filter, per_user),
+                                                     (threshold_to_should_filter, per_user, boundary_hours, start_date, end_date),
+                                                     boundary_shard_fnames, workers_num)
+    for bot_score_threshold, hourly_df in threshold_to_hourly_df.items():
+        if len(boundary_hours) > 0:
+            hourly_df = pd.concat([hourly_df[~hourly_df["t_hour"].isin(boundary_hours)],
+                                   threshold_to_boundary_df[bot_score_threshold]])
+            hourly_df = hourly_df.sort_values(get_stance_counts_group_cols(per_user), kind="stable", ignore_index=True)
+        if not start_date is None:
+            hourly_df = hourly_df[hourly_df["t_hour"] >= pd.Timestamp(start_date).floor("h")]
+        if not end_date is None:
+            hourly_df = hourly_df[sm.is_up_to_end_date(hourly_df["t_hour"], end_date)]
+        if not stances is None:
+            hourly_df = hourly_df[hourly_df["t_stance"].isin([str(stance) for stance in stances])]
+        threshold_to_hourly_df[bot_score_threshold] = hourly_df
+    return threshold_to_hourly_df
+
+def get_sentiment_aggregated_data_per_granularities(granularities=DEFAULT_GRANULARITIES, bot_score_thresholds=(None,),
+                                                    workers_num=None, start_date=None, end_date=None, stances=None):
+    '''
+    Same as get_sentiment_aggregated_data_per_bot_thresholds(), for several date bucket granularities at once (the shards
+    are read once). Date buckets are relative to the earliest date of all the shards, even if start_date is given.
+    Returns a dict from granularity to a dict from threshold to its aggregated df
+    '''
+    earliest_date, latest_date = get_min_and_max_dates_and_write_to_file(workers_num=workers_num)
+    threshold_to_hourly_df = get_hourly_stance_counts_per_bot_thresholds(bot_score_thresholds, workers_num, start_date,
+                                                                         end_date, stances)
+    granularity_to_aggregated_dfs = {granularity: {bot_score_threshold: bucket_stance_counts(hourly_df, earliest_date, granularity)
+                                                   for bot_score_threshold, hourly_df in threshold_to_hourly_df.items()}
+                                     for granularity in granularities}
+    return granularity_to_aggregated_dfs, earliest_date, latest_date
+
+def get_sentiment_aggregated_data_per_policies(policies=COUNTING_POLICIES, granularities=(DELTA_TIME_IN_DAYS,),
+                                                bot_score_thresholds=(None,), user_totals_source=USER_TOTALS_FROM_CORPUS,
+                                                workers_num=None, start_date=None, end_date=None, stances=None):
+    '''
+    Same as get_sentiment_aggregated_data_per_granularities(), for several counting policies at once. All of them are
+    computed from the counts of tweets per (user, hour, stance), taken in a single pass over the shards (with the bot
+    filtering). With start_date/end_date, the user totals are of the requested dates only (unless taken from the users file).
+    Returns a dict from policy to a dict from granularity to a dict from threshold to its aggregated df
+    '''
+    earliest_date, latest_date = get_min_and_max_dates_and_write_to_file(workers_num=workers_num)
+    threshold_to_user_hourly_df = get_hourly_stance_counts_per_bot_thresholds(bot_score_thresholds, workers_num, start_date,
+                                                                              end_date, stances, per_user=True)
+    policy_to_aggregated_dfs = {}
+    for policy in policies:
+        policy_to_aggregated_dfs[policy] = {}
+        for granularity in granularities:
+            policy_to_aggregated_dfs[policy][granularity] = {
+                bot_score_threshold: bucket_stance_counts(weigh_stance_counts(user_hourly_df, earliest_date, granularity, policy, user_totals_source), earliest_date, granularity)
+                for bot_score_threshold, user_hourly_df in threshold_to_user_hourly_df.items()}
+    return policy_to_aggregated_dfs, earliest_date, latest_date
+
+def get_sentiment_aggregated_data_per_bot_thresholds(bot_score_thresholds=(None,), workers_num=None, start_date=None,
+                                                     end_date=None, stances=None, granularity=DELTA_TIME_IN_DAYS):
+    '''
+    Returns a dict from bot score threshold to its aggregated df - count of tweets per stance per date bucket
+    '''
+    granularity_to_aggregated_dfs, earliest_date, latest_date = get_sentiment_aggregated_data_per_granularities(
+        [granularity], bot_score_thresholds, workers_num, start_date, end_date, stances)
+    return granularity_to_aggregated_dfs[granularity], earliest_date, latest_date
 
-    aggregated_df["Date"] = aggregated_df["date_bucket_id"].apply(lambda i: earliest_date + datetime.timedelta(days=DELTA_TIME_IN_DAYS * i))
-    aggregated_df.drop(columns=['date_bucket_id'], inplace=True)
-    return aggregated_df, earliest_date, latest_date
+def get_sentiment_aggregated_data(bot_score_threshold=None, workers_num=None, granularity=DELTA_TIME_IN_DAYS):
+    threshold_to_aggregated_df, earliest_date, latest_date = get_sentiment_aggregated_data_per_bot_thresholds([bot_score_threshold], workers_num, granularity=granularity)
+    return threshold_to_aggregated_df[bot_score_threshold], earliest_date, latest_date
 
 def plot_quantitative_counters(sentiment_df, earliest_date, latest_date, name_suffix=""):
     plot_stances_from_counters(sentiment_df, "size", earliest_date, latest_date, f'quantitative{name_suffix}', "Count of tweets")
@@ -198,6 +432,34 @@ def plot_percentage_counters(sentiment_df, earliest_date, latest_date, name_suff
     plot_stances_from_counters(sentiment_df, "percent_per_date", earliest_date, latest_date, f'percentage{name_suffix}',
                                "Percent of tweets")
 
+def read_quantitative_df(fname):
+    return pd.read_csv(fname, index_col=0, parse_dates=["Date"])
+
+def render_quantitative_plot(quantitative_df_fname, earliest_date, latest_date, name_suffix=""):
+    plot_quantitative_counters(read_quantitative_df(quantitative_df_fname), earliest_date, latest_date, name_suffix)
+
+def render_percentage_plot(quantitative_df_fname, earliest_date, latest_date, name_suffix=""):
+    percentage_df = get_percentage_df_from_quantitative(read_quantitative_df(quantitative_df_fname))
+    plot_percentage_counters(percentage_df, earliest_date, latest_date, name_suffix)
+
+def get_stances_plot_specs(quantitative_df_fname, earliest_date, latest_date, name_suffix=""):
+    return [pr.PlotSpec(f'quantitative{name_suffix}', render_quantitative_plot, [quantitative_df_fname],
+                        (quantitative_df_fname, earliest_date, latest_date, name_suffix)),
+            pr.PlotSpec(f'percentage{name_suffix}', render_percentage_plot, [quantitative_df_fname],
+                        (quantitative_df_fname, earliest_date, latest_date, name_suffix))]
+
+def get_all_stances_plot_specs(suffixes, earliest_date, latest_date):
+    plot_specs = []
+    for suffix in suffixes:
+        threshold_to_fname = get_quantitative_df_fnames(suffix)
+        ### Quantitative and percentage ###
+        plot_specs.extend(get_stances_plot_specs(threshold_to_fname[None], earliest_date, latest_date, suffix))
+
+        for bot_score_threshold in BOT_SCORE_THRESHOLDS:
+            plot_specs.extend(get_stances_plot_specs(threshold_to_fname[bot_score_threshold], earliest_date, latest_date,
+                                                     f'_botscore_{bot_score_threshold}{suffix}'))
+    return plot_specs
+
 def get_percentage_df_from_quantitative(quantitative_df):
     percentage_df = quantitative_df.copy(deep=False)
     percentage_df["count_per_date"] = quantitative_df.groupby(by=["Date"]).transform('sum')["size"]
@@ -206,55 +468,82 @@ def get_percentage_df_from_quantitative(quantitative_df):
     return percentage_df
 
 
-def final_report_plot_generator():
+def get_granularity_suffix(granularity):
+    if granularity == DELTA_TIME_IN_DAYS:
+        return ""  # The default granularity keeps the original file names
+    return f'_{granularity}' if granularity == GRANULARITY_MONTHLY else f'_{granularity}_days'
 
-    quantitative_df = None
-    earliest_date, latest_date = "3000-01-01", "1000-01-01"
-    bot_score_thresholds = [0.3, 0.5, 0.7, 0.98]  # Probability of an account being a bot (1 is the highest)
-    quantitative_df_bots = [None] * len(bot_score_thresholds)
+def get_policy_suffix(policy):
+    return "" if policy == POLICY_ALL_TWEETS else f'_{policy}'  # Counting all tweets keeps the original file names
 
-    quantitative_df_fname = add_folder_prefix("quantitative.csv")
-    quantitative_df_fname_bots = [add_folder_prefix(f"quantitative_bot_filter_{s}.csv") for s in bot_score_thresholds]
+def get_quantitative_df_fnames(suffix=""):
+    '''
+    Returns a dict from bot score threshold (None stands for the unfiltered data) to the file of its aggregated df
+    '''
+    quantitative_df_fname = add_folder_prefix(f"quantitative{suffix}.csv")
+    quantitative_df_fname_bots = [add_folder_prefix(f"quantitative_bot_filter_{s}{suffix}.csv") for s in BOT_SCORE_THRESHOLDS]
+    return dict(zip([None] + BOT_SCORE_THRESHOLDS, [quantitative_df_fname] + quantitative_df_fname_bots))
 
-    if np.all([os.path.isfile(f) for f in [quantitative_df_fname]]):
-        quantitative_df = pd.read_csv(quantitative_df_fname)
-        earliest_date, latest_date = get_min_and_max_dates_and_write_to_file()
+@inst.timed_stage()
+def write_quantitative_dfs(granularities=(DELTA_TIME_IN_DAYS,), policies=(POLICY_ALL_TWEETS,),
+                           user_totals_source=USER_TOTALS_FROM_CORPUS, workers_num=None):
+    '''
+    Writes the aggregated dfs (and the date limits) of every granularity and counting policy. Returns the suffixes of
+    their files, the earliest and the latest dates
+    '''
+    # None stands for the unfiltered data. All the tables (of all granularities and counting policies) are calculated
+    # together in a single pass over the shards - only the shards that changed since the last run are actually read (see
+    # shard_aggregates_cache)
+    if tuple(policies) == (POLICY_ALL_TWEETS,):
+        granularity_to_aggregated_dfs, earliest_date, latest_date = get_sentiment_aggregated_data_per_granularities(granularities, [None] + BOT_SCORE_THRESHOLDS, workers_num)
+        policy_to_aggregated_dfs = {POLICY_ALL_TWEETS: granularity_to_aggregated_dfs}  # No need for the per user counts
     else:
-        quantitative_df, earliest_date, latest_date = get_sentiment_aggregated_data()
-        quantitative_df.to_csv(quantitative_df_fname)
-
-    for i, bot_score_threshold in enumerate(bot_score_thresholds):
-        if os.path.isfile(quantitative_df_fname_bots[i]):
-            quantitative_df_bots[i] = pd.read_csv(quantitative_df_fname_bots[i])
-        else:
-            quantitative_df_bot, earliest_date, latest_date = get_sentiment_aggregated_data(bot_score_threshold)
-            quantitative_df_bot.to_csv(quantitative_df_fname_bots[i])
-            quantitative_df_bots[i] = quantitative_df_bot
-
-    ### Quantitative ###
-    plot_quantitative_counters(quantitative_df, earliest_date, latest_date)
-
-    ### Percentage ###
-    percentage_df = get_percentage_df_from_quantitative(quantitative_df)
-    plot_percentage_counters(percentage_df, earliest_date, latest_date)
+        policy_to_aggregated_dfs, earliest_date, latest_date = get_sentiment_aggregated_data_per_policies(policies, granularities, [None] + BOT_SCORE_THRESHOLDS, user_totals_source, workers_num)
+    suffixes = []
+    for policy, granularity_to_aggregated_dfs in policy_to_aggregated_dfs.items():
+        for granularity, threshold_to_aggregated_df in granularity_to_aggregated_dfs.items():
+            suffix = f'{get_policy_suffix(policy)}{get_granularity_suffix(granularity)}'
+            threshold_to_fname = get_quantitative_df_fnames(suffix)
+            for bot_score_threshold, aggregated_df in threshold_to_aggregated_df.items():
+                aggregated_df.to_csv(threshold_to_fname[bot_score_threshold])
+            suffixes.append(suffix)
+    return suffixes, earliest_date, latest_date
+
+@inst.timed_stage()
+def render_stances_plots(suffixes=("",), date_limits_fname=DATE_LIMITS_FNAME, workers_num=None):
+    '''
+    Renders the plots of the aggregated dfs that write_quantitative_dfs() wrote (with the same suffixes)
+    '''
+    earliest_date, latest_date = read_date_limits(date_limits_fname)
+    pr.render_plots(get_all_stances_plot_specs(suffixes, earliest_date, latest_date), workers_num)
 
-    for i, bot_score_threshold in enumerate(bot_score_thresholds):
-        q_df = quantitative_df_bots[i]
-        plot_quantitative_counters(q_df, earliest_date, latest_date, f'_botscore_{bot_score_threshold}')
-        p_df = get_percentage_df_from_quantitative(q_df)
-        plot_percentage_counters(p_df, earliest_date, latest_date, f'_botscore_{bot_score_threshold}')
+@inst.timed_stage()
+def final_report_plot_generator(granularities=(DELTA_TIME_IN_DAYS,), policies=(POLICY_ALL_TWEETS,),
+                                user_totals_source=USER_TOTALS_FROM_CORPUS, workers_num=None):
+    suffixes, earliest_date, latest_date = write_quantitative_dfs(granularities, policies, user_totals_source, workers_num)
+    # The plots are rendered (in parallel) from the csv files, only the ones whose data changed
+    pr.render_plots(get_all_stances_plot_specs(suffixes, earliest_date, latest_date), workers_num)
 
+def get_stance_aggregates_stage():
+    return pl.PipelineStage("stance_aggregates", write_quantitative_dfs, inputs=[FINAL_REPORT_DATA_FOLDER, BOT_SCORES_CSV_FNAME],
+                            outputs=[DATE_LIMITS_FNAME] + list(get_quantitative_df_fnames().values()), cache_outputs=True)
 
+def get_pipeline_stages():
     '''
-    TODO - Need to do analysis for each one of the following counting "policies":
-     - Allow every user no more than a single tweet a day (per stance)  
-     - Cut off completely users with a botscore higher than [0.3, 0.5, 0.7] (do separate calculation for each threshold)   
-     - Count every tweet as one divided by the number of overall tweets that the user tweeted overall in the dataset
-     - Count every tweet as one divided by the number of overall tweets that the user tweeted in each timespan separately
+    The stages of the final report (see pipeline.py): the data files, their aggregations and the plots
     '''
+    data_fnames = [os.path.join(DATA_FOLDER, f'tweets_stance_sentiment_{i}outof4.csv') for i in range(1, 5)]
+    plot_fnames = [pr.get_plot_fname(spec.name) for spec in get_all_stances_plot_specs([""], None, None)]
+    # The fetcher's output is large and keeps growing, so it's fingerprinted by its files' sizes and mtimes
+    return [pl.PipelineStage("final_report_data", final_report_data_generator, inputs=data_fnames,
+                             outputs=[FINAL_REPORT_DATA_FOLDER], stat_inputs=FETCHER_OUT_DIRS),
+            get_stance_aggregates_stage(),
+            pl.PipelineStage("stances_plots", render_stances_plots,
+                             inputs=[DATE_LIMITS_FNAME] + list(get_quantitative_df_fnames().values()),
+                             outputs=plot_fnames + [pr.RENDERED_PLOTS_HASHES_FNAME])]
 
 if __name__ == "__main__":
-    print(f'{get_cur_formatted_time()} Start')
-    final_report_data_generator()
-    final_report_plot_generator()
-    print(f'{get_cur_formatted_time()} FIN')
\ No newline at end of file
+    inst.log(f'Start')
+    with inst.run("final_report_generator"):
+        pl.run_pipeline(get_pipeline_stages())
+    inst.log(f'FIN')
\ No newline at end of file
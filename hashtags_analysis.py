@@ -7,14 +7,31 @@ from collections import Counter, OrderedDict
 from string import punctuation
 
 import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
 import common_utiles as cu
+import hashtags_cube as hc
+import hashtags_taxonomy as ht
+import hashtags_vocabulary as hv
+import instrumentation as inst
+import pipeline as pl
+import plot_rendering as pr
+import shard_aggregates_cache as sac
+import tags_cooccurrence as tc
+import tags_inverted_index as tii
 
 BOT_SCORES_DF = None
 TAG_FREQ_PERCANT_CUTOFF = [0.1, 0.25, 0.5, 1, 1.5]
 DEFAULT_FIGSIZE_VALS = (6.4, 4.8)  # See https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.figure.html
+LEGACY_HASHTAGS_COUNTER_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "hashtags_counter.json")
+RENDERED_HISTOGRAMS_HASHES_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "rendered_histograms_hashes.json")
+HASHTAG_TWEETS_DIR = os.path.join(cu.PLOTS_DATA_FOLDER, 'hashtag_tweets')
+LEAST_COMMON_HASHTAG_TWEETS_DIR = os.path.join(cu.PLOTS_DATA_FOLDER, 'least_common_hashtag_tweets')
+# None counts every hashtag exactly. Otherwise the vocabulary is a hv.HashtagsSketch of this capacity (exact only for the
+# pure-stance tags) - for corpora whose long tail of hashtags doesn't fit in memory
+HASHTAGS_SKETCH_CAPACITY = None
+HASHTAGS_CUBE_BOT_SCORE_THRESHOLDS = ()  # Each one adds a (bot filtered) copy of the hashtags cube
 
 '''
 Sources for tag stance assigning:
@@ -52,18 +69,27 @@ REMAIN_TAGS = set(['yes2eu', 'yestoeu', 'yes2europe', 'yestoeurope', 'betteroffi
                    'ukiptoryfascistsout', 'ofoc', 'saytostay'])
 
 ALL_TAGS = LEAVE_TAGS.union(REMAIN_TAGS)
+TOPIC_TAGS = set(['brexit', 'eu', 'europe', 'article50', 'tory', 'tories', 'labour'])  # No stance, they group the tags under them
+# The tags that aren't listed under these get their stance (e.g. 'ukip-manchester'), unless a listed tag is nearer (e.g.
+# 'ukipout'). Stance tags that counter-tags often start with (e.g. 'voteleave' of 'voteleavelies') aren't here
+INHERITED_LEAVE_TAGS = set(['ukip', 'leaveeu', 'standup4brexit'])
+INHERITED_REMAIN_TAGS = set(['stopbrexit', 'revokearticle50', 'bremain', 'fbpe'])
+TAGS_TAXONOMY = ht.TagsTaxonomy.build({ht.STANCE_LEAVE: LEAVE_TAGS, ht.STANCE_REMAIN: REMAIN_TAGS}, TOPIC_TAGS,
+                                      {ht.STANCE_LEAVE: INHERITED_LEAVE_TAGS, ht.STANCE_REMAIN: INHERITED_REMAIN_TAGS})
 
 TOKENS_TO_REMOVE = f'{punctuation.replace("?", "")}…'
+TOKENS_TO_REMOVE_TABLE = str.maketrans("", "", TOKENS_TO_REMOVE)
+HASHTAG_REGEX = re.compile(r"#(?<!\S#)(\S*)")  # A whitespace separated token that starts with '#' (without the '#')
 
 def process_tokens(s):
     unescaped = ""
-    while unescaped != s:  # E.g. when s = '&amp#8216brexit&amp#8217' (in this case the "real" string is html.unescape(html.unescape(s))).
+    while "&" in s and unescaped != s:  # E.g. when s = '&amp#8216brexit&amp#8217' (in this case the "real" string is html.unescape(html.unescape(s))).
         # Code inspired by: https://stackoverflow.com/a/58739826
         unescaped = html.unescape(s)
         s = html.unescape(unescaped)
 
     tmp = s
-    if s.isascii() and s.isprintable():
+    if "\\" in s and s.isascii() and s.isprintable():
         # The reason for this if is a string like "지민" that doesn't throw exception on s.encode().decode('unicode_escape') - but comes out invalid from it.
         # See: https://stackoverflow.com/a/51141941
         '''
@@ -84,18 +110,11 @@ def process_tokens(s):
 
     s = s.strip(f'{punctuation.replace("?", "")}’')
 
-    tmp = s
-    for t in TOKENS_TO_REMOVE:
-        tmp = tmp.replace(t, "")
+    tmp = s.translate(TOKENS_TO_REMOVE_TABLE)
     return tmp if (tmp == "" or tmp in ALL_TAGS) else s
 
 
-def extract_hash_tags(s):
-
-    s = s.replace("@", "@ ") #To make sure no user-taggings will be in any hashtag
-
-    # Based on: https://stackoverflow.com/a/2527903
-    tags = set(part[1:] for part in s.split() if part.startswith('#'))
+def split_compound_tags(tags):
     tags_to_remove = set()
     tags_to_add = set()
     for cur_t in tags:
@@ -125,13 +144,54 @@ def extract_hash_tags(s):
     splitting to separate tags, some just deleting the sequence from the tag (and not splitting). It's pretty rare so
     no big deal
     '''
+    return tags
 
 
+def extract_hash_tags(s):
+
+    s = s.replace("@", "@ ") #To make sure no user-taggings will be in any hashtag
+
+    # Based on: https://stackoverflow.com/a/2527903
+    tags = set(part[1:] for part in s.split() if part.startswith('#'))
+    tags = split_compound_tags(tags)
+
     tags = [process_tokens(t.lower()) for t in tags]
     tags = list(filter(None, tags))  # Remove empty strings
     return tags
 
 
+def extract_hash_tags_batch(texts):
+    '''
+    Batch version of extract_hash_tags() for a whole column of texts - returns a series (with the index of texts) of the
+    same tag lists (the order of the tags within a list may differ). Texts that aren't strings get an empty list.
+    The texts are tokenized at once with a compiled regex and every distinct tag is processed only once
+    '''
+    texts = pd.Series(texts)
+    index = texts.index
+    texts = texts.reset_index(drop=True)
+
+    tags = texts.str.replace("@", "@ ", regex=False).str.findall(HASHTAG_REGEX)
+    tags = tags.explode().dropna()
+    tags = tags[~tags.reset_index().duplicated().values]  # Keep each tag once per text
+
+    compound_tags_mask = tags.str.contains("#", regex=False)
+    if compound_tags_mask.any():
+        compound_rows = tags.index[compound_tags_mask].unique()
+        compound_tags = pd.Series([list(split_compound_tags(set(tags.loc[[i]]))) for i in compound_rows],
+                                  index=compound_rows).explode().dropna()
+        tags = pd.concat([tags[~tags.index.isin(compound_rows)], compound_tags])
+
+    unique_tags = tags.unique()
+    processed_tags = dict(zip(unique_tags, [process_tokens(t.lower()) for t in unique_tags]))
+    tags = tags.map(processed_tags)
+    tags = tags[tags != ""]
+
+    # Regroup the tags per text (a stable sort by text position followed by a split, much faster than a groupby)
+    sorted_tags = tags.values[np.argsort(tags.index.values, kind="stable")].tolist()
+    ends = np.cumsum(np.bincount(tags.index.values, minlength=len(texts))).tolist()
+    return pd.Series([sorted_tags[start:end] for start, end in zip([0] + ends[:-1], ends)], index=index, dtype=object)
+
+
 def sum_counters(counter_list):
     '''
     Recursive counter with a O(log(n)) Complexity (Source https://stackoverflow.com/a/62393323)
@@ -149,26 +209,81 @@ def sum_counters(counter_list):
         return sum(counter_list, Counter())
 
 
-def calculate_hashtags_counter(bot_score_threshold=None):
-    hashtags_counter = Counter()
+def iter_shard_tag_lists(full_fname, bot_score_threshold=None):
+    '''
+    Yields the tag lists of the shard's tweets, a chunk at a time (see cu.iter_shard_chunks())
+    '''
     should_filter_bots, bot_msg_suffix = cu.handle_bots(bot_score_threshold)
-
-    for fname in os.listdir(cu.FINAL_REPORT_DATA_FOLDER):
-        if not (fname.startswith(f'tweets_stance_sentiment_incl_date_and_text') and fname.endswith(".csv")):
-            continue
-        full_fname = os.path.join(cu.FINAL_REPORT_DATA_FOLDER, fname)
-        print(f'{cu.get_cur_formatted_time()} Parsing {full_fname}{bot_msg_suffix}')
-        df = pd.read_csv(full_fname)
+    inst.log(f'Parsing {full_fname}{bot_msg_suffix}')
+    cols = ["t_text", "user_id"] if should_filter_bots else ["t_text"]
+    for df in cu.iter_shard_chunks(full_fname, columns=cols):
         if should_filter_bots:
             df = cu.remove_bots_by_threshold(df, bot_score_threshold)
+        yield extract_hash_tags_batch(df["t_text"])
+
+
+def count_hashtags_in_shard(full_fname, bot_score_threshold=None):
+    should_filter_bots, _ = cu.handle_bots(bot_score_threshold)
+    cache_threshold = bot_score_threshold if should_filter_bots else None
 
-        df["hashtags"] = df["t_text"].apply(extract_hash_tags)
-        df = df.drop(df.columns.difference(["hashtags"]), axis="columns")  # Drop all but "hashtags" column
-        counters_list = [Counter(x) for x in df["hashtags"].values]
-        counters_list.append(hashtags_counter)
-        hashtags_counter = sum_counters(counters_list)
+    def compute_shard_vocabulary():
+        vocabulary = hv.HashtagsVocabulary()
+        for tag_lists in iter_shard_tag_lists(full_fname, bot_score_threshold):
+            vocabulary.count_tag_lists(tag_lists)
+        return vocabulary.to_arrays()
 
-    return Counter(OrderedDict(hashtags_counter.most_common()))  # Sorting the counter
+    return hv.HashtagsVocabulary.from_arrays(sac.get_or_compute_partial(
+        full_fname, f'hashtags_{sac.get_threshold_name(cache_threshold)}',
+        sac.get_shard_fingerprint(full_fname, cache_threshold), compute_shard_vocabulary))
+
+
+def is_pure_stance_tag(tag):
+    return TAGS_TAXONOMY.is_stance_tag(tag)
+
+
+def count_hashtags_sketch_in_shard(full_fname, bot_score_threshold=None, capacity=hv.SKETCH_CAPACITY):
+    '''
+    Like count_hashtags_in_shard(), in the memory of a sketch of capacity tags (and of a chunk) - only the pure-stance
+    tags are counted exactly
+    '''
+    should_filter_bots, _ = cu.handle_bots(bot_score_threshold)
+    cache_threshold = bot_score_threshold if should_filter_bots else None
+
+    def compute_shard_sketch():
+        sketch = hv.HashtagsSketch(capacity)
+        for tag_lists in iter_shard_tag_lists(full_fname, bot_score_threshold):
+            sketch.count_tag_lists(tag_lists, is_pure_stance_tag)
+        return sketch.to_arrays()
+
+    return hv.HashtagsSketch.from_arrays(sac.get_or_compute_partial(
+        full_fname, f'hashtags_sketch_{capacity}_{sac.get_threshold_name(cache_threshold)}',
+        sac.get_shard_fingerprint(full_fname, cache_threshold), compute_shard_sketch))
+
+
+@inst.timed_stage()
+def calculate_hashtags_vocabulary(bot_score_threshold=None, workers_num=None):
+    return cu.map_reduce_shards(count_hashtags_in_shard, hv.merge_vocabularies, (bot_score_threshold,),
+                                workers_num=workers_num)
+
+
+@inst.timed_stage()
+def calculate_hashtags_sketch(bot_score_threshold=None, workers_num=None, capacity=hv.SKETCH_CAPACITY):
+    return cu.map_reduce_shards(count_hashtags_sketch_in_shard, hv.merge_sketches, (bot_score_threshold, capacity),
+                                workers_num=workers_num)
+
+
+def calculate_hashtags_counter(bot_score_threshold=None, workers_num=None, sketch_capacity=None):
+    '''
+    Sorted, most common first. With sketch_capacity, only the pure-stance tags are counted exactly and the rest are the
+    (over)estimated counts of the sketch's top tags (see hv.HashtagsSketch)
+    '''
+    if sketch_capacity is not None:
+        return calculate_hashtags_sketch(bot_score_threshold, workers_num, sketch_capacity).to_counter()
+    return calculate_hashtags_vocabulary(bot_score_threshold, workers_num).to_counter()
+
+
+def get_most_common_plot_name(n=10, title_suffix=""):
+    return f'{n}_most_common_tags{title_suffix.lower().replace(" ", "_").replace("-", "_").replace(",", "")}'
 
 
 def plot_most_common(counter, n=10, keys_to_ignore=[], title_suffix=""):
@@ -176,54 +291,148 @@ def plot_most_common(counter, n=10, keys_to_ignore=[], title_suffix=""):
     x_vals, y_vals = [], []
     colors = []
     if n <= 10:
-        plt.figure(figsize=tuple([z * 1.5 for z in DEFAULT_FIGSIZE_VALS]))
+        fig = pr.new_figure(figsize=tuple([z * 1.5 for z in DEFAULT_FIGSIZE_VALS]))
     else:
-        plt.figure(figsize=tuple([z * 2 for z in DEFAULT_FIGSIZE_VALS]))
+        fig = pr.new_figure(figsize=tuple([z * 2 for z in DEFAULT_FIGSIZE_VALS]))
+    ax = fig.add_subplot()
     for i, tag in enumerate(most_common_hashtags):
         if not tag[0] in keys_to_ignore:
             x_vals.append(tag[0])
             y_vals.append(tag[1])
-            plt.text(x=i, y=tag[1] + 1, s=f"{tag[1]}", fontdict=dict(fontsize=10),
-                     ha='center')  # Source: https://stackoverflow.com/a/55866275
+            ax.text(x=i, y=tag[1] + 1, s=f"{tag[1]}", fontdict=dict(fontsize=10),
+                    ha='center')  # Source: https://stackoverflow.com/a/55866275
 
-            if tag[0] in REMAIN_TAGS:
+            stance = TAGS_TAXONOMY.get_stance(tag[0])
+            if stance == ht.STANCE_REMAIN:
                 colors.append(cu.REMAIN_COLOR)
-            elif tag[0] in LEAVE_TAGS:
+            elif stance == ht.STANCE_LEAVE:
                 colors.append(cu.LEAVE_COLOR)
             else:
                 colors.append(cu.OTHER_STANCE_COLOR)
-    plt.bar(x_vals, y_vals, color=colors)
-    plt.title(f'{n} most common tags{title_suffix}')
+    ax.bar(x_vals, y_vals, color=colors)
+    ax.set_title(f'{n} most common tags{title_suffix}')
 
     # Custom legend (see https://stackoverflow.com/a/39500357)
     legend_item_remain = mpatches.Patch(color=cu.REMAIN_COLOR, label='Remain')
     legend_item_leave = mpatches.Patch(color=cu.LEAVE_COLOR, label='Leave')
     legend_item_other = mpatches.Patch(color=cu.OTHER_STANCE_COLOR, label='Other')
-    plt.legend(handles=[legend_item_remain, legend_item_leave, legend_item_other])
+    ax.legend(handles=[legend_item_remain, legend_item_leave, legend_item_other])
 
-    plt.xticks(rotation=45, ha="right")  # Tilt the x ticks lables
-    plt.subplots_adjust(bottom=0.25)
-    cu.save_fig(f'{n}_most_common_tags{title_suffix.lower().replace(" ", "_").replace("-", "_").replace(",", "")}')
+    for label in ax.xaxis.get_ticklabels():
+        label.set_rotation(45)  # Tilt the x ticks lables
+        label.set_horizontalalignment("right")
+    fig.subplots_adjust(bottom=0.25)
+    pr.save_figure(fig, get_most_common_plot_name(n, title_suffix))
 
 
-def get_and_write_hashtags_counter():
-    counter_fname = os.path.join(cu.PLOTS_DATA_FOLDER, "hashtags_counter.json")
-    if os.path.isfile(counter_fname):
-        print(f'{cu.get_cur_formatted_time()} Reading data from {counter_fname}')
-        with open(counter_fname, "r", encoding="utf-8") as f:
-            cur_dict = json.load(f)
-            hashtags_counter = Counter(cur_dict)
+def get_top_pure_stance_tags_counter(hashtags_counter, top_n_per_stance=20):
+    '''
+    The top_n_per_stance most common leave tags and remain tags
+    '''
+    filtered_counter_remain = get_only_specific_keys_from_counter(hashtags_counter, keys = TAGS_TAXONOMY.get_stance_tags(hashtags_counter, ht.STANCE_LEAVE))
+    filtered_counter_remain = filtered_counter_remain.most_common(top_n_per_stance)
+    filtered_counter_remain = Counter({i[0]: i[1] for i in filtered_counter_remain})
+    filtered_counter_leave = get_only_specific_keys_from_counter(hashtags_counter, keys = TAGS_TAXONOMY.get_stance_tags(hashtags_counter, ht.STANCE_REMAIN))
+    filtered_counter_leave = filtered_counter_leave.most_common(top_n_per_stance)
+    filtered_counter_leave = Counter({i[0]: i[1] for i in filtered_counter_leave})
+    return sum_counters([filtered_counter_remain, filtered_counter_leave])
+
+
+def render_most_common_plot(vocabulary_fname, n=10, keys_to_ignore=(), title_suffix="", only_pure_stance_tags=False,
+                            top_n_per_stance=None):
+    '''
+    Plots the most common tags of the vocabulary in vocabulary_fname - only the pure-stance ones with
+    only_pure_stance_tags, or just the top_n_per_stance of each stance
+    '''
+    hashtags_counter = hv.load_vocabulary_or_sketch(vocabulary_fname).to_counter()
+    if top_n_per_stance is not None:
+        hashtags_counter = get_top_pure_stance_tags_counter(hashtags_counter, top_n_per_stance)
+    elif only_pure_stance_tags:
+        hashtags_counter = get_only_specific_keys_from_counter(hashtags_counter)
+    plot_most_common(hashtags_counter, n, list(keys_to_ignore), title_suffix)
+
+
+def get_tags_inverted_index():
+    return tii.get_tags_inverted_index(extract_hash_tags_batch)
+
+
+def get_tags_cooccurrence():
+    return tc.get_tags_cooccurrence(get_tags_inverted_index())
+
+
+def write_hashtags_cube(vocabulary_fname=None, bot_score_thresholds=(), workers_num=None):
+    '''
+    Builds the hashtags cube (see hashtags_cube.py) of the most common tags of the vocabulary in vocabulary_fname (see
+    get_hashtags_counter())
+    '''
+    hc.build_hashtags_cube(get_hashtags_counter(vocabulary_fname), extract_hash_tags_batch, bot_score_thresholds,
+                           workers_num=workers_num)
+
+
+def render_tags_trend_plot(tags, start_date=None, end_date=None, granularity=7, bot_score_threshold=None,
+                           cube_fname=hc.HASHTAGS_CUBE_FNAME, axes_fname=hc.HASHTAGS_CUBE_AXES_FNAME):
+    '''
+    Plots the number of tweets per stance that contain the tags, per bucket of granularity days - from the hashtags cube,
+    without reading the shards
+    '''
+    trend_df = hc.HashtagsCube.load(cube_fname, axes_fname).get_trend(tags, start_date, end_date, bot_score_threshold, granularity)
+    fig = pr.new_figure(figsize=tuple([z * 2 for z in DEFAULT_FIGSIZE_VALS]))
+    ax = fig.add_subplot()
+    for stance, color in [("other", cu.OTHER_STANCE_COLOR), ("remain", cu.REMAIN_COLOR), ("leave", cu.LEAVE_COLOR)]:
+        if stance in trend_df.columns:
+            ax.plot(trend_df.index, trend_df[stance], label=stance, color=color)
+    ax.set_title(f'Tweets with {", ".join(sorted(tags))} (per {granularity} days)')
+    ax.legend()
+    fig.autofmt_xdate()
+    pr.save_figure(fig, f'trend_{"_".join(sorted(tags))}_{granularity}_days'.replace("?", ""))
+    return trend_df
+
+
+def get_and_write_hashtags_vocabulary(vocabulary_fname=hv.HASHTAGS_VOCABULARY_FNAME, sketch_capacity=None):
+    '''
+    Counts the hashtags of all the shards - only the shards that changed since the last run are parsed (see
+    shard_aggregates_cache). With sketch_capacity, the vocabulary is a hv.HashtagsSketch of that capacity. Without
+    shards, falls back to the last written vocabulary (or legacy json counter)
+    '''
+    legacy_counter_fname = LEGACY_HASHTAGS_COUNTER_FNAME
+    if len(cu.list_shard_files()) > 0:
+        inst.log(f'Calculating hashtags frequency')
+        vocabulary = calculate_hashtags_vocabulary() if sketch_capacity is None else calculate_hashtags_sketch(capacity=sketch_capacity)
+    elif os.path.isfile(vocabulary_fname):
+        return hv.load_vocabulary_or_sketch(vocabulary_fname)
+    elif os.path.isfile(legacy_counter_fname):
+        inst.log(f'Reading data from {legacy_counter_fname} (converting it to {vocabulary_fname})')
+        with open(legacy_counter_fname, "r", encoding="utf-8") as f:
+            vocabulary = hv.HashtagsVocabulary.from_counter(json.load(f))
     else:
-        print(f'{cu.get_cur_formatted_time()} No existing data file found, calculating hashtags frequency')
-        hashtags_counter = calculate_hashtags_counter()
-        cu.write_to_json_file_if_not_empty(hashtags_counter, counter_fname, escape_html_chars=False)
-    return hashtags_counter
+        raise FileNotFoundError(f'No shards in {cu.FINAL_REPORT_DATA_FOLDER} and no existing hashtags counter')
+    vocabulary.save(vocabulary_fname)
+    return vocabulary
+
 
+def get_and_write_hashtags_counter():
+    return get_and_write_hashtags_vocabulary(sketch_capacity=HASHTAGS_SKETCH_CAPACITY).to_counter()
 
-def get_only_specific_keys_from_counter(counter, keys=ALL_TAGS, reverse=False, threshold_count=0):
+
+def get_hashtags_counter(vocabulary_fname=None):
+    '''
+    The counter of the vocabulary in vocabulary_fname (e.g. the output of the pipeline's hashtags_vocabulary stage), or if
+    it's None, of all the shards (see get_and_write_hashtags_vocabulary())
+    '''
+    if vocabulary_fname is None:
+        return get_and_write_hashtags_counter()
+    return hv.load_vocabulary_or_sketch(vocabulary_fname).to_counter()
+
+
+def get_only_specific_keys_from_counter(counter, keys=None, reverse=False, threshold_count=0):
+    '''
+    keys default to the tags of the counter that have a stance (see TAGS_TAXONOMY)
+    '''
+    if keys is None:
+        keys = TAGS_TAXONOMY.get_stance_tags(counter)
     res = Counter({k: counter[k] for k in keys})
     if threshold_count is not None:
-        res = Counter(el for el in res.elements() if res[el] > threshold_count)
+        res = Counter({k: count for k, count in res.items() if count > threshold_count})
 
     if reverse:
         res = OrderedDict(res.most_common())
@@ -231,22 +440,32 @@ def get_only_specific_keys_from_counter(counter, keys=ALL_TAGS, reverse=False, t
 
     return res
 
-def create_hashtags_histograms():
-    hashtags_counter = get_and_write_hashtags_counter()
-    plot_most_common(hashtags_counter)
+def get_histograms_plot_args(top_pure_stance_tags_num, top_n_per_stance=20):
+    '''
+    Arguments of render_most_common_plot() (after the vocabulary fname) for every histogram
+    '''
     tags_to_ignore = ["brexit", "uk", "eu", "news"]
-    plot_most_common(hashtags_counter, keys_to_ignore=tags_to_ignore, title_suffix=f" without {', '.join(tags_to_ignore)}")
+    return [(10, (), ""),
+            (10, tuple(tags_to_ignore), f" without {', '.join(tags_to_ignore)}"),
+            (10, (), " pure-stance hashtags", True),
+            (top_pure_stance_tags_num, (), f" top {top_n_per_stance} from each pure-stance hashtags", True, top_n_per_stance)]
 
-    filtered_counter = get_only_specific_keys_from_counter(hashtags_counter)
-    plot_most_common(filtered_counter, title_suffix=" pure-stance hashtags")
-    filtered_counter_remain = get_only_specific_keys_from_counter(hashtags_counter, keys = LEAVE_TAGS)
-    filtered_counter_remain = filtered_counter_remain.most_common(20)
-    filtered_counter_remain = Counter({i[0]: i[1] for i in filtered_counter_remain})
-    filtered_counter_leave = get_only_specific_keys_from_counter(hashtags_counter, keys = REMAIN_TAGS)
-    filtered_counter_leave = filtered_counter_leave.most_common(20)
-    filtered_counter_leave = Counter({i[0]: i[1] for i in filtered_counter_leave})
-    filtered_counter = sum_counters([filtered_counter_remain, filtered_counter_leave])
-    plot_most_common(filtered_counter, n=len(filtered_counter), title_suffix=" top 20 from each pure-stance hashtags")
+
+@inst.timed_stage()
+def create_hashtags_histograms(vocabulary_fname=None, workers_num=None):
+    '''
+    The histograms are rendered (in parallel) from the vocabulary file - only if it changed since they were rendered.
+    Without vocabulary_fname, the vocabulary is calculated first (see get_hashtags_counter())
+    '''
+    hashtags_counter = get_hashtags_counter(vocabulary_fname)
+    if vocabulary_fname is None:
+        vocabulary_fname = hv.HASHTAGS_VOCABULARY_FNAME
+    top_n_per_stance = 20
+    top_pure_stance_tags_num = len(get_top_pure_stance_tags_counter(hashtags_counter, top_n_per_stance))
+    plot_args = get_histograms_plot_args(top_pure_stance_tags_num, top_n_per_stance)
+    pr.render_plots([pr.PlotSpec(get_most_common_plot_name(args[0], args[2]), render_most_common_plot,
+                                 [vocabulary_fname], (vocabulary_fname,) + args) for args in plot_args], workers_num,
+                    hashes_fname=RENDERED_HISTOGRAMS_HASHES_FNAME)
 
     '''
     TODO:
@@ -260,30 +479,33 @@ def is_quota_met_for_tag(df, num_tweets_required):
     return (not df is None) and len(df.index) >= num_tweets_required
 
 
-def get_exist_tags_to_tweets_or_default(hashtags_counter, dir = os.path.join(cu.PLOTS_DATA_FOLDER, 'hashtag_tweets')):
+def get_exist_tags_to_tweets_or_default(hashtags_counter, dir = HASHTAG_TWEETS_DIR):
     tag_to_tweets = {tag: None for tag in hashtags_counter}
     existing_counters_count = 0
-    print(f'{cu.get_cur_formatted_time()} Checking for existing tags_to_tweets in {dir}')
+    inst.log(f'Checking for existing tags_to_tweets in {dir}')
     for tag in hashtags_counter:
         fname = os.path.join(dir, f"hashtag_{tag}_tweets.csv")
         if os.path.isfile(fname):
             tag_to_tweets[tag] = pd.read_csv(fname)
             existing_counters_count += 1
 
-    print(f'{cu.get_cur_formatted_time()} Found existing data for {existing_counters_count}/{len(hashtags_counter)} tags (in {dir})')
+    inst.log(f'Found existing data for {existing_counters_count}/{len(hashtags_counter)} tags (in {dir})')
     return tag_to_tweets
 
 
-def write_tags_to_tweets_least_common_arbitrator(dir_to_check_existing, bot_score_threshold=None):
+@inst.timed_stage()
+def write_tags_to_tweets_least_common_arbitrator(dir_to_check_existing=LEAST_COMMON_HASHTAG_TWEETS_DIR, bot_score_threshold=None,
+                                                 vocabulary_fname=None):
     should_filter_bots, bot_msg_suffix = cu.handle_bots(bot_score_threshold)
-    hashtags_counter = get_and_write_hashtags_counter()
+    hashtags_counter = get_hashtags_counter(vocabulary_fname)
     hashtags_counter = get_only_specific_keys_from_counter(hashtags_counter, reverse=True, threshold_count=200)
+    tag_to_id, tag_ranks = get_tag_ranks(hashtags_counter)
+    tags_index = get_tags_inverted_index()
+    os.makedirs(dir_to_check_existing, exist_ok=True)
 
-    for fname in os.listdir(cu.FINAL_REPORT_DATA_FOLDER):
-        if not (fname.startswith(f'tweets_stance_sentiment_incl_date_and_text') and fname.endswith(".csv")):
-            continue
-        full_fname = os.path.join(cu.FINAL_REPORT_DATA_FOLDER, fname)
-        print(f'{cu.get_cur_formatted_time()} Checking {full_fname}{bot_msg_suffix}')
+    for full_fname in cu.list_shard_files():
+        fname = os.path.basename(full_fname)
+        inst.log(f'Checking {full_fname}{bot_msg_suffix}')
         df = None
 
         main_file_id = re.search(r"\d", fname).start()
@@ -291,44 +513,51 @@ def write_tags_to_tweets_least_common_arbitrator(dir_to_check_existing, bot_scor
         main_file_id, sub_file_id = fname[main_file_id], fname[sub_file_id]
 
         for cur_tag in hashtags_counter:
-            print(f'{cu.get_cur_formatted_time()} Tag {cur_tag}')
+            inst.log(f'Tag {cur_tag}')
             full_tag_fname = os.path.join(dir_to_check_existing, f"hashtag_{cur_tag}_tweets_{main_file_id}_{sub_file_id}.csv")
             if os.path.isfile(full_tag_fname):
                 df_for_tag = pd.read_csv(full_tag_fname, nrows=1)
                 if len(df_for_tag.index) > 0:
-                    print(f'{cu.get_cur_formatted_time()} found {full_tag_fname} - skipping this tag')
+                    inst.log(f'found {full_tag_fname} - skipping this tag')
                     continue
 
+            tag_rows = tags_index.get_rows(cur_tag, full_fname)
+            if len(tag_rows) == 0:
+                inst.log(f'Found 0 tweets containing tag')
+                continue
+
             if df is None:
                 #This block is here and not outside the tags loop to avoid expensive read_csv if one isn't needed
-                df = pd.read_csv(full_fname)
+                #Only the tweets that contain (at least) one of the tags are kept
+                df = cu.read_shard_rows(full_fname, tags_index.get_rows_of_any_tag(hashtags_counter, full_fname))
                 if should_filter_bots:
                     df = cu.remove_bots_by_threshold(df, bot_score_threshold)
-                df["hashtags"] = df["t_text"].apply(extract_hash_tags)
+                df["t_date"] = cu.to_tweet_date_strings(df["t_date"])  # Written as they are in the fetched tweets
+                # The arbitrator's choice doesn't depend on the current tag, so it's made once for all the tweets
+                df["least_common_tag"] = choose_least_common_tags(extract_hash_tags_batch(df["t_text"]), tag_to_id, tag_ranks)
 
-            df["is_tag_present"] = df['hashtags'].apply(lambda l: cur_tag in l)
-            df_for_tag = df[df["is_tag_present"]]
-            print(f'{cu.get_cur_formatted_time()} Found {len(df_for_tag.index)} tweets containing tag')
+            df_for_tag = df[df.index.isin(tag_rows)]
+            inst.log(f'Found {len(df_for_tag.index)} tweets containing tag')
 
             if len(df_for_tag.index) == 0:
                 continue
 
-            df_for_tag["hashtags"] = df_for_tag["hashtags"].apply(lambda l: choose_least_common_tag(hashtags_counter, l))
-            df_for_tag["is_tag_present"] = df_for_tag['hashtags'].apply(lambda l: cur_tag in l)
-            df_for_tag = df_for_tag[df_for_tag["is_tag_present"]]
-            print(f'{cu.get_cur_formatted_time()} Found {len(df_for_tag.index)} tweets that passed arbitrator')
+            df_for_tag = df_for_tag[df_for_tag["least_common_tag"] == cur_tag].copy()
+            inst.log(f'Found {len(df_for_tag.index)} tweets that passed arbitrator')
 
             if len(df_for_tag.index) == 0:
                 continue
 
-            df_for_tag = df_for_tag.drop(["is_tag_present"], axis="columns")
+            df_for_tag["hashtags"] = [[cur_tag]] * len(df_for_tag.index)
+            df_for_tag = df_for_tag.drop(["least_common_tag"], axis="columns")
 
             cu.df_to_csv_plus_create_dir(df_for_tag, "", full_tag_fname)
 
 
-def create_tweets_with_pure_stance_tags(bot_score_threshold=None, max_tweets_per_tag=200):
+@inst.timed_stage()
+def create_tweets_with_pure_stance_tags(bot_score_threshold=None, max_tweets_per_tag=200, vocabulary_fname=None):
     should_filter_bots, bot_msg_suffix = cu.handle_bots(bot_score_threshold)
-    hashtags_counter = get_and_write_hashtags_counter()
+    hashtags_counter = get_hashtags_counter(vocabulary_fname)
     hashtags_counter = get_only_specific_keys_from_counter(hashtags_counter, reverse=True)
     no_pure_stance_tags_key = "no_stance_tags"
     no_tags_at_all_key = "no_tags_at_all"
@@ -337,46 +566,55 @@ def create_tweets_with_pure_stance_tags(bot_score_threshold=None, max_tweets_per
     tag_to_num_tweets_required = {tag: min(hashtags_counter[tag], max_tweets_per_tag) for tag in hashtags_counter}
     tag_to_tweets = get_exist_tags_to_tweets_or_default(hashtags_counter)
 
-    for fname in os.listdir(cu.FINAL_REPORT_DATA_FOLDER):
+    tags_index = get_tags_inverted_index()
+    stance_tags = TAGS_TAXONOMY.get_stance_tags(tags_index.tags)
+
+    for full_fname in cu.list_shard_files():
         if all([is_quota_met_for_tag(tag_to_tweets[tag], tag_to_num_tweets_required[tag]) for tag in tag_to_num_tweets_required]):
-            print(f'{cu.get_cur_formatted_time()} Quotas for all tags met - not checking anymore files')
+            inst.log(f'Quotas for all tags met - not checking anymore files')
             break
-        if not (fname.startswith(f'tweets_stance_sentiment_incl_date_and_text') and fname.endswith(".csv")):
-            continue
-        full_fname = os.path.join(cu.FINAL_REPORT_DATA_FOLDER, fname)
-        print(f'{cu.get_cur_formatted_time()} Parsing {full_fname}{bot_msg_suffix}')
-        df = pd.read_csv(full_fname)
+        inst.log(f'Parsing {full_fname}{bot_msg_suffix}')
+
+        # The candidate tweets of every tag are taken from the index, so only these are processed
+        tag_to_rows = {}
+        for cur_tag in hashtags_counter:
+            if is_quota_met_for_tag(tag_to_tweets[cur_tag], tag_to_num_tweets_required[cur_tag]):
+                continue
+            if cur_tag == no_pure_stance_tags_key:
+                tag_to_rows[cur_tag] = np.setdiff1d(tags_index.get_rows_with_tags(full_fname),
+                                                    tags_index.get_rows_of_any_tag(stance_tags, full_fname))
+            elif cur_tag == no_tags_at_all_key:
+                tag_to_rows[cur_tag] = np.setdiff1d(np.arange(tags_index.get_shard_rows_num(full_fname)), tags_index.get_rows_with_tags(full_fname))
+                if not should_filter_bots:
+                    # These have no tags to sort by, so the first ones are as good as any
+                    tag_to_rows[cur_tag] = tag_to_rows[cur_tag][:tag_to_num_tweets_required[cur_tag]]
+            else:
+                tag_to_rows[cur_tag] = tags_index.get_rows(cur_tag, full_fname)
+        df = cu.read_shard_rows(full_fname, np.unique(np.concatenate(list(tag_to_rows.values()))) if len(tag_to_rows) > 0 else [])
         if should_filter_bots:
             df = cu.remove_bots_by_threshold(df, bot_score_threshold)
+        df["t_date"] = cu.to_tweet_date_strings(df["t_date"])  # Written as they are in the fetched tweets
 
-        df["hashtags"] = df["t_text"].apply(extract_hash_tags)
+        df["hashtags"] = extract_hash_tags_batch(df["t_text"])
         df.sort_values(by=['hashtags'], inplace=True)
 
         for cur_tag in hashtags_counter:
-            print(f'{cu.get_cur_formatted_time()} Tag {cur_tag}')
+            inst.log(f'Tag {cur_tag}')
             if is_quota_met_for_tag(tag_to_tweets[cur_tag], tag_to_num_tweets_required[cur_tag]):
-                print(f'{cu.get_cur_formatted_time()} Tag quota reached')
+                inst.log(f'Tag quota reached')
                 continue
 
+            df_for_tag = df[df.index.isin(tag_to_rows[cur_tag])]
             if cur_tag == no_pure_stance_tags_key:
-                df["is_tag_present"] = df['hashtags'].apply(
-                    lambda l: len(ALL_TAGS.intersection(set(l))) == 0 and len(l) > 0)
-                df_for_tag = df[df["is_tag_present"]]
-                print(f'{cu.get_cur_formatted_time()} Found {len(df_for_tag.index)} tweets containing no pure-stance tags')
+                inst.log(f'Found {len(df_for_tag.index)} tweets containing no pure-stance tags')
             elif cur_tag == no_tags_at_all_key:
-                df["is_tag_present"] = df['hashtags'].apply(
-                    lambda l: len(ALL_TAGS.intersection(set(l))) == 0 and len(l) == 0)
-                df_for_tag = df[df["is_tag_present"]]
-                print(f'{cu.get_cur_formatted_time()} Found {len(df_for_tag.index)} tweets containing no tags at all')
+                inst.log(f'Found {len(df_for_tag.index)} tweets containing no tags at all')
             else:
-                df["is_tag_present"] = df['hashtags'].apply(lambda l: cur_tag in l)
-                df_for_tag = df[df["is_tag_present"]]
-                print(f'{cu.get_cur_formatted_time()} Found {len(df_for_tag.index)} tweets containing tag')
+                inst.log(f'Found {len(df_for_tag.index)} tweets containing tag')
 
             if len(df_for_tag.index) == 0:
                 continue
 
-            df_for_tag = df_for_tag.drop(["is_tag_present"], axis="columns")
             df_for_tag = df_for_tag.head(tag_to_num_tweets_required[cur_tag])
             if tag_to_tweets[cur_tag] is None:
                 tag_to_tweets[cur_tag] = df_for_tag
@@ -391,10 +629,48 @@ def create_tweets_with_pure_stance_tags(bot_score_threshold=None, max_tweets_per
                 f'{cur_tag}: {0 if tag_to_tweets[cur_tag] is None else len(tag_to_tweets[cur_tag].index)}/{tag_to_num_tweets_required[cur_tag]}')
 
     if len(quotas_not_met) > 0:
-        print(f'Tags not found in enough tweets: {quotas_not_met.join(", ")}')
+        inst.log(f'Tags not found in enough tweets: {", ".join(quotas_not_met)}')
 
     return tag_to_tweets
 
+def write_tweets_with_pure_stance_tags(out_dir=HASHTAG_TWEETS_DIR, vocabulary_fname=None):
+    tag_to_tweets_df = create_tweets_with_pure_stance_tags(vocabulary_fname=vocabulary_fname)
+    for tag in tag_to_tweets_df:
+        cu.df_to_csv_plus_create_dir(tag_to_tweets_df[tag], out_dir, f"hashtag_{tag}_tweets.csv")
+
+def get_tag_ranks(counter):
+    '''
+    Returns a dict from each tag of counter (with a positive count) to its id, and the rank of every id by count - 0 is
+    the least common and equal counts get the same rank
+    '''
+    tags = [tag for tag, count in counter.items() if count > 0]
+    counts = np.array([counter[tag] for tag in tags], dtype=np.int64)
+    return {tag: i for i, tag in enumerate(tags)}, np.unique(counts, return_inverse=True)[1].astype(np.int64)
+
+
+def choose_least_common_tags(tag_lists, tag_to_id, tag_ranks):
+    '''
+    Vectorized choose_least_common_tag() for a series of tag lists (with tag_to_id and tag_ranks of get_tag_ranks()):
+    the least common tag of every list (of the ones in tag_to_id), or None. Like in choose_least_common_tag(), a tie is
+    won by the tag that comes last in the list
+    '''
+    tags = tag_lists.reset_index(drop=True).explode().dropna()
+    tags = tags[~tags.reset_index().duplicated().values]  # Only the first occurrence of a tag in a list counts
+    list_ids = tags.index.values.astype(np.int64)
+    positions = tags.groupby(level=0).cumcount().values
+    tag_ids = tags.map(tag_to_id).values.astype(np.float64)
+    is_known = ~np.isnan(tag_ids)
+    list_ids, positions, tag_ids = list_ids[is_known], positions[is_known], tag_ids[is_known].astype(np.int64)
+
+    order = np.lexsort((-positions, tag_ranks[tag_ids], list_ids))  # Per list: the lowest rank, then the last position
+    list_ids, tag_ids = list_ids[order], tag_ids[order]
+    is_first = np.concatenate([[True], list_ids[1:] != list_ids[:-1]]) if len(list_ids) > 0 else np.empty(0, dtype=bool)
+    id_to_tag = np.array(list(tag_to_id), dtype=object)
+    least_common_tags = np.full(len(tag_lists), None, dtype=object)
+    least_common_tags[list_ids[is_first]] = id_to_tag[tag_ids[is_first]]
+    return pd.Series(least_common_tags, index=tag_lists.index, dtype=object)
+
+
 def choose_least_common_tag(counter, tag_list):
     if len(tag_list) == 0:
         return []
@@ -404,27 +680,39 @@ def choose_least_common_tag(counter, tag_list):
         return []
     return [tag_counter_tuple[0]]
 
-if __name__ == "__main__":
-    print(f'{cu.get_cur_formatted_time()} Start')
-    create_hashtags_histograms()
-    tag_to_tweets_df = create_tweets_with_pure_stance_tags()
-    for tag in tag_to_tweets_df:
-        cu.df_to_csv_plus_create_dir(tag_to_tweets_df[tag], os.path.join(cu.PLOTS_DATA_FOLDER, 'hashtag_tweets'),
-                                  f"hashtag_{tag}_tweets.csv")
-
-    write_tags_to_tweets_least_common_arbitrator(dir_to_check_existing=os.path.join(cu.PLOTS_DATA_FOLDER, 'least_common_hashtag_tweets'))
-
+def get_pipeline_stages():
     '''
-    TODO - create a tree-like structure that orders (at least some of) the taga in a way that makes semantic sense in
-    that a node is more "granularity-fined" then it's parent.
-    E.g.:
-     - "ukip-manchester" will be a descendant of "ukip"
-     - All of the following will be same-level siblings: 'yes2eu', 'yestoeu', 'yes2europe', 'yestoeurope' 
-     
-    tag_to_tweets_df = create_tweets_with_pure_stance_tags(max_tweets_per_tag=None, tweets_arbitrator=choose_most_accurate_tag)
-    for tag in tag_to_tweets_df:
-        cu.df_to_csv_plus_create_dir(tag_to_tweets_df[tag], os.path.join(cu.PLOTS_DATA_FOLDER, 'most_accurate_hashtag_tweets'),
-                                  f"hashtag_{tag}_tweets.csv")
+    The stages of the hashtags analysis (see pipeline.py) - they read the vocabulary that the first one writes
     '''
+    vocabulary_fname = hv.HASHTAGS_VOCABULARY_FNAME
+    # The last histogram is named after the number of its tags, known only once the vocabulary is built
+    histograms_fnames = [pr.get_plot_fname(get_most_common_plot_name(args[0], args[2])) for args in get_histograms_plot_args(None)[:-1]]
+    return [pl.PipelineStage("hashtags_vocabulary", get_and_write_hashtags_vocabulary,
+                             (vocabulary_fname, HASHTAGS_SKETCH_CAPACITY),
+                             inputs=[cu.FINAL_REPORT_DATA_FOLDER, LEGACY_HASHTAGS_COUNTER_FNAME], outputs=[vocabulary_fname],
+                             cache_outputs=True),
+            pl.PipelineStage("hashtags_histograms", create_hashtags_histograms, (vocabulary_fname,), inputs=[vocabulary_fname],
+                             outputs=histograms_fnames + [RENDERED_HISTOGRAMS_HASHES_FNAME]),
+            pl.PipelineStage("tags_inverted_index", get_tags_inverted_index, inputs=[cu.FINAL_REPORT_DATA_FOLDER],
+                             outputs=[tii.TAGS_INVERTED_INDEX_FNAME]),
+            pl.PipelineStage("hashtags_cube", write_hashtags_cube, (vocabulary_fname, HASHTAGS_CUBE_BOT_SCORE_THRESHOLDS),
+                             inputs=[cu.FINAL_REPORT_DATA_FOLDER, vocabulary_fname] +
+                                    ([cu.BOT_SCORES_CSV_FNAME] if len(HASHTAGS_CUBE_BOT_SCORE_THRESHOLDS) > 0 else []),
+                             outputs=[hc.HASHTAGS_CUBE_FNAME, hc.HASHTAGS_CUBE_AXES_FNAME]),
+            pl.PipelineStage("tags_cooccurrence", get_tags_cooccurrence, inputs=[tii.TAGS_INVERTED_INDEX_FNAME],
+                             outputs=[tc.TAGS_COOCCURRENCE_FNAME]),
+            # Both of these resume from the tweets they already wrote (unless the shards or the vocabulary changed)
+            pl.PipelineStage("pure_stance_hashtag_tweets", write_tweets_with_pure_stance_tags,
+                             (HASHTAG_TWEETS_DIR, vocabulary_fname),
+                             inputs=[cu.FINAL_REPORT_DATA_FOLDER, vocabulary_fname, tii.TAGS_INVERTED_INDEX_FNAME],
+                             outputs=[HASHTAG_TWEETS_DIR], clean_outputs=True),
+            pl.PipelineStage("least_common_hashtag_tweets", write_tags_to_tweets_least_common_arbitrator,
+                             (LEAST_COMMON_HASHTAG_TWEETS_DIR, None, vocabulary_fname),
+                             inputs=[cu.FINAL_REPORT_DATA_FOLDER, vocabulary_fname, tii.TAGS_INVERTED_INDEX_FNAME],
+                             outputs=[LEAST_COMMON_HASHTAG_TWEETS_DIR], clean_outputs=True)]
 
-    print(f'{cu.get_cur_formatted_time()} FIN')
+if __name__ == "__main__":
+    inst.log(f'Start')
+    with inst.run("hashtags_analysis"):
+        pl.run_pipeline(get_pipeline_stages())
+    inst.log(f'FIN')
@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import common_utiles as cu
+import instrumentation as inst
+import shard_manifest as sm
+
+'''
+A count cube of the tweets per hashtag x day x stance (and per bot score threshold), so the trend of any set of tags can
+be queried without scanning the shards. The cube is a dense .npy file that's memory-mapped when it's loaded - a query
+reads only the slices of its tags
+'''
+
+HASHTAGS_CUBE_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "hashtags_cube.npy")
+HASHTAGS_CUBE_AXES_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "hashtags_cube_axes.npz")
+CUBE_MAX_TAGS = 10 ** 4  # Only the most common tags are in the cube - its size is thresholds x tags x days x stances
+CUBE_DTYPE = np.int32
+DAY = np.timedelta64(1, "D")
+
+
+class HashtagsCube:
+    '''
+    cube[k, tag, day, stance] is the number of tweets of the day (since first_day) and stance that contain the tag - of
+    all the users for k = 0 and without the users whose bot score is above bot_score_thresholds[k - 1] otherwise
+    '''
+
+    def __init__(self, cube, tags, first_day, stances, bot_score_thresholds=()):
+        self.cube = cube
+        self.tags = tags
+        self.tag_to_id = {tag: i for i, tag in enumerate(tags)}
+        self.first_day = np.datetime64(first_day, "D")
+        self.stances = stances
+        self.bot_score_thresholds = list(bot_score_thresholds)
+
+    def get_threshold_id(self, bot_score_threshold=None):
+        if bot_score_threshold is None:
+            return 0
+        if not bot_score_threshold in self.bot_score_thresholds:
+            raise ValueError(f'The cube has no bot score threshold {bot_score_threshold} (only {self.bot_score_thresholds})')
+        return self.bot_score_thresholds.index(bot_score_threshold) + 1
+
+    def get_day_id(self, date):
+        return int((np.datetime64(pd.Timestamp(date).to_datetime64(), "D") - self.first_day) // DAY)
+
+    def get_trend(self, tags, start_date=None, end_date=None, bot_score_threshold=None, granularity=1):
+        '''
+        Counts of the tweets that contain the tags (summed over them - a tweet with two of the tags is counted twice) per
+        bucket of granularity days in [start_date, end_date], as a df with a column per stance, indexed by the buckets'
+        start dates. Tags that aren't in the cube are ignored
+        '''
+        days_num = self.cube.shape[2]
+        start_day = 0 if start_date is None else min(max(self.get_day_id(start_date), 0), days_num)
+        end_day = days_num if end_date is None else min(max(self.get_day_id(end_date) + 1, start_day), days_num)
+        tag_ids = sorted(self.tag_to_id[tag] for tag in set(tags) if tag in self.tag_to_id)
+        counts = self.cube[self.get_threshold_id(bot_score_threshold)][tag_ids, start_day:end_day].sum(axis=0, dtype=np.int64)
+        bucket_starts = np.arange(0, end_day - start_day, granularity)
+        if len(bucket_starts) > 0:
+            counts = np.add.reduceat(counts, bucket_starts, axis=0)
+        dates = pd.DatetimeIndex(self.first_day + (start_day + bucket_starts) * DAY, name="Date")
+        return pd.DataFrame(counts.reshape(len(bucket_starts), len(self.stances)), index=dates, columns=self.stances)
+
+    def save_axes(self, fname=HASHTAGS_CUBE_AXES_FNAME):
+        tags_blob, tags_blob_offsets = cu.encode_strings(self.tags)
+        stances_blob, stances_blob_offsets = cu.encode_strings(self.stances)
+        np.savez(fname, tags_blob=tags_blob, tags_blob_offsets=tags_blob_offsets, first_day=self.first_day,
+                 stances_blob=stances_blob, stances_blob_offsets=stances_blob_offsets,
+                 bot_score_thresholds=np.array(self.bot_score_thresholds, dtype=np.float64))
+
+    @staticmethod
+    def load(fname=HASHTAGS_CUBE_FNAME, axes_fname=HASHTAGS_CUBE_AXES_FNAME):
+        inst.log(f'Reading hashtags cube from {fname}')
+        with np.load(axes_fname) as data:
+            return HashtagsCube(np.load(fname, mmap_mode="r"), cu.decode_strings(data["tags_blob"], data["tags_blob_offsets"]),
+                                data["first_day"], cu.decode_strings(data["stances_blob"], data["stances_blob_offsets"]),
+                                data["bot_score_thresholds"].tolist())
+
+
+def count_shard_cube_cells(full_fname, extract_tags_func, tag_to_id, first_day, days_num, stances, bot_score_thresholds):
+    '''
+    The flat indices (into the cube) of the cells the tweets of the shard fall into, and their counts
+    '''
+    inst.log(f'Counting hashtags of {full_fname} per day and stance')
+    cols = ["t_text", "t_date", "t_stance"] + (["user_id"] if len(bot_score_thresholds) > 0 else [])
+    cube_shape = (len(bot_score_thresholds) + 1, len(tag_to_id), days_num, len(stances))
+    cell_ids = []
+    for df in cu.iter_shard_chunks(full_fname, columns=cols):
+        df = df.reset_index(drop=True)  # Tags are indexed by the position of their tweet in the chunk
+        tags = extract_tags_func(df["t_text"]).explode().dropna()
+        tags = tags[~tags.reset_index().duplicated().values]  # A tag can come out of a text more than once
+        tag_ids = tags.map(tag_to_id).values.astype(np.float64)
+        is_in_cube = ~np.isnan(tag_ids)
+        tweet_ids, tag_ids = tags.index.values[is_in_cube], tag_ids[is_in_cube].astype(np.int64)
+
+        day_ids = ((df["t_date"].values.astype("datetime64[D]") - first_day) // DAY).astype(np.int64)[tweet_ids]
+        stance_ids = pd.Categorical(df["t_stance"].astype(str), categories=stances).codes.astype(np.int64)[tweet_ids]
+        is_valid = (day_ids >= 0) & (day_ids < days_num) & (stance_ids >= 0)
+        threshold_masks = [np.ones(len(tweet_ids), dtype=bool)]
+        if len(bot_score_thresholds) > 0:
+            bot_scores = cu.get_bot_scores(df["user_id"]).values[tweet_ids]
+            threshold_masks.extend(np.isnan(bot_scores) | (bot_scores <= threshold) for threshold in bot_score_thresholds)
+        for threshold_id, mask in enumerate(threshold_masks):
+            mask = mask & is_valid
+            cell_ids.append(np.ravel_multi_index((np.full(mask.sum(), threshold_id), tag_ids[mask], day_ids[mask],
+                                                  stance_ids[mask]), cube_shape))
+    return np.unique(np.concatenate(cell_ids), return_counts=True) if len(cell_ids) > 0 else \
+        (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+
+def get_cube_date_limits_and_stances(shard_fnames):
+    '''
+    The first and last days and the stances of all the shards, by their manifests
+    '''
+    first_day, last_day, stances = None, None, set()
+    for full_fname in shard_fnames:
+        manifest = sm.get_shard_manifest(full_fname)
+        min_date, max_date = sm.get_manifest_date_limits(manifest)
+        if min_date is None:
+            continue
+        first_day = min_date if first_day is None else min(first_day, min_date)
+        last_day = max_date if last_day is None else max(last_day, max_date)
+        stances.update(stance for stance, count in manifest["stance_counts"].items() if count > 0)
+    if first_day is None:
+        return None, None, []
+    return np.datetime64(first_day.floor("D"), "D"), np.datetime64(last_day.floor("D"), "D"), sorted(stances)
+
+
+@inst.timed_stage()
+def build_hashtags_cube(counter, extract_tags_func, bot_score_thresholds=(), max_tags=CUBE_MAX_TAGS,
+                        fname=HASHTAGS_CUBE_FNAME, axes_fname=HASHTAGS_CUBE_AXES_FNAME, workers_num=None):
+    '''
+    Builds the cube of the max_tags most common tags of counter (e.g. the vocabulary's) in a single pass over the shards
+    (mapped in parallel, see cu.iter_mapped_shards()). Every shard's counts are added to the memory-mapped file as soon as
+    it's mapped, so neither the cube nor the shards' counts are held in memory. extract_tags_func is as in
+    tags_inverted_index.build_tags_inverted_index()
+    '''
+    shard_fnames = cu.list_shard_files()
+    tags = [tag for tag, _ in counter.most_common(max_tags)]
+    first_day, last_day, stances = get_cube_date_limits_and_stances(shard_fnames)
+    if first_day is None:
+        first_day = last_day = np.datetime64("today", "D")
+    days_num = int((last_day - first_day) // DAY) + 1
+    bot_score_thresholds = list(bot_score_thresholds)
+    for bot_score_threshold in bot_score_thresholds:
+        cu.handle_bots(bot_score_threshold)  # Builds the bot scores store before the workers open it
+    cube_shape = (len(bot_score_thresholds) + 1, len(tags), days_num, len(stances))
+    inst.log(f'Building hashtags cube of shape {cube_shape} ({first_day} to {last_day}, stances {stances})')
+
+    tmp_fname = f'{fname}.tmp'
+    cube = np.lib.format.open_memmap(tmp_fname, mode="w+", dtype=CUBE_DTYPE, shape=cube_shape)
+    flat_cube = cube.reshape(-1)
+    map_args = (extract_tags_func, {tag: i for i, tag in enumerate(tags)}, first_day, days_num, stances, bot_score_thresholds)
+    for cell_ids, counts in cu.iter_mapped_shards(count_shard_cube_cells, map_args, shard_fnames, workers_num):
+        flat_cube[cell_ids] += counts.astype(CUBE_DTYPE)  # The cells of a shard are distinct
+    cube.flush()
+    del flat_cube, cube
+    os.replace(tmp_fname, fname)
+    hashtags_cube = HashtagsCube(np.load(fname, mmap_mode="r"), tags, first_day, stances, bot_score_thresholds)
+    hashtags_cube.save_axes(axes_fname)
+    return hashtags_cube
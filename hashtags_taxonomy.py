@@ -0,0 +1,159 @@
+import re
+from collections import namedtuple
+
+'''
+A taxonomy of hashtags: a prefix trie over the tags' canonical forms, so that a tag's node is an ancestor of every tag
+that starts with it (e.g. "ukip-manchester" is a descendant of "ukip"), and variants of a tag that differ only in
+separators or in a digit standing for a word are the same node (e.g. 'yes2eu' and 'yestoeu').
+Looking a tag up walks the trie once along its canonical form, collecting its ancestors on the way
+'''
+
+STANCE_LEAVE = "leave"
+STANCE_REMAIN = "remain"
+MAX_MEMOIZED_TAGS = 10 ** 6  # The lookups memos are cleared when they reach this many tags, so they stay bounded
+NODE_KEY = ""  # The key of a node's TaxonomyNode in its trie dict (every other key is a single char)
+
+TAG_SEPARATORS_REGEX = re.compile(r"[-_.#'’]")
+DIGITS_AS_WORDS_REGEXES = [(re.compile(r"(?<=[a-z])2(?=[a-z])"), "to"), (re.compile(r"(?<=[a-z])4(?=[a-z])"), "for")]
+
+# tag is the canonical form, variants are the forms it was added with (e.g. ['yes2eu', 'yestoeu']). The tags under a node
+# that is_inherited get its stance (see TagsTaxonomy.get_stance())
+TaxonomyNode = namedtuple("TaxonomyNode", ["tag", "stance", "variants", "is_inherited"], defaults=(False,))
+
+
+def get_canonical_tag(tag):
+    '''
+    Lower case, without separators and with digits that stand for words (between letters) replaced by them
+    '''
+    canonical_tag = TAG_SEPARATORS_REGEX.sub("", tag.lower())
+    for regex, word in DIGITS_AS_WORDS_REGEXES:
+        canonical_tag = regex.sub(word, canonical_tag)
+    return canonical_tag
+
+
+class TagsTaxonomy:
+    '''
+    The trie is nested dicts from a char to the sub trie of the tags that continue with it. A tag's stance is the stance
+    its node (i.e. it or a variant of it) was added with. A tag that wasn't added gets the stance of its nearest ancestor
+    with a stance, if that one was added as inherited (e.g. 'ukip-manchester' under 'ukip') - only some tags are, since
+    a tag under a stance tag is often against it (e.g. 'voteleavelies' under 'voteleave').
+    Stances are looked up in the trie once per distinct tag (as long as the memo doesn't reach MAX_MEMOIZED_TAGS tags)
+    '''
+
+    def __init__(self):
+        self.trie = {}
+        self.tag_to_stance = {}
+
+    def add(self, tag, stance=None, is_inherited=False):
+        '''
+        With is_inherited, the tags under tag that weren't added get its stance. Raises ValueError if a variant of tag
+        was already added with another stance
+        '''
+        canonical_tag = get_canonical_tag(tag)
+        cur_trie = self.trie
+        for char in canonical_tag:
+            cur_trie = cur_trie.setdefault(char, {})
+        node = cur_trie.get(NODE_KEY)
+        if node is None:
+            cur_trie[NODE_KEY] = TaxonomyNode(canonical_tag, stance, [tag], is_inherited)
+        elif node.stance != stance:
+            raise ValueError(f'{tag} is a variant of {node.variants} with another stance ({stance}, not {node.stance})')
+        else:
+            if not tag in node.variants:
+                node.variants.append(tag)
+            if is_inherited and not node.is_inherited:
+                cur_trie[NODE_KEY] = node._replace(is_inherited=True)
+        self.tag_to_stance = {}
+
+    def find_nodes(self, tag):
+        '''
+        Returns the nodes of tag's ancestors (from the root down) and tag's own node (None if it wasn't added)
+        '''
+        ancestors, cur_trie = [], self.trie
+        for char in get_canonical_tag(tag):
+            if NODE_KEY in cur_trie:
+                ancestors.append(cur_trie[NODE_KEY])
+            cur_trie = cur_trie.get(char)
+            if cur_trie is None:
+                return ancestors, None
+        return ancestors, cur_trie.get(NODE_KEY)
+
+    def get_node(self, tag):
+        return self.find_nodes(tag)[1]
+
+    def is_stance_tag(self, tag):
+        '''
+        Whether tag has a stance (see get_stance())
+        '''
+        return self.get_stance(tag) is not None
+
+    def get_ancestors(self, tag):
+        '''
+        Canonical forms of the tag's ancestors, from the root down
+        '''
+        return [node.tag for node in self.find_nodes(tag)[0]]
+
+    def get_children(self, tag):
+        '''
+        Canonical forms of the nearest nodes under tag (whether it was added or not)
+        '''
+        cur_trie = self.trie
+        for char in get_canonical_tag(tag):
+            cur_trie = cur_trie.get(char)
+            if cur_trie is None:
+                return []
+        children, sub_tries = [], [sub_trie for char, sub_trie in sorted(cur_trie.items()) if char != NODE_KEY]
+        while len(sub_tries) > 0:
+            sub_trie = sub_tries.pop(0)
+            if NODE_KEY in sub_trie:
+                children.append(sub_trie[NODE_KEY].tag)
+            else:
+                sub_tries.extend(child_trie for _, child_trie in sorted(sub_trie.items()))
+        return sorted(children)
+
+    def get_stance(self, tag):
+        '''
+        The stance of tag's node, or the inherited stance of its nearest ancestor with a stance (None if there's none)
+        '''
+        if tag in self.tag_to_stance:
+            return self.tag_to_stance[tag]
+        ancestors, node = self.find_nodes(tag)
+        if node is not None:
+            stance = node.stance
+        else:
+            stance_ancestors = [ancestor for ancestor in ancestors if ancestor.stance is not None]
+            stance = stance_ancestors[-1].stance if len(stance_ancestors) > 0 and stance_ancestors[-1].is_inherited else None
+        if len(self.tag_to_stance) >= MAX_MEMOIZED_TAGS:
+            self.tag_to_stance = {}
+        self.tag_to_stance[tag] = stance
+        return stance
+
+    def get_depth(self, tag):
+        '''
+        Number of the tag's ancestors - the more of them, the more specific the tag
+        '''
+        return len(self.find_nodes(tag)[0])
+
+    def get_stance_tags(self, tags, stance=None):
+        '''
+        The tags (of tags) that have a stance (see get_stance()) - the given one, or any stance if it's None
+        '''
+        return [tag for tag in tags if (self.is_stance_tag(tag) if stance is None else self.get_stance(tag) == stance)]
+
+    @staticmethod
+    def build(stance_to_tags, topic_tags=(), stance_to_inherited_tags=None):
+        '''
+        stance_to_tags is a dict from a stance to its tags. topic_tags are tags without a stance that group the tags
+        under them (e.g. 'brexit'). stance_to_inherited_tags is a dict from a stance to its tags whose stance is passed
+        to the tags under them (e.g. 'ukip')
+        '''
+        taxonomy = TagsTaxonomy()
+        for stance, tags in stance_to_tags.items():
+            for tag in sorted(tags):
+                taxonomy.add(tag, stance)
+        for stance, tags in (stance_to_inherited_tags or {}).items():
+            for tag in sorted(tags):
+                taxonomy.add(tag, stance, is_inherited=True)
+        for tag in sorted(topic_tags):
+            taxonomy.add(tag)
+        return taxonomy
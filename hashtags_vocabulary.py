@@ -0,0 +1,243 @@
+import os
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import common_utiles as cu
+import instrumentation as inst
+
+HASHTAGS_VOCABULARY_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "hashtags_counter.npz")
+COUNT_DTYPE = np.int64
+SKETCH_CAPACITY = 10 ** 5  # Number of tags a HashtagsSketch keeps (besides the ones it counts exactly)
+EXACT_ARRAYS_PREFIX = "exact_"
+
+
+class HashtagsVocabulary:
+    '''
+    Interns every hashtag to an int id (ids are given by order of first appearance) and keeps the number of occurrences
+    of tag i in counts[i]. Counting is done with np.bincount over the ids instead of a Counter per tweet
+    '''
+
+    def __init__(self, tags=None, counts=None):
+        self.tags = list(tags) if tags is not None else []
+        self.tag_to_id = {tag: i for i, tag in enumerate(self.tags)}
+        self.counts = np.asarray(counts, dtype=COUNT_DTYPE) if counts is not None else np.zeros(len(self.tags), dtype=COUNT_DTYPE)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, tag):
+        return tag in self.tag_to_id
+
+    def __getitem__(self, tag):
+        return int(self.counts[self.tag_to_id[tag]]) if tag in self.tag_to_id else 0
+
+    def get_or_add_ids(self, tags):
+        '''
+        Ids of tags (an iterable of strings), adding the ones that aren't in the vocabulary yet
+        '''
+        tag_ids = np.empty(len(tags), dtype=np.int64)
+        for i, tag in enumerate(tags):
+            if not tag in self.tag_to_id:
+                self.tag_to_id[tag] = len(self.tags)
+                self.tags.append(tag)
+            tag_ids[i] = self.tag_to_id[tag]
+        if len(self.counts) < len(self.tags):
+            self.counts = np.concatenate([self.counts, np.zeros(len(self.tags) - len(self.counts), dtype=COUNT_DTYPE)])
+        return tag_ids
+
+    def add_counts(self, tags, counts):
+        tag_ids = self.get_or_add_ids(tags)  # Might grow self.counts
+        np.add.at(self.counts, tag_ids, np.asarray(counts, dtype=COUNT_DTYPE))
+
+    def count_tag_lists(self, tag_lists):
+        '''
+        Counts all the tags in tag_lists - a series of tag lists (e.g. the output of extract_hash_tags_batch())
+        '''
+        all_tags = tag_lists.explode().dropna()
+        tag_ids, unique_tags = pd.factorize(all_tags, sort=False)  # Unique tags are in order of first appearance
+        self.add_counts(unique_tags, np.bincount(tag_ids, minlength=len(unique_tags)))
+
+    def merge(self, other):
+        self.add_counts(other.tags, other.counts)
+        return self
+
+    def get_ids(self, tags):
+        '''
+        Ids of tags, -1 for tags that aren't in the vocabulary
+        '''
+        return np.array([self.tag_to_id.get(tag, -1) for tag in tags], dtype=np.int64)
+
+    def get_sorted_ids(self):
+        return np.argsort(-self.counts, kind="stable")  # Most common first, ties by order of first appearance
+
+    def to_counter(self):
+        sorted_ids = self.get_sorted_ids()
+        return Counter(OrderedDict(zip([self.tags[i] for i in sorted_ids], self.counts[sorted_ids].tolist())))
+
+    @staticmethod
+    def from_counter(counter):
+        return HashtagsVocabulary(list(counter.keys()), list(counter.values()))
+
+    def to_arrays(self):
+        tags_blob, tags_blob_offsets = cu.encode_strings(self.tags)
+        return {"tags_blob": tags_blob, "tags_blob_offsets": tags_blob_offsets, "counts": self.counts}
+
+    @staticmethod
+    def from_arrays(arrays):
+        return HashtagsVocabulary(cu.decode_strings(arrays["tags_blob"], arrays["tags_blob_offsets"]), arrays["counts"])
+
+    def save(self, fname=HASHTAGS_VOCABULARY_FNAME):
+        inst.log(f'Writing hashtags vocabulary ({len(self.tags)} tags) to {fname}')
+        np.savez(fname, **self.to_arrays())
+
+    @staticmethod
+    def load(fname=HASHTAGS_VOCABULARY_FNAME):
+        inst.log(f'Reading hashtags vocabulary from {fname}')
+        with np.load(fname) as data:
+            return HashtagsVocabulary.from_arrays(data)
+
+def merge_vocabularies(vocabularies):
+    res = HashtagsVocabulary()
+    for vocabulary in vocabularies:
+        res.merge(vocabulary)
+    return res
+
+
+class HashtagsSketch:
+    '''
+    A Space-Saving summary of the hashtags counts in fixed memory: it keeps (at most) capacity tags, each with an
+    overestimate of its count and the maximal error of it - the tag's true count is in [count - error, count]. A tag that
+    isn't kept occurred at most get_min_count() times (which is at most total / capacity). Tags for which is_exact_tag
+    (see count_tag_lists()) is True are counted exactly on the side, in exact_vocabulary. Sketches are mergeable with
+    the same guarantees, so they can be computed per shard (and per chunk) and merged
+    '''
+
+    def __init__(self, capacity=SKETCH_CAPACITY, tags=None, counts=None, errors=None, total=0, exact_vocabulary=None):
+        self.capacity = int(capacity)
+        self.tags = list(tags) if tags is not None else []
+        self.counts = np.asarray(counts, dtype=COUNT_DTYPE) if counts is not None else np.zeros(len(self.tags), dtype=COUNT_DTYPE)
+        self.errors = np.asarray(errors, dtype=COUNT_DTYPE) if errors is not None else np.zeros(len(self.tags), dtype=COUNT_DTYPE)
+        self.tag_to_id = {tag: i for i, tag in enumerate(self.tags)}
+        self.total = int(total)  # Occurrences of all the tags that aren't counted exactly
+        self.exact_vocabulary = exact_vocabulary if exact_vocabulary is not None else HashtagsVocabulary()
+
+    def __len__(self):
+        return len(self.tags) + len(self.exact_vocabulary)
+
+    def __getitem__(self, tag):
+        return self.get_count_bounds(tag)[1]
+
+    def get_min_count(self):
+        '''
+        The count that a tag that isn't kept might have - 0 as long as the sketch isn't full (all the tags are kept)
+        '''
+        return int(self.counts.min()) if len(self.tags) >= self.capacity else 0
+
+    def get_count_bounds(self, tag):
+        '''
+        (min, max) of the true count of tag
+        '''
+        if tag in self.exact_vocabulary:
+            return self.exact_vocabulary[tag], self.exact_vocabulary[tag]
+        if tag in self.tag_to_id:
+            tag_id = self.tag_to_id[tag]
+            return int(self.counts[tag_id] - self.errors[tag_id]), int(self.counts[tag_id])
+        return 0, self.get_min_count()
+
+    def merge_summary(self, tags, counts, errors, min_count):
+        '''
+        Merges a summary of other occurrences, in which a tag that's missing might have up to min_count, and keeps the
+        capacity tags with the highest counts (ties by tag, so merging is commutative)
+        '''
+        own_min_count, own_tags_num = self.get_min_count(), len(self.tags)
+        all_tags = np.concatenate([np.array(self.tags, dtype=object), np.array(list(tags), dtype=object)])
+        unique_tags, tag_ids = np.unique(all_tags, return_inverse=True)
+        merged_counts = np.full(len(unique_tags), own_min_count + min_count, dtype=COUNT_DTYPE)
+        merged_errors = merged_counts.copy()
+        merged_counts[tag_ids[:own_tags_num]] += self.counts - own_min_count
+        merged_counts[tag_ids[own_tags_num:]] += np.asarray(counts, dtype=COUNT_DTYPE) - min_count
+        merged_errors[tag_ids[:own_tags_num]] += self.errors - own_min_count
+        merged_errors[tag_ids[own_tags_num:]] += np.asarray(errors, dtype=COUNT_DTYPE) - min_count
+        kept_ids = np.argsort(-merged_counts, kind="stable")[:self.capacity]  # Most common first
+        self.tags = unique_tags[kept_ids].tolist()
+        self.counts, self.errors = merged_counts[kept_ids], merged_errors[kept_ids]
+        self.tag_to_id = {tag: i for i, tag in enumerate(self.tags)}
+
+    def add_vocabulary(self, vocabulary, is_exact_tag=None):
+        '''
+        Adds the (exact) counts of vocabulary - of a chunk of tweets, so it's bounded by the size of the chunk
+        '''
+        is_exact = np.array([is_exact_tag(tag) for tag in vocabulary.tags] if is_exact_tag is not None else
+                            np.zeros(len(vocabulary), dtype=bool), dtype=bool)
+        tags = np.array(vocabulary.tags, dtype=object)
+        self.exact_vocabulary.add_counts(tags[is_exact], vocabulary.counts[is_exact])
+        self.merge_summary(tags[~is_exact], vocabulary.counts[~is_exact], np.zeros((~is_exact).sum(), dtype=COUNT_DTYPE), 0)
+        self.total += int(vocabulary.counts[~is_exact].sum())
+
+    def count_tag_lists(self, tag_lists, is_exact_tag=None):
+        '''
+        Counts all the tags in tag_lists (see HashtagsVocabulary.count_tag_lists()). is_exact_tag(tag) tells if tag
+        should be counted exactly
+        '''
+        vocabulary = HashtagsVocabulary()
+        vocabulary.count_tag_lists(tag_lists)
+        self.add_vocabulary(vocabulary, is_exact_tag)
+
+    def merge(self, other):
+        self.exact_vocabulary.merge(other.exact_vocabulary)
+        self.merge_summary(other.tags, other.counts, other.errors, other.get_min_count())
+        self.total += other.total
+        return self
+
+    def to_counter(self):
+        '''
+        The exact counts and the (over)estimated counts of the kept tags, most common first
+        '''
+        tags = self.exact_vocabulary.tags + self.tags
+        counts = np.concatenate([self.exact_vocabulary.counts, self.counts])
+        sorted_ids = np.argsort(-counts, kind="stable")
+        return Counter(OrderedDict(zip([tags[i] for i in sorted_ids], counts[sorted_ids].tolist())))
+
+    def to_arrays(self):
+        tags_blob, tags_blob_offsets = cu.encode_strings(self.tags)
+        arrays = {"capacity": np.array(self.capacity, dtype=np.int64), "tags_blob": tags_blob,
+                  "tags_blob_offsets": tags_blob_offsets, "counts": self.counts, "errors": self.errors,
+                  "total": np.array(self.total, dtype=np.int64)}
+        arrays.update({f'{EXACT_ARRAYS_PREFIX}{k}': v for k, v in self.exact_vocabulary.to_arrays().items()})
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        exact_vocabulary = HashtagsVocabulary.from_arrays({k[len(EXACT_ARRAYS_PREFIX):]: arrays[k] for k in arrays
+                                                           if k.startswith(EXACT_ARRAYS_PREFIX)})
+        return HashtagsSketch(int(arrays["capacity"]), cu.decode_strings(arrays["tags_blob"], arrays["tags_blob_offsets"]),
+                              arrays["counts"], arrays["errors"], int(arrays["total"]), exact_vocabulary)
+
+    def save(self, fname=HASHTAGS_VOCABULARY_FNAME):
+        inst.log(f'Writing hashtags sketch ({len(self.tags)} tags, {len(self.exact_vocabulary)} exact ones) to {fname}')
+        np.savez(fname, **self.to_arrays())
+
+    @staticmethod
+    def load(fname=HASHTAGS_VOCABULARY_FNAME):
+        inst.log(f'Reading hashtags sketch from {fname}')
+        with np.load(fname) as data:
+            return HashtagsSketch.from_arrays(data)
+
+
+def merge_sketches(sketches):
+    sketches = list(sketches)
+    res = HashtagsSketch(sketches[0].capacity if len(sketches) > 0 else SKETCH_CAPACITY)
+    for sketch in sketches:
+        res.merge(sketch)
+    return res
+
+
+def load_vocabulary_or_sketch(fname=HASHTAGS_VOCABULARY_FNAME):
+    '''
+    The HashtagsVocabulary or the HashtagsSketch that was saved to fname (both have to_counter())
+    '''
+    with np.load(fname) as data:
+        is_sketch = "errors" in data.files
+    return HashtagsSketch.load(fname) if is_sketch else HashtagsVocabulary.load(fname)
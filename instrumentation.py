@@ -0,0 +1,234 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on windows - the peak RSS isn't reported there
+    resource = None
+
+'''
+Structured progress and resource metrics. Work is split to named (nested) stages - "with stage(name):" or the
+@timed_stage(name) decorator - and each one gets its wall and CPU time, rows processed, bytes read and the peak RSS
+when it ended. Counters (e.g. the fetcher's requests, 429/503 responses and sleep time) are global to the run.
+Everything within "with run(name):" is written as one json metrics file (optionally with a cProfile of the run)
+'''
+
+METRICS_FOLDER = "metrics"
+STAGE_NAME_SEPARATOR = "/"
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+FETCHER_REQUESTS = "fetcher_requests"
+FETCHER_TOO_MANY_REQUESTS_RESPONSES = "fetcher_429_responses"
+FETCHER_SERVICE_UNAVAILABLE_RESPONSES = "fetcher_503_responses"
+FETCHER_OTHER_ERROR_RESPONSES = "fetcher_other_error_responses"
+FETCHER_CONNECTION_ERRORS = "fetcher_connection_errors"
+FETCHER_SLEEP_SECONDS = "fetcher_sleep_seconds"
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+
+    def add_rows(self, rows_num):
+        self.rows += rows_num
+
+    def add_bytes(self, bytes_num):
+        self.bytes += bytes_num
+
+
+class RunMetrics:
+    '''
+    The metrics of the stages (by their full name, e.g. "a/b" for stage b within a - a stage that ran several times is
+    summed up) and the counters of a run
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.stage_to_metrics = {}
+        self.counters = {}
+        self.lock = threading.Lock()  # Counters are incremented from the fetcher's threads
+
+    def add_stage(self, full_name, wall_seconds, cpu_seconds, rows, bytes, peak_rss_mb):
+        self.merge_stage(full_name, {"calls": 1, "wall_seconds": wall_seconds, "cpu_seconds": cpu_seconds, "rows": rows,
+                                     "bytes": bytes, "peak_rss_mb": peak_rss_mb})
+
+    def merge_stage(self, full_name, stage_metrics):
+        metrics = self.stage_to_metrics.setdefault(full_name, {"calls": 0, "wall_seconds": 0, "cpu_seconds": 0,
+                                                               "rows": 0, "bytes": 0, "peak_rss_mb": None})
+        for key in ["calls", "wall_seconds", "cpu_seconds", "rows", "bytes"]:
+            metrics[key] += stage_metrics[key]
+        if stage_metrics["peak_rss_mb"] is not None:
+            metrics["peak_rss_mb"] = max(metrics["peak_rss_mb"] or 0, stage_metrics["peak_rss_mb"])
+
+    def increment(self, counter_name, value=1):
+        with self.lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+
+    def to_dict(self):
+        wall_seconds = time.time() - self.start_time
+        stages = [{"name": name, **metrics,
+                   "rows_per_sec": metrics["rows"] / metrics["wall_seconds"] if metrics["wall_seconds"] > 0 else None}
+                  for name, metrics in self.stage_to_metrics.items()]
+        return {"run": self.name, "start_time": time.strftime(DATETIME_FORMAT, time.localtime(self.start_time)),
+                "wall_seconds": wall_seconds, "cpu_seconds": get_cpu_seconds(), "peak_rss_mb": get_peak_rss_mb(),
+                "stages": stages, "counters": dict(self.counters)}
+
+
+current_run = RunMetrics("")  # Stages and counters outside of a run() are collected here (and not written)
+stages_stack = []
+
+
+def log(message):
+    '''
+    Prints a progress message (with the time, like all the progress messages)
+    '''
+    print(f'{time.strftime(DATETIME_FORMAT)} {message}')
+
+
+def get_cpu_seconds():
+    '''
+    CPU time of this process and of its child processes that were waited for (e.g. the workers of a pool that was shut
+    down)
+    '''
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def get_peak_rss_mb():
+    '''
+    Peak RSS (so far) of this process or of one of its child processes that were waited for, the larger of the two
+    '''
+    if resource is None:
+        return None
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak_rss / 2 ** 20 if sys.platform == "darwin" else peak_rss / 2 ** 10  # Bytes on mac, KB on linux
+
+
+def get_current_stage():
+    return stages_stack[-1] if len(stages_stack) > 0 else None
+
+
+def add_rows(rows_num):
+    '''
+    Adds to the rows processed by the current stage (ignored outside of a stage)
+    '''
+    cur_stage = get_current_stage()
+    if cur_stage is not None:
+        cur_stage.add_rows(rows_num)
+
+
+def add_bytes(bytes_num):
+    cur_stage = get_current_stage()
+    if cur_stage is not None:
+        cur_stage.add_bytes(bytes_num)
+
+
+def increment(counter_name, value=1):
+    current_run.increment(counter_name, value)
+
+
+@contextmanager
+def stage(name):
+    '''
+    Yields the stage, to add rows and bytes to (or call add_rows()/add_bytes() from anywhere within it). The rows and
+    bytes of a stage are also added to the stage it's nested in
+    '''
+    full_name = STAGE_NAME_SEPARATOR.join([s.name for s in stages_stack] + [name])
+    cur_stage = Stage(name)
+    stages_stack.append(cur_stage)
+    start_time, start_cpu_seconds = time.perf_counter(), get_cpu_seconds()
+    try:
+        yield cur_stage
+    finally:
+        stages_stack.pop()
+        current_run.add_stage(full_name, time.perf_counter() - start_time, get_cpu_seconds() - start_cpu_seconds,
+                              cur_stage.rows, cur_stage.bytes, get_peak_rss_mb())
+        add_rows(cur_stage.rows)
+        add_bytes(cur_stage.bytes)
+
+
+def timed_stage(name=None):
+    '''
+    Decorator that runs the function as a stage (named after the function by default)
+    '''
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def call_in_worker(func, *args):
+    '''
+    Calls func in a worker process (of a pool) and returns its result with the rows, bytes and counters it added and the
+    stages it ran - to be passed to add_worker_metrics() in the parent process. A forked worker starts with the parent's
+    stages and counters, so they're put aside during the call
+    '''
+    global current_run, stages_stack
+    parent_run, parent_stages_stack = current_run, stages_stack
+    current_run, stages_stack = RunMetrics(""), [Stage("")]
+    try:
+        result = func(*args)
+        return result, {"rows": stages_stack[0].rows, "bytes": stages_stack[0].bytes, "counters": current_run.counters,
+                        "stages": current_run.stage_to_metrics}
+    finally:
+        current_run, stages_stack = parent_run, parent_stages_stack
+
+
+def add_worker_metrics(worker_metrics):
+    '''
+    The worker's stages are added as nested in the current stage
+    '''
+    add_rows(worker_metrics["rows"])
+    add_bytes(worker_metrics["bytes"])
+    for counter_name, value in worker_metrics["counters"].items():
+        increment(counter_name, value)
+    cur_full_name = STAGE_NAME_SEPARATOR.join(s.name for s in stages_stack)
+    for full_name, stage_metrics in worker_metrics["stages"].items():
+        # The worker's stages are nested in its nameless root stage (their full names start with the separator)
+        current_run.merge_stage(f'{cur_full_name}{full_name}'.lstrip(STAGE_NAME_SEPARATOR), stage_metrics)
+
+
+def get_metrics_fname(run_name, metrics_folder=METRICS_FOLDER):
+    return os.path.join(metrics_folder, f'{run_name}_{time.strftime("%Y%m%d_%H%M%S")}.json')
+
+
+@contextmanager
+def run(name, metrics_folder=METRICS_FOLDER, profile=False):
+    '''
+    Collects the metrics of everything within it and writes them (also if it failed) to a json file in metrics_folder.
+    With profile, the run is also profiled with cProfile, to a .prof file next to it (see the pstats module)
+    '''
+    global current_run
+    current_run = RunMetrics(name)
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with stage(name):
+            yield current_run
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        os.makedirs(metrics_folder, exist_ok=True)
+        metrics_fname = get_metrics_fname(name, metrics_folder)
+        with open(metrics_fname, "w") as f:
+            json.dump(current_run.to_dict(), f, indent=4)
+        if profiler is not None:
+            profiler.dump_stats(f'{os.path.splitext(metrics_fname)[0]}.prof')
+        log(f'Wrote the metrics of {name} to {metrics_fname}')
+        current_run = RunMetrics("")
@@ -0,0 +1,431 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import common_utiles as cu
+import instrumentation as inst
+
+'''
+Dependency-aware runner of the pipeline's stages. Every stage declares the files (or folders) it reads and writes, and a
+stage depends on the stages that write its inputs. A stage is rebuilt only if it's stale - if the content of its inputs
+(or its function's code or arguments) changed since it was last built, or if one of its outputs was changed or deleted
+since. Stages whose dependencies are done run concurrently, each in its own process (the processes of the stages and
+the ones they map the shards with share a single budget, see run_pipeline()).
+Only the code of the stage's own function is hashed (changes in the functions it calls aren't noticed - rebuild it with
+force then). Contents are hashed (sha256) and the hashes are memoized by the files' size and mtime, so only files that were touched
+are read again. Stages with small outputs can keep them in a content-addressed cache, to restore them (instead of
+rebuilding) when their inputs go back to an earlier state
+'''
+
+PIPELINE_STATE_DIR = os.path.join(cu.FINAL_REPORT_FOLDER, "pipeline")
+STAGES_STATE_FNAME = "stages_state.json"
+FILE_HASHES_FNAME = "file_hashes.json"
+ARTIFACTS_DIR = "artifacts"
+HASH_BLOCK_BYTES = 2 ** 20
+MAX_CACHED_OUTPUTS_PER_STAGE = 4  # Outputs of the most recent input states that are kept, per stage
+
+# func(*args) builds the stage. inputs and outputs are files or folders (all the files in them). With clean_outputs, the
+# outputs are deleted before the stage is rebuilt for new inputs (they're kept when it's resumed after it failed, for
+# stages that pick up where they stopped) and with cache_outputs they're kept in the artifacts cache. stat_inputs are
+# inputs that are fingerprinted by their files' sizes and mtimes instead of their contents - for large inputs that are
+# appended to (e.g. the fetcher's output), so they aren't read to tell whether they changed
+PipelineStage = namedtuple("PipelineStage", ["name", "func", "args", "inputs", "outputs", "clean_outputs", "cache_outputs",
+                                             "stat_inputs"],
+                           defaults=((), (), (), False, False, ()))
+
+
+class FileHashes:
+    '''
+    Memoized content hashes of files, valid as long as the file's size and mtime didn't change
+    '''
+
+    def __init__(self, fname_to_hash=None):
+        self.fname_to_hash = fname_to_hash if fname_to_hash is not None else {}
+        self.is_dirty = False
+
+    def get(self, fname):
+        stat = os.stat(fname)
+        entry = self.fname_to_hash.get(fname)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        hash_obj = hashlib.sha256()
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b""):
+                hash_obj.update(block)
+        inst.add_bytes(stat.st_size)
+        self.fname_to_hash[fname] = [stat.st_size, stat.st_mtime_ns, hash_obj.hexdigest()]
+        self.is_dirty = True
+        return hash_obj.hexdigest()
+
+    def save(self, state_dir=PIPELINE_STATE_DIR):
+        if self.is_dirty:
+            write_json_atomically(self.fname_to_hash, os.path.join(state_dir, FILE_HASHES_FNAME))
+            self.is_dirty = False
+
+    @staticmethod
+    def load(state_dir=PIPELINE_STATE_DIR):
+        return FileHashes(read_json_or_default(os.path.join(state_dir, FILE_HASHES_FNAME), {}))
+
+
+def read_json_or_default(fname, default):
+    if not os.path.isfile(fname):
+        return default
+    with open(fname) as f:
+        return json.load(f)
+
+
+def write_json_atomically(data, fname):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = f'{fname}.tmp'
+    with open(tmp_fname, "w") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+    os.replace(tmp_fname, fname)
+
+
+def read_stages_state(state_dir=PIPELINE_STATE_DIR):
+    return read_json_or_default(os.path.join(state_dir, STAGES_STATE_FNAME), {})
+
+
+def write_stages_state(stages_state, state_dir=PIPELINE_STATE_DIR):
+    write_json_atomically(stages_state, os.path.join(state_dir, STAGES_STATE_FNAME))
+
+
+def normalize_path(path):
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def is_same_or_nested_path(path, other_path):
+    path, other_path = normalize_path(path), normalize_path(other_path)
+    return path == other_path or path.startswith(f'{other_path}/') or other_path.startswith(f'{path}/')
+
+
+def list_files(path):
+    '''
+    path itself if it's a file, all the files under it (sorted) if it's a folder and nothing if it doesn't exist
+    '''
+    if os.path.isfile(path):
+        return [normalize_path(path)]
+    fnames = []
+    for dir_path, dir_names, filenames in os.walk(path):
+        dir_names.sort()
+        fnames.extend(normalize_path(os.path.join(dir_path, filename)) for filename in sorted(filenames))
+    return fnames
+
+
+def get_paths_fingerprint(paths, file_hashes):
+    '''
+    Hash of every file in paths (None for paths that don't exist)
+    '''
+    fname_to_hash = {}
+    for path in paths:
+        fnames = list_files(path)
+        if len(fnames) == 0:
+            fname_to_hash[normalize_path(path)] = None
+        for fname in fnames:
+            fname_to_hash[fname] = file_hashes.get(fname)
+    return fname_to_hash
+
+
+def get_paths_stats(paths):
+    '''
+    Size and mtime of every file in paths (None for paths that don't exist)
+    '''
+    fname_to_stats = {}
+    for path in paths:
+        fnames = list_files(path)
+        if len(fnames) == 0:
+            fname_to_stats[normalize_path(path)] = None
+        for fname in fnames:
+            stat = os.stat(fname)
+            fname_to_stats[fname] = [stat.st_size, stat.st_mtime_ns]
+    return fname_to_stats
+
+
+def get_func_source(func):
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):  # E.g. a builtin
+        return ""
+
+
+def get_stage_key(stage, file_hashes):
+    '''
+    Content address of the stage's build: a hash of its function (name and code), its arguments and its inputs' contents
+    (and its stat_inputs' sizes and mtimes)
+    '''
+    hash_obj = hashlib.sha256()
+    hash_obj.update(f'{stage.func.__module__}.{stage.func.__qualname__}{stage.args!r}'.encode("utf-8"))
+    hash_obj.update(get_func_source(stage.func).encode("utf-8"))
+    hash_obj.update(json.dumps(get_paths_fingerprint(stage.inputs, file_hashes), sort_keys=True).encode("utf-8"))
+    if len(stage.stat_inputs) > 0:
+        hash_obj.update(json.dumps(get_paths_stats(stage.stat_inputs), sort_keys=True).encode("utf-8"))
+    return hash_obj.hexdigest()
+
+
+def is_built(stage, stage_key, stages_state, file_hashes):
+    stage_state = stages_state.get(stage.name, {})
+    return stage_state.get("key") == stage_key and \
+           stage_state.get("outputs") == get_paths_fingerprint(stage.outputs, file_hashes)
+
+
+def is_stage_up_to_date(stage, state_dir=PIPELINE_STATE_DIR):
+    '''
+    Whether the outputs of stage were built (by the pipeline) from its current inputs and weren't changed since - e.g. to
+    check that a file can be read instead of being calculated again
+    '''
+    file_hashes = FileHashes.load(state_dir)
+    return is_built(stage, get_stage_key(stage, file_hashes), read_stages_state(state_dir), file_hashes)
+
+
+def get_artifact_fname(file_hash, state_dir=PIPELINE_STATE_DIR):
+    return os.path.join(state_dir, ARTIFACTS_DIR, file_hash[:2], file_hash)
+
+
+def remove_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+
+def cache_outputs(outputs_fingerprint, state_dir=PIPELINE_STATE_DIR):
+    for fname, file_hash in outputs_fingerprint.items():
+        if file_hash is None:
+            continue
+        artifact_fname = get_artifact_fname(file_hash, state_dir)
+        if not os.path.isfile(artifact_fname):
+            os.makedirs(os.path.dirname(artifact_fname), exist_ok=True)
+            shutil.copyfile(fname, f'{artifact_fname}.tmp')
+            os.replace(f'{artifact_fname}.tmp', artifact_fname)
+
+
+def restore_cached_outputs(stage, outputs_fingerprint, state_dir=PIPELINE_STATE_DIR):
+    '''
+    Replaces the outputs of stage with the cached ones. Returns False (without changing anything) if any of them is
+    missing from the cache
+    '''
+    if any(not os.path.isfile(get_artifact_fname(file_hash, state_dir))
+           for file_hash in outputs_fingerprint.values() if file_hash is not None):
+        return False
+    remove_paths(stage.outputs)
+    for fname, file_hash in outputs_fingerprint.items():
+        if file_hash is None:
+            continue
+        if os.path.dirname(fname) != "":
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+        shutil.copyfile(get_artifact_fname(file_hash, state_dir), fname)
+    return True
+
+
+def remove_unreferenced_artifacts(stages_state, state_dir=PIPELINE_STATE_DIR):
+    referenced_hashes = set()
+    for stage_state in stages_state.values():
+        for outputs_fingerprint in stage_state.get("cached_outputs", {}).values():
+            referenced_hashes.update(outputs_fingerprint.values())
+    artifacts_dir = os.path.join(state_dir, ARTIFACTS_DIR)
+    for fname in list_files(artifacts_dir):
+        if not os.path.basename(fname) in referenced_hashes:
+            os.remove(fname)
+
+
+def get_stages_dependencies(stages):
+    '''
+    Returns a dict from a stage's name to the names of the stages that write its inputs. Raises ValueError if two stages
+    write the same outputs or if the stages depend on each other in a cycle
+    '''
+    name_to_stage = {stage.name: stage for stage in stages}
+    if len(name_to_stage) != len(stages):
+        raise ValueError(f'Stage names should be unique: {[stage.name for stage in stages]}')
+    for i, stage in enumerate(stages):
+        for other_stage in stages[i + 1:]:
+            if any(is_same_or_nested_path(out, other_out) for out in stage.outputs for other_out in other_stage.outputs):
+                raise ValueError(f'Stages {stage.name} and {other_stage.name} write the same outputs')
+
+    name_to_dependencies = {stage.name: [other_stage.name for other_stage in stages if other_stage.name != stage.name and
+                                         any(is_same_or_nested_path(inp, out) for inp in list(stage.inputs) + list(stage.stat_inputs)
+                                             for out in other_stage.outputs)]
+                            for stage in stages}
+    visited, visiting = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f'The stages depend on each other in a cycle (through {name})')
+        visiting.add(name)
+        for dependency in name_to_dependencies[name]:
+            visit(dependency)
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in name_to_stage:
+        visit(name)
+    return name_to_dependencies
+
+
+def get_stages_to_run(stages, targets, name_to_dependencies):
+    '''
+    Names of the targets' stages and of the stages they depend on (recursively) - all the stages if targets is None
+    '''
+    if targets is None:
+        return set(name_to_dependencies)
+    stages_to_run, names = set(), list(targets)
+    while len(names) > 0:
+        name = names.pop()
+        if not name in name_to_dependencies:
+            raise ValueError(f'Unknown stage {name} (should be one of {[stage.name for stage in stages]})')
+        if not name in stages_to_run:
+            stages_to_run.add(name)
+            names.extend(name_to_dependencies[name])
+    return stages_to_run
+
+
+def build_stage(stage, shard_workers_num=None):
+    '''
+    shard_workers_num, if given, replaces cu.SHARD_WORKERS_NUM (the default number of processes the stage maps the
+    shards and renders the plots with) while the stage is built
+    '''
+    default_shard_workers_num = cu.SHARD_WORKERS_NUM
+    if shard_workers_num is not None:
+        cu.SHARD_WORKERS_NUM = shard_workers_num
+    try:
+        with inst.stage(stage.name):
+            stage.func(*stage.args)
+    finally:
+        cu.SHARD_WORKERS_NUM = default_shard_workers_num
+
+
+@inst.timed_stage()
+def run_pipeline(stages, targets=None, force=False, max_parallel_stages=None, state_dir=PIPELINE_STATE_DIR,
+                 workers_num=None):
+    '''
+    Builds the stale stages among targets (names of stages, None for all of them) and the stages they depend on. With
+    force, the targets are built even if they're up to date (not the stages they depend on). Up to max_parallel_stages
+    (default workers_num) independent stages are built at once, each in a worker process (1 builds them one after the
+    other in this process). workers_num (default cu.SHARD_WORKERS_NUM) is the budget of processes for the whole run: the
+    processes that the running stages don't map their shards with are split between the stages that become ready
+    together (at least 1 each, i.e. serially). So a stage that runs alone (e.g. in a chain of dependent stages) gets the
+    whole budget, instead of every stage starting a pool of its own of all the CPUs.
+    Stage functions and arguments have to be picklable. Returns the names of the stages that were built (or restored
+    from the cache)
+    '''
+    name_to_stage = {stage.name: stage for stage in stages}
+    name_to_dependencies = get_stages_dependencies(stages)
+    names_to_run = get_stages_to_run(stages, targets, name_to_dependencies)
+    pending_names = set(names_to_run)
+    forced_names = set(names_to_run if targets is None else targets) if force else set()
+    if workers_num is None:
+        workers_num = cu.SHARD_WORKERS_NUM
+    if max_parallel_stages is None:
+        max_parallel_stages = workers_num
+    stages_state = read_stages_state(state_dir)
+    file_hashes = FileHashes.load(state_dir)
+    done_names, built_names = set(), []
+    name_to_key = {}
+
+    def record_build(name, is_restored=False):
+        stage, stage_state = name_to_stage[name], stages_state.setdefault(name, {})
+        stage_state["key"] = name_to_key[name]
+        stage_state["outputs"] = get_paths_fingerprint(stage.outputs, file_hashes)
+        if stage.cache_outputs and not is_restored:
+            cache_outputs(stage_state["outputs"], state_dir)
+            cached_outputs = stage_state.setdefault("cached_outputs", {})
+            cached_outputs.pop(name_to_key[name], None)  # Re-added as the most recent one
+            cached_outputs[name_to_key[name]] = stage_state["outputs"]
+            for key in list(cached_outputs)[:-MAX_CACHED_OUTPUTS_PER_STAGE]:
+                del cached_outputs[key]
+        write_stages_state(stages_state, state_dir)
+        file_hashes.save(state_dir)
+        done_names.add(name)
+        built_names.append(name)
+
+    def get_stages_to_build():
+        '''
+        Marks the ready stages (all their dependencies are done) that are up to date as done (or restores them from the
+        cache) and returns the ones that have to be built
+        '''
+        stages_to_build = []
+        while True:
+            ready_names = sorted(name for name in pending_names if all(dependency in done_names or not dependency in names_to_run
+                                                                      for dependency in name_to_dependencies[name]))
+            if len(ready_names) == 0:
+                return stages_to_build
+            for name in ready_names:
+                pending_names.remove(name)
+                stage = name_to_stage[name]
+                name_to_key[name] = get_stage_key(stage, file_hashes)
+                if not name in forced_names and is_built(stage, name_to_key[name], stages_state, file_hashes):
+                    inst.log(f'Stage {name} is up to date')
+                    done_names.add(name)
+                    continue
+                cached_outputs = stages_state.get(name, {}).get("cached_outputs", {}).get(name_to_key[name])
+                if not name in forced_names and cached_outputs is not None and restore_cached_outputs(stage, cached_outputs, state_dir):
+                    inst.log(f'Stage {name} restored from the cache')
+                    record_build(name, is_restored=True)
+                    continue
+                stage_state = stages_state.setdefault(name, {})
+                if stage.clean_outputs and stage_state.get("started_key") != name_to_key[name]:
+                    remove_paths(stage.outputs)  # Outputs of other inputs - not to be resumed from
+                stage_state["started_key"] = name_to_key[name]
+                write_stages_state(stages_state, state_dir)
+                stages_to_build.append(stage)
+
+    if max_parallel_stages <= 1:
+        stages_to_build = get_stages_to_build()
+        while len(stages_to_build) > 0:
+            for stage in stages_to_build:
+                inst.log(f'Building stage {stage.name}')
+                build_stage(stage, workers_num)
+                record_build(stage.name)
+            stages_to_build = get_stages_to_build()
+    else:
+        with ProcessPoolExecutor(max_workers=max_parallel_stages) as executor:
+            future_to_name, future_to_workers_num = {}, {}
+            try:
+                while True:
+                    stages_to_build = get_stages_to_build()
+                    free_workers_num = workers_num - sum(future_to_workers_num.values())
+                    starting_stages_num = min(len(stages_to_build), max_parallel_stages - len(future_to_name))
+                    shard_workers_num = max(free_workers_num // max(starting_stages_num, 1), 1)
+                    for stage in stages_to_build:
+                        inst.log(f'Building stage {stage.name} (mapping shards with {shard_workers_num} processes)')
+                        future = executor.submit(inst.call_in_worker, build_stage, stage, shard_workers_num)
+                        future_to_name[future], future_to_workers_num[future] = stage.name, shard_workers_num
+                    if len(future_to_name) == 0:
+                        break
+                    done_futures, _ = wait(future_to_name, return_when=FIRST_COMPLETED)
+                    for future in done_futures:
+                        name = future_to_name.pop(future)
+                        del future_to_workers_num[future]
+                        _, worker_metrics = future.result()
+                        inst.add_worker_metrics(worker_metrics)
+                        record_build(name)
+            except BaseException:
+                for future in future_to_name:
+                    future.cancel()  # The stages that were already started are left to finish
+                raise
+
+    remove_unreferenced_artifacts(stages_state, state_dir)
+    inst.log(f'Built {len(built_names)} stages ({len(done_names) - len(built_names)} were up to date)')
+    return built_names
+
+
+def get_pipeline_stages():
+    '''
+    All the stages, of the final report and of the hashtags analysis
+    '''
+    import final_report_generator as frg
+    import hashtags_analysis as ha
+    return frg.get_pipeline_stages() + ha.get_pipeline_stages()
+
+
+if __name__ == "__main__":
+    inst.log(f'Start')
+    with inst.run("pipeline"):
+        run_pipeline(get_pipeline_stages())
+    inst.log(f'FIN')
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import common_utiles as cu
+import instrumentation as inst
+
+'''
+Headless plot rendering: plots are drawn on Agg figures (no pyplot global state), each one from the aggregates on disk,
+so they can be rendered in a pool of processes. A plot is rendered only if the hash of its inputs changed since it was
+last rendered (or if its image is missing)
+'''
+
+RENDERED_PLOTS_HASHES_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "rendered_plots_hashes.json")
+PLOT_FORMAT = "png"
+HASH_BLOCK_BYTES = 2 ** 20
+
+# name is the image name (without the extension), render_func(*args) draws and saves it and input_fnames are the files
+# it's rendered from
+PlotSpec = namedtuple("PlotSpec", ["name", "render_func", "input_fnames", "args"])
+
+
+def new_figure(figsize=None):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def get_plot_fname(name, f_format=PLOT_FORMAT):
+    return os.path.join(cu.PLOTS_IMG_FOLDER, f'{name}.{f_format}')
+
+
+def save_figure(fig, name, f_format=PLOT_FORMAT):
+    path = get_plot_fname(name, f_format)
+    inst.log(f'Saving plot {path}')
+    fig.savefig(path)
+
+
+def update_hash_with_file(hash_obj, fname):
+    '''
+    npz files are hashed by their arrays - the zip entries of an npz have the time it was written
+    '''
+    if fname.endswith(".npz"):
+        with np.load(fname) as data:
+            for name in sorted(data.files):
+                hash_obj.update(name.encode("utf-8"))
+                hash_obj.update(np.ascontiguousarray(data[name]).tobytes())
+        return
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b""):
+            hash_obj.update(block)
+
+
+def get_plot_input_hash(spec):
+    hash_obj = hashlib.sha256()
+    hash_obj.update(f'{spec.render_func.__module__}.{spec.render_func.__qualname__}{spec.args!r}'.encode("utf-8"))
+    for fname in spec.input_fnames:
+        update_hash_with_file(hash_obj, fname)
+    return hash_obj.hexdigest()
+
+
+def read_rendered_plots_hashes(hashes_fname=RENDERED_PLOTS_HASHES_FNAME):
+    if not os.path.isfile(hashes_fname):
+        return {}
+    with open(hashes_fname) as f:
+        return json.load(f)
+
+
+def write_rendered_plots_hashes(name_to_hash, hashes_fname=RENDERED_PLOTS_HASHES_FNAME):
+    tmp_fname = f'{hashes_fname}.tmp'
+    with open(tmp_fname, "w") as f:
+        json.dump(name_to_hash, f, indent=4, sort_keys=True)
+    os.replace(tmp_fname, hashes_fname)
+
+
+def render_plot(spec):
+    spec.render_func(*spec.args)
+    return spec.name
+
+
+@inst.timed_stage()
+def render_plots(specs, workers_num=None, force=False, hashes_fname=RENDERED_PLOTS_HASHES_FNAME):
+    '''
+    Renders the plots of specs whose inputs changed (all of them with force) in a pool of workers_num processes (default
+    cu.SHARD_WORKERS_NUM, 1 renders them serially in this process)
+    '''
+    name_to_hash = read_rendered_plots_hashes(hashes_fname)
+    spec_to_hash = {spec.name: get_plot_input_hash(spec) for spec in specs}
+    stale_specs = [spec for spec in specs if force or name_to_hash.get(spec.name) != spec_to_hash[spec.name] or
+                   not os.path.isfile(get_plot_fname(spec.name))]
+    inst.log(f'Rendering {len(stale_specs)} plots ({len(specs) - len(stale_specs)} are up to date)')
+    if workers_num is None:
+        workers_num = cu.SHARD_WORKERS_NUM
+    workers_num = min(workers_num, len(stale_specs))
+    os.makedirs(cu.PLOTS_IMG_FOLDER, exist_ok=True)
+    if workers_num <= 1:
+        rendered_names = [render_plot(spec) for spec in stale_specs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers_num) as executor:
+            rendered_names = list(executor.map(render_plot, stale_specs))
+    inst.add_rows(len(rendered_names))
+
+    for name in rendered_names:
+        name_to_hash[name] = spec_to_hash[name]
+    write_rendered_plots_hashes(name_to_hash, hashes_fname)
+    return rendered_names
@@ -0,0 +1,128 @@
+import os
+
+import numpy as np
+
+PROCESSED_IDS_INDEX_DIR = "processed_ids_index"
+BASE_FNAME = "processed_ids.npy"  # Sorted unique int64 ids, memory-mapped on load
+JOURNAL_FNAME = "processed_ids.journal"  # Raw int64 ids appended by the fetcher since the last compaction
+ID_DTYPE = np.dtype("<i8")
+MAX_PENDING_IDS = 10 ** 5  # Ids added in this session are merged into the sorted journal array in batches of this size
+COMPACTION_MIN_JOURNAL_IDS = 10 ** 6
+
+
+def is_in_sorted(sorted_arr, ids):
+    if len(sorted_arr) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    positions = np.searchsorted(sorted_arr, ids)
+    positions[positions == len(sorted_arr)] = 0
+    return sorted_arr[positions] == ids
+
+
+def to_ids_array(ids):
+    if isinstance(ids, np.ndarray):
+        return ids.astype(ID_DTYPE, copy=False)
+    return np.fromiter((int(i) for i in ids), dtype=ID_DTYPE)
+
+
+class ProcessedIdsIndex:
+    '''
+    Persistent set of tweet ids that were already processed by the fetcher (found, not found or not authorized).
+    It's made of a sorted, memory-mapped base array and an append-only journal that add() writes to. compact() merges
+    the journal into the base. Membership checks are binary searches, so loading is near instant
+    '''
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        base_fname = os.path.join(index_dir, BASE_FNAME)
+        self.base_ids = np.load(base_fname, mmap_mode="r") if os.path.isfile(base_fname) else np.empty(0, ID_DTYPE)
+        self.journal_fname = os.path.join(index_dir, JOURNAL_FNAME)
+        self.journal_ids = np.unique(self.read_journal())
+        self.pending_ids = np.empty(0, ID_DTYPE)  # Sorted and unique, every add() inserts its new ids into it
+        self.journal_file = open(self.journal_fname, "ab")
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.isfile(os.path.join(index_dir, BASE_FNAME))
+
+    @staticmethod
+    def create(index_dir, ids):
+        os.makedirs(index_dir, exist_ok=True)
+        write_sorted_ids(os.path.join(index_dir, BASE_FNAME), np.unique(to_ids_array(ids)))
+        return ProcessedIdsIndex(index_dir)
+
+    def read_journal(self):
+        if not os.path.isfile(self.journal_fname):
+            return np.empty(0, ID_DTYPE)
+        journal_size = os.path.getsize(self.journal_fname)
+        if journal_size % ID_DTYPE.itemsize != 0:
+            # A crash in the middle of a write - the last id is partial, drop it
+            with open(self.journal_fname, "r+b") as f:
+                f.truncate(journal_size - journal_size % ID_DTYPE.itemsize)
+        return np.fromfile(self.journal_fname, dtype=ID_DTYPE)
+
+    def __len__(self):
+        return len(self.base_ids) + len(self.journal_ids) + len(self.pending_ids)
+
+    def __contains__(self, tweet_id):
+        try:
+            return bool(self.contains([int(tweet_id)])[0])
+        except ValueError:
+            return False
+
+    def contains(self, ids):
+        ids = to_ids_array(ids)
+        res = is_in_sorted(self.base_ids, ids) | is_in_sorted(self.journal_ids, ids)
+        return res | is_in_sorted(self.pending_ids, ids)
+
+    def add(self, ids):
+        ids = to_ids_array(ids)
+        if len(ids) == 0:
+            return
+        self.journal_file.write(ids.tobytes())
+        self.journal_file.flush()
+        new_ids = np.unique(ids)
+        new_ids = new_ids[~is_in_sorted(self.pending_ids, new_ids)]
+        self.pending_ids = np.insert(self.pending_ids, np.searchsorted(self.pending_ids, new_ids), new_ids)
+        if len(self.pending_ids) >= MAX_PENDING_IDS:
+            self.journal_ids = np.union1d(self.journal_ids, self.pending_ids)
+            self.pending_ids = np.empty(0, ID_DTYPE)
+
+    def compact(self, min_journal_ids=0):
+        ids_to_merge = np.concatenate([self.journal_ids, self.pending_ids])
+        if len(ids_to_merge) < max(min_journal_ids, 1):
+            return
+        merged_ids = np.union1d(self.base_ids, ids_to_merge)
+        self.journal_file.close()
+        self.base_ids = None  # Release the memory map before replacing its file
+        write_sorted_ids(os.path.join(self.index_dir, BASE_FNAME), merged_ids)
+        open(self.journal_fname, "wb").close()
+        self.base_ids = np.load(os.path.join(self.index_dir, BASE_FNAME), mmap_mode="r")
+        self.journal_ids = np.empty(0, ID_DTYPE)
+        self.pending_ids = np.empty(0, ID_DTYPE)
+        self.journal_file = open(self.journal_fname, "ab")
+
+    def close(self):
+        self.journal_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_npy_atomically(fname, arr):
+    '''
+    Writes arr as a .npy file that's replaced only once it's fully written (and synced), so a crash never leaves a
+    partial file behind
+    '''
+    tmp_fname = f'{fname}.tmp'
+    with open(tmp_fname, "wb") as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def write_sorted_ids(fname, sorted_ids):
+    write_npy_atomically(fname, np.asarray(sorted_ids, dtype=ID_DTYPE))
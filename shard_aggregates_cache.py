@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+
+import common_utiles as cu
+
+SHARD_AGGREGATES_CACHE_DIR = os.path.join(cu.FINAL_REPORT_FOLDER, "shard_aggregates")
+FINGERPRINT_KEY = "fingerprint"
+
+
+def get_threshold_name(bot_score_threshold):
+    return "all" if bot_score_threshold is None else f'bot_filter_{bot_score_threshold}'
+
+
+def get_shard_fingerprint(full_fname, bot_score_threshold=None):
+    '''
+    A partial of a shard is valid as long as the shard didn't change - and if it's bot filtered, neither did the bot
+    scores csv
+    '''
+    fingerprint = list(cu.get_file_fingerprint(full_fname))
+    if not bot_score_threshold is None:
+        fingerprint.extend(cu.get_file_fingerprint(cu.BOT_SCORES_CSV_FNAME))
+    return np.array(fingerprint, dtype=np.int64)
+
+
+def get_partial_fname(full_fname, partial_name, cache_dir=SHARD_AGGREGATES_CACHE_DIR):
+    shard_name = os.path.splitext(os.path.basename(full_fname))[0]
+    return os.path.join(cache_dir, f'{shard_name}.{partial_name}.npz')
+
+
+def load_partial(full_fname, partial_name, fingerprint, cache_dir=SHARD_AGGREGATES_CACHE_DIR):
+    '''
+    Returns the arrays of the cached partial aggregate of the shard, or None if there's none or if it's stale
+    '''
+    partial_fname = get_partial_fname(full_fname, partial_name, cache_dir)
+    if not os.path.isfile(partial_fname):
+        return None
+    with np.load(partial_fname) as data:
+        if not np.array_equal(data[FINGERPRINT_KEY], fingerprint):
+            return None
+        return {k: data[k] for k in data.files if k != FINGERPRINT_KEY}
+
+
+def save_partial(full_fname, partial_name, fingerprint, arrays, cache_dir=SHARD_AGGREGATES_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    partial_fname = get_partial_fname(full_fname, partial_name, cache_dir)
+    tmp_fname = f'{partial_fname}.tmp'
+    with open(tmp_fname, "wb") as f:  # A file object, so np.savez won't add a .npz extension to the tmp file
+        np.savez(f, **{FINGERPRINT_KEY: fingerprint}, **arrays)
+    os.replace(tmp_fname, partial_fname)
+
+
+def get_or_compute_partial(full_fname, partial_name, fingerprint, compute_func, cache_dir=SHARD_AGGREGATES_CACHE_DIR):
+    '''
+    compute_func() returns the partial as a dict of arrays. It's called only if there's no valid cached partial
+    '''
+    arrays = load_partial(full_fname, partial_name, fingerprint, cache_dir)
+    if arrays is None:
+        arrays = compute_func()
+        save_partial(full_fname, partial_name, fingerprint, arrays, cache_dir)
+    return arrays
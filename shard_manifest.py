@@ -0,0 +1,162 @@
+import datetime
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import common_utiles as cu
+import instrumentation as inst
+
+# Not next to the shards, so that a manifest written (or rewritten) lazily by a reader doesn't change the data folder -
+# the output of the final_report_data pipeline stage
+SHARD_MANIFESTS_DIR = os.path.join(cu.FINAL_REPORT_FOLDER, "shard_manifests")
+MANIFEST_FNAME_SUFFIX = ".manifest.json"
+MAX_USER_ID_RANGES = 32  # The user ids of a shard are summarized as (at most) this many [min, max] ranges
+DATE_ONLY_REGEX = re.compile(r"\s*\d{4}-\d{2}-\d{2}\s*")
+
+
+def get_manifest_fname(full_fname, manifests_dir=SHARD_MANIFESTS_DIR):
+    return os.path.join(manifests_dir, f'{os.path.basename(full_fname)}{MANIFEST_FNAME_SUFFIX}')
+
+
+def get_user_id_ranges(user_ids, max_ranges=MAX_USER_ID_RANGES):
+    '''
+    Splits the (unique, sorted) user ids at their max_ranges - 1 largest gaps and returns the [min, max] of each part
+    '''
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+    if len(user_ids) == 0:
+        return []
+    largest_gaps = np.argsort(-np.diff(user_ids), kind="stable")[:max_ranges - 1]
+    split_positions = np.sort(largest_gaps) + 1
+    starts = np.concatenate([[0], split_positions])
+    ends = np.concatenate([split_positions - 1, [len(user_ids) - 1]])
+    return [[int(user_ids[s]), int(user_ids[e])] for s, e in zip(starts, ends)]
+
+
+def compute_shard_manifest(chunks, full_fname):
+    '''
+    Metadata of a shard (a zone map) that lets readers skip it without reading it: row count, min/max date, count of
+    tweets per stance and ranges of its user ids. chunks are the content of the shard, as one or more dfs (only the
+    distinct user ids are kept between chunks)
+    '''
+    rows_num, min_date, max_date, stance_counts = 0, None, None, pd.Series(dtype=np.int64)
+    user_ids = np.empty(0, dtype=np.int64)
+    for df in chunks:
+        if len(df.index) == 0:
+            continue
+        datetime_series = cu.to_naive_datetime(df["t_date"])
+        rows_num += len(df.index)
+        min_date = datetime_series.min() if min_date is None else min(min_date, datetime_series.min())
+        max_date = datetime_series.max() if max_date is None else max(max_date, datetime_series.max())
+        stance_counts = stance_counts.add(df["t_stance"].astype(str).value_counts(sort=False), fill_value=0)
+        user_ids = np.union1d(user_ids, df["user_id"].values.astype(np.int64))
+    return {"shard_fname": os.path.basename(full_fname),
+            "fingerprint": list(cu.get_file_fingerprint(full_fname)),
+            "rows": rows_num,
+            "min_date": min_date.isoformat() if rows_num > 0 else None,
+            "max_date": max_date.isoformat() if rows_num > 0 else None,
+            "stance_counts": {str(k): int(v) for k, v in stance_counts.items()},
+            "user_id_ranges": get_user_id_ranges(user_ids)}
+
+
+def write_shard_manifest(chunks, full_fname):
+    manifest = compute_shard_manifest(chunks, full_fname)
+    os.makedirs(SHARD_MANIFESTS_DIR, exist_ok=True)
+    with open(get_manifest_fname(full_fname), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_shard_manifest(full_fname):
+    '''
+    Returns the manifest of the shard, or None if there's none or if the shard changed since it was written
+    '''
+    manifest_fname = get_manifest_fname(full_fname)
+    if not os.path.isfile(manifest_fname):
+        return None
+    with open(manifest_fname) as f:
+        manifest = json.load(f)
+    if tuple(manifest["fingerprint"]) != cu.get_file_fingerprint(full_fname):
+        return None
+    return manifest
+
+
+def get_shard_manifest(full_fname):
+    manifest = read_shard_manifest(full_fname)
+    if manifest is None:
+        inst.log(f'Reading {full_fname} (for its manifest)')
+        manifest = write_shard_manifest(cu.iter_shard_chunks(full_fname, columns=["t_date", "t_stance", "user_id"]),
+                                        full_fname)
+    return manifest
+
+
+def get_manifest_date_limits(manifest):
+    if manifest["rows"] == 0:
+        return None, None
+    return pd.Timestamp(manifest["min_date"]), pd.Timestamp(manifest["max_date"])
+
+
+def is_date_only(date):
+    '''
+    Whether date is a date without a time (e.g. '2016-06-23' or a datetime.date, but not '2016-06-23 00:00')
+    '''
+    if isinstance(date, str):
+        return DATE_ONLY_REGEX.fullmatch(date) is not None
+    if isinstance(date, np.datetime64):
+        return np.datetime_data(date.dtype)[0] in ("Y", "M", "W", "D")
+    return isinstance(date, datetime.date) and not isinstance(date, datetime.datetime)
+
+
+def is_up_to_end_date(dates, end_date):
+    '''
+    Whether dates (a timestamp or a datetime64 series) are up to end_date, inclusive. An end_date without a time (see
+    is_date_only()) stands for the whole day, so it includes the dates before the midnight after it
+    '''
+    if is_date_only(end_date):
+        return dates < pd.Timestamp(end_date).floor("D") + pd.Timedelta(days=1)
+    return dates <= pd.Timestamp(end_date)
+
+
+def is_manifest_in_date_range(manifest, start_date=None, end_date=None):
+    '''
+    Whether the shard of manifest may have tweets in [start_date, end_date] (a date-only end_date includes its whole day)
+    '''
+    min_date, max_date = get_manifest_date_limits(manifest)
+    if min_date is None:
+        return False
+    return (start_date is None or max_date >= pd.Timestamp(start_date)) and (end_date is None or is_up_to_end_date(min_date, end_date))
+
+
+def has_manifest_any_stance(manifest, stances):
+    return any(manifest["stance_counts"].get(str(stance), 0) > 0 for stance in stances)
+
+
+def may_manifest_contain_users(manifest, user_ids):
+    ranges = np.array(manifest["user_id_ranges"], dtype=np.int64).reshape(-1, 2)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    range_ids = np.searchsorted(ranges[:, 0], user_ids, side="right") - 1  # The last range that starts before each id
+    return bool(np.any((range_ids >= 0) & (user_ids <= ranges[np.maximum(range_ids, 0), 1])))
+
+
+def prune_shard_files(shard_fnames=None, start_date=None, end_date=None, stances=None, user_ids=None):
+    '''
+    Returns only the shards (of shard_fnames, default all) that may have tweets in [start_date, end_date], of one of
+    stances and of one of user_ids (None means no restriction). Only the manifests are read
+    '''
+    if shard_fnames is None:
+        shard_fnames = cu.list_shard_files()
+    res = []
+    for full_fname in shard_fnames:
+        manifest = get_shard_manifest(full_fname)
+        if not is_manifest_in_date_range(manifest, start_date, end_date):
+            continue
+        if not stances is None and not has_manifest_any_stance(manifest, stances):
+            continue
+        if not user_ids is None and not may_manifest_contain_users(manifest, user_ids):
+            continue
+        res.append(full_fname)
+    if len(res) < len(shard_fnames):
+        inst.log(f'Skipping {len(shard_fnames) - len(res)}/{len(shard_fnames)} shards (by their manifests)')
+    return res
@@ -0,0 +1,168 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import common_utiles as cu
+import instrumentation as inst
+from hashtags_analysis import LEAVE_TAGS, REMAIN_TAGS
+
+'''
+A deterministic synthetic corpus in the layout of the real one, for benchmarking without the dataverse files and twitter:
+the 4 dataverse csv files, the users csv (with bot scores) and the fetcher's json output (with texts that have a mix of
+stance, common and long tail hashtags). Run from (or chdir to) the dir it should be written to - like the real scripts
+'''
+
+DEFAULT_TWEETS_PER_FILE = 10 ** 5
+DEFAULT_USERS_NUM = 10 ** 4
+DEFAULT_SEED = 0
+FETCHER_OUT_DIRS = [cu.BASE_OUT_DIR + ("" if i == 1 else f'{i}') for i in range(1, 5)]
+FIRST_TWEET_ID = 10 ** 17
+MAX_TWEET_ID_GAP = 1000
+START_DATE = pd.Timestamp("2016-01-01")
+END_DATE = pd.Timestamp("2020-01-31")
+STANCES = np.array(["leave", "remain", "other"])
+STANCE_PROBS = [0.35, 0.3, 0.35]
+SENTIMENTS = np.array(["positive", "negative", "neutral"])
+FETCHED_RATIO = 0.8
+NOT_FOUND_RATIO = 0.1
+NOT_AUTHORIZED_RATIO = 0.05  # The rest of the tweets weren't requested yet
+RECORDS_PER_FRAGMENT = 10 ** 5  # Tweets per json fragment of the fetcher
+
+COMMON_TAGS = np.array(["brexit", "eu", "uk", "euref", "referendum", "politics", "theresamay", "borisjohnson", "news",
+                        "london", "europe", "ge2017", "ge2019", "article50", "nhs"])
+LONG_TAIL_TAGS_NUM = 10 ** 5  # Tags drawn with a zipf distribution - most of them appear once or not at all
+MAX_TAGS_PER_TWEET = 4
+STANCE_TAG_PROB = 0.3  # Of every tag in a tweet of a leave/remain stance
+COMMON_TAG_PROB = 0.4  # Of every tag (the rest are long tail tags)
+MENTION_PROB = 0.2
+COMPOUND_TAG_PROB = 0.02  # A tag that's glued to the previous one (e.g. #brexit#eu)
+TAG_SUFFIXES = np.array(["", "", "", "", "!", ",", ".", "?", ":", "…"])
+WORDS = np.array(["the", "vote", "today", "deal", "people", "government", "parliament", "never", "again", "future",
+                  "country", "trade", "border", "economy", "leaders", "promise", "want", "think", "why", "now",
+                  "time", "jobs", "market", "europe", "britain", "is", "not", "will", "be", "a", "we", "they"])
+WORDS_PER_TWEET = (5, 20)
+
+
+def get_long_tail_tags(rng, size):
+    ranks = np.minimum(rng.zipf(1.3, size=size), LONG_TAIL_TAGS_NUM)
+    return np.char.add("tag", ranks.astype(str))
+
+
+def random_case(rng, tags):
+    '''
+    Tags are written as lower, upper or title case, as in real tweets (so the processing has something to normalize)
+    '''
+    cases = rng.integers(0, 4, size=len(tags))
+    return np.where(cases == 1, np.char.upper(tags), np.where(cases == 2, np.char.capitalize(tags), tags))
+
+
+def generate_tweet_texts(rng, stances):
+    '''
+    Returns a text per stance: random words with (up to MAX_TAGS_PER_TWEET) hashtags. Leave/remain tweets get some of
+    their stance's tags, every tweet gets common tags and long tail tags, with case variants, punctuation, compound tags
+    and mentions
+    '''
+    tweets_num = len(stances)
+    tags_nums = rng.integers(0, MAX_TAGS_PER_TWEET + 1, size=tweets_num)
+    tags_num = int(tags_nums.sum())
+    tag_stances = np.repeat(stances, tags_nums)
+    kinds = rng.random(tags_num)
+    leave_tags, remain_tags = np.array(sorted(LEAVE_TAGS)), np.array(sorted(REMAIN_TAGS))
+    tags = get_long_tail_tags(rng, tags_num).astype(object)
+    is_common = kinds < COMMON_TAG_PROB
+    tags[is_common] = rng.choice(COMMON_TAGS, size=int(is_common.sum()))
+    for stance, stance_tags in [("leave", leave_tags), ("remain", remain_tags)]:
+        is_stance_tag = (kinds >= 1 - STANCE_TAG_PROB) & (tag_stances == stance)
+        tags[is_stance_tag] = rng.choice(stance_tags, size=int(is_stance_tag.sum()))
+    tags = random_case(rng, tags.astype(str))
+    separators = np.where(rng.random(tags_num) < COMPOUND_TAG_PROB, "#", " #")
+    tags = np.char.add(np.char.add(separators, tags), rng.choice(TAG_SUFFIXES, size=tags_num)).tolist()
+
+    words_nums = rng.integers(*WORDS_PER_TWEET, size=tweets_num)
+    words = rng.choice(WORDS, size=int(words_nums.sum())).tolist()
+    has_mention = (rng.random(tweets_num) < MENTION_PROB).tolist()
+    tag_ends, word_ends = np.cumsum(tags_nums).tolist(), np.cumsum(words_nums).tolist()
+    texts = []
+    for i, (tag_end, word_end) in enumerate(zip(tag_ends, word_ends)):
+        text = " ".join(words[word_end - words_nums[i]:word_end]) + "".join(tags[tag_end - tags_nums[i]:tag_end])
+        texts.append(f'@user{i % 1000} {text}' if has_mention[i] else text.lstrip(" "))
+    return texts
+
+
+def generate_users_file(rng, users_num):
+    user_ids = np.arange(users_num) + 1000
+    bot_scores = np.round(rng.beta(2, 5, size=users_num), 3).astype(str)
+    bot_scores[rng.random(users_num) < 0.05] = ""  # Users without a bot score
+    users_df = pd.DataFrame({"user_id": user_ids, "user_sentiment": rng.choice(SENTIMENTS, size=users_num),
+                             "user_stance": rng.choice(STANCES, size=users_num, p=STANCE_PROBS), "bot_score": bot_scores,
+                             "bot_fetch_time": "2019-01-01", "tweets_num": rng.integers(1, 1000, size=users_num)})
+    os.makedirs(cu.DATA_FOLDER, exist_ok=True)
+    users_df.to_csv(cu.BOT_SCORES_CSV_FNAME, sep="~", header=False, index=False)
+    return user_ids
+
+
+def write_fetcher_output(rng, tweet_ids, texts, with_text, records_per_fragment=RECORDS_PER_FRAGMENT):
+    '''
+    Splits the tweets between the fetcher's out dirs as fetched (with a random date), not found, not authorized or not
+    requested yet, and writes them as the fetcher's json fragments. Returns the number of fetched tweets
+    '''
+    categories = rng.random(len(tweet_ids))
+    out_dir_nums = rng.integers(0, len(FETCHER_OUT_DIRS), size=len(tweet_ids))
+    seconds = rng.integers(0, int((END_DATE - START_DATE).total_seconds()), size=len(tweet_ids))
+    dates = (START_DATE + pd.to_timedelta(seconds, unit="s")).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    tweet_ids = tweet_ids.astype(str)
+    fetched_tweets_num = 0
+    for out_dir_num, out_dir in enumerate(FETCHER_OUT_DIRS):
+        in_dir = out_dir_nums == out_dir_num
+        is_fetched = in_dir & (categories < FETCHED_RATIO)
+        fetched_positions = np.flatnonzero(is_fetched)
+        fetched_tweets_num += len(fetched_positions)
+        fname_prefix = "tweets_ids_to_creation_time_and_text" if with_text else "tweets_ids_to_creation_time"
+        for start in range(0, len(fetched_positions), records_per_fragment):
+            positions = fetched_positions[start:start + records_per_fragment]
+            if with_text:
+                data = {tweet_ids[p]: {"created_at": dates[p], "text": texts[p]} for p in positions}
+            else:
+                data = {tweet_ids[p]: dates[p] for p in positions}
+            write_fetcher_fragment(data, os.path.join(out_dir, "tweets_ids_to_creation_time"), f'{fname_prefix}_{start}.json')
+        is_not_found = in_dir & (categories >= FETCHED_RATIO) & (categories < FETCHED_RATIO + NOT_FOUND_RATIO)
+        write_fetcher_fragment(tweet_ids[is_not_found].tolist(), os.path.join(out_dir, "tweet_ids_not_found"),
+                               "tweet_ids_not_found_0.json")
+        is_not_authorized = in_dir & (categories >= FETCHED_RATIO + NOT_FOUND_RATIO) & \
+                            (categories < FETCHED_RATIO + NOT_FOUND_RATIO + NOT_AUTHORIZED_RATIO)
+        write_fetcher_fragment(tweet_ids[is_not_authorized].tolist(), os.path.join(out_dir, "tweet_ids_not_authorized"),
+                               "tweet_ids_not_authorized_0.json")
+    return fetched_tweets_num
+
+
+def write_fetcher_fragment(data, dir, fname):
+    os.makedirs(dir, exist_ok=True)
+    with open(os.path.join(dir, fname), "w") as f:
+        json.dump(data, f)
+
+
+def generate_synthetic_corpus(tweets_per_file=DEFAULT_TWEETS_PER_FILE, users_num=DEFAULT_USERS_NUM, seed=DEFAULT_SEED,
+                              with_text=True):
+    '''
+    Writes the synthetic corpus to the current dir (same seed and sizes, same corpus). Returns the tweet texts (of all
+    the tweets, fetched or not) and the number of fetched tweets
+    '''
+    rng = np.random.default_rng(seed)
+    for dir in [cu.FINAL_REPORT_DATA_FOLDER, cu.PLOTS_DATA_FOLDER, cu.PLOTS_IMG_FOLDER]:
+        os.makedirs(dir, exist_ok=True)
+    inst.log(f'Generating a synthetic corpus of {4 * tweets_per_file} tweets and {users_num} users (seed {seed})')
+    user_ids = generate_users_file(rng, users_num)
+    tweet_ids = FIRST_TWEET_ID + np.cumsum(rng.integers(1, MAX_TWEET_ID_GAP, size=4 * tweets_per_file))
+    stances = rng.choice(STANCES, size=len(tweet_ids), p=STANCE_PROBS)
+    for i in range(1, 5):
+        file_slice = slice((i - 1) * tweets_per_file, i * tweets_per_file)
+        df = pd.DataFrame({"ID": tweet_ids[file_slice], "user_id": rng.choice(user_ids, size=tweets_per_file),
+                           "t_sentiment": rng.choice(SENTIMENTS, size=tweets_per_file), "t_stance": stances[file_slice]})
+        # Only the first file has a header (see final_report_data_generator())
+        df.to_csv(os.path.join(cu.DATA_FOLDER, f'tweets_stance_sentiment_{i}outof4.csv'), sep="~", index=False, header=i == 1)
+    texts = generate_tweet_texts(rng, stances)
+    fetched_tweets_num = write_fetcher_output(rng, tweet_ids, texts, with_text)
+    inst.log(f'Generated {len(tweet_ids)} tweets ({fetched_tweets_num} fetched)')
+    return texts, fetched_tweets_num
@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+
+import common_utiles as cu
+import instrumentation as inst
+
+TAGS_COOCCURRENCE_FNAME = os.path.join(cu.PLOTS_DATA_FOLDER, "tags_cooccurrence.npz")
+
+
+class TagsCooccurrence:
+    '''
+    A sparse (CSR) tag x tag matrix of the number of tweets that contain both tags: the tags that co-occur with tag i are
+    indices[indptr[i]:indptr[i+1]] (sorted) and their counts are in the same slice of counts. The matrix is symmetric and
+    its diagonal is the number of tweets that contain each tag. Tag ids are the ones of the tags inverted index
+    '''
+
+    def __init__(self, tags, indptr, indices, counts, shard_fnames, shard_fingerprints):
+        self.tags = tags
+        self.tag_to_id = {tag: i for i, tag in enumerate(tags)}
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.shard_fnames = shard_fnames
+        self.shard_fingerprints = shard_fingerprints
+
+    def is_up_to_date(self, tags_index):
+        return self.shard_fnames == tags_index.shard_fnames and np.array_equal(self.shard_fingerprints,
+                                                                               tags_index.shard_fingerprints)
+
+    def get_row(self, tag):
+        '''
+        Ids of the tags that co-occur with tag (including itself) and the counts of the tweets they share
+        '''
+        if not tag in self.tag_to_id:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        tag_id = self.tag_to_id[tag]
+        start, end = self.indptr[tag_id], self.indptr[tag_id + 1]
+        return self.indices[start:end], self.counts[start:end]
+
+    def get_count(self, tag_a, tag_b):
+        '''
+        Number of tweets that contain both tags
+        '''
+        tag_ids, counts = self.get_row(tag_a)
+        if not tag_b in self.tag_to_id:
+            return 0
+        i = np.searchsorted(tag_ids, self.tag_to_id[tag_b])
+        return int(counts[i]) if i < len(tag_ids) and tag_ids[i] == self.tag_to_id[tag_b] else 0
+
+    def get_cooccurring_tags(self, tag, n=None):
+        '''
+        The (n) tags that co-occur with tag the most, as (tag, count) pairs - most common first
+        '''
+        tag_ids, counts = self.get_row(tag)
+        is_other = tag_ids != self.tag_to_id.get(tag, -1)
+        tag_ids, counts = tag_ids[is_other], counts[is_other]
+        order = np.argsort(-counts, kind="stable")[:n]
+        return [(self.tags[i], int(c)) for i, c in zip(tag_ids[order], counts[order])]
+
+    def save(self, fname=TAGS_COOCCURRENCE_FNAME):
+        tags_blob, tags_blob_offsets = cu.encode_strings(self.tags)
+        shards_blob, shards_blob_offsets = cu.encode_strings(self.shard_fnames)
+        inst.log(f'Writing tags co-occurrence ({len(self.tags)} tags, {len(self.indices)} non zeros) to {fname}')
+        np.savez(fname, tags_blob=tags_blob, tags_blob_offsets=tags_blob_offsets, indptr=self.indptr,
+                 indices=self.indices, counts=self.counts, shards_blob=shards_blob,
+                 shards_blob_offsets=shards_blob_offsets, shard_fingerprints=self.shard_fingerprints)
+
+    @staticmethod
+    def load(fname=TAGS_COOCCURRENCE_FNAME):
+        inst.log(f'Reading tags co-occurrence from {fname}')
+        with np.load(fname) as data:
+            return TagsCooccurrence(cu.decode_strings(data["tags_blob"], data["tags_blob_offsets"]), data["indptr"],
+                                    data["indices"], data["counts"],
+                                    cu.decode_strings(data["shards_blob"], data["shards_blob_offsets"]),
+                                    data["shard_fingerprints"])
+
+
+def count_tag_pairs(tweet_ids, tag_ids, tags_num):
+    '''
+    tweet_ids and tag_ids are postings sorted by tweet, then tag (each tag once per tweet). Returns the distinct pairs of
+    tags (a < b) that share tweets, encoded as a * tags_num + b, and their counts. A tweet with k tags has k * (k - 1) / 2
+    pairs, so its i-th tag is paired with its (i + offset)-th tag for every offset
+    '''
+    pair_keys = []
+    for offset in range(1, len(tweet_ids)):
+        is_same_tweet = tweet_ids[offset:] == tweet_ids[:-offset]
+        if not is_same_tweet.any():
+            break
+        pair_keys.append(tag_ids[:-offset][is_same_tweet] * tags_num + tag_ids[offset:][is_same_tweet])
+    if len(pair_keys) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(pair_keys), return_counts=True)
+
+
+@inst.timed_stage()
+def build_tags_cooccurrence(tags_index):
+    '''
+    Builds the matrix in a single pass over the postings of the tags inverted index (without reading the shards) - a
+    shard at a time, so only the pairs of one shard and the distinct pairs so far are held in memory
+    '''
+    tags_num = len(tags_index.tags)
+    postings_tag = np.repeat(np.arange(tags_num, dtype=np.int64), np.diff(tags_index.tag_offsets))
+    order = np.lexsort((postings_tag, tags_index.postings_row, tags_index.postings_shard))
+    postings_shard = tags_index.postings_shard[order]
+    postings_row, postings_tag = tags_index.postings_row[order].astype(np.int64), postings_tag[order]
+    shard_starts = np.searchsorted(postings_shard, np.arange(len(tags_index.shard_fnames) + 1))
+
+    pair_keys, pair_counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    for start, end in zip(shard_starts[:-1], shard_starts[1:]):
+        shard_keys, shard_counts = count_tag_pairs(postings_row[start:end], postings_tag[start:end], tags_num)
+        pair_keys, key_ids = np.unique(np.concatenate([pair_keys, shard_keys]), return_inverse=True)
+        pair_counts = np.bincount(key_ids, weights=np.concatenate([pair_counts, shard_counts]),
+                                  minlength=len(pair_keys)).astype(np.int64)
+    inst.add_rows(len(postings_row))
+
+    # Both (a, b) and (b, a), and the diagonal
+    tag_ids, (tags_a, tags_b) = np.arange(tags_num, dtype=np.int64), np.divmod(pair_keys, max(tags_num, 1))
+    rows, cols = np.concatenate([tags_a, tags_b, tag_ids]), np.concatenate([tags_b, tags_a, tag_ids])
+    counts = np.concatenate([pair_counts, pair_counts, np.diff(tags_index.tag_offsets).astype(np.int64)])
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(tags_num + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=tags_num))
+    return TagsCooccurrence(list(tags_index.tags), indptr, cols[order], counts[order], list(tags_index.shard_fnames),
+                            np.asarray(tags_index.shard_fingerprints, dtype=np.int64))
+
+
+def get_tags_cooccurrence(tags_index, fname=TAGS_COOCCURRENCE_FNAME):
+    '''
+    Loads the matrix from fname, (re)building it from tags_index if it doesn't exist or if the index is of other shards
+    '''
+    if os.path.isfile(fname):
+        tags_cooccurrence = TagsCooccurrence.load(fname)
+        if tags_cooccurrence.is_up_to_date(tags_index):
+            return tags_cooccurrence
+        inst.log(f'Shards changed since {fname} was built, rebuilding it')
+    tags_cooccurrence = build_tags_cooccurrence(tags_index)
+    tags_cooccurrence.save(fname)
+    return tags_cooccurrence
@@ -0,0 +1,140 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import common_utiles as cu
+import instrumentation as inst
+
+TAGS_INVERTED_INDEX_FNAME = os.path.join(cu.FINAL_REPORT_FOLDER, "tags_inverted_index.npz")
+
+
+class TagsInvertedIndex:
+    '''
+    Maps every hashtag to its postings - the (shard, row) pairs of the tweets that contain it. The postings are sorted by
+    tag, then shard, then row, so the postings of tag i are postings_*[tag_offsets[i]:tag_offsets[i+1]]. Rows are
+    positions in the shard file (0 based)
+    '''
+
+    def __init__(self, tags, tag_offsets, postings_shard, postings_row, shard_fnames, shard_fingerprints, shard_rows):
+        self.tags = tags
+        self.tag_to_id = {tag: i for i, tag in enumerate(tags)}
+        self.tag_offsets = tag_offsets
+        self.postings_shard = postings_shard
+        self.postings_row = postings_row
+        self.shard_fnames = shard_fnames
+        self.shard_to_id = {fname: i for i, fname in enumerate(shard_fnames)}
+        self.shard_fingerprints = shard_fingerprints
+        self.shard_rows = shard_rows
+
+    def is_up_to_date(self, shard_full_fnames):
+        if [os.path.basename(f) for f in shard_full_fnames] != self.shard_fnames:
+            return False
+        return all(tuple(cu.get_file_fingerprint(f)) == tuple(fingerprint) for f, fingerprint in
+                   zip(shard_full_fnames, self.shard_fingerprints))
+
+    def get_tag_count(self, tag):
+        '''
+        Number of tweets that contain tag
+        '''
+        if not tag in self.tag_to_id:
+            return 0
+        tag_id = self.tag_to_id[tag]
+        return int(self.tag_offsets[tag_id + 1] - self.tag_offsets[tag_id])
+
+    def get_rows(self, tag, shard_fname):
+        '''
+        Sorted rows of the tweets in shard_fname that contain tag
+        '''
+        shard_fname = os.path.basename(shard_fname)
+        if not (tag in self.tag_to_id and shard_fname in self.shard_to_id):
+            return np.empty(0, dtype=np.int64)
+        tag_id, shard_id = self.tag_to_id[tag], self.shard_to_id[shard_fname]
+        start, end = self.tag_offsets[tag_id], self.tag_offsets[tag_id + 1]
+        tag_shards = self.postings_shard[start:end]
+        shard_start, shard_end = np.searchsorted(tag_shards, [shard_id, shard_id + 1])
+        return self.postings_row[start + shard_start:start + shard_end]
+
+    def get_rows_of_any_tag(self, tags, shard_fname):
+        rows = [self.get_rows(tag, shard_fname) for tag in tags]
+        return np.unique(np.concatenate(rows)) if len(rows) > 0 else np.empty(0, dtype=np.int64)
+
+    def get_shard_rows_num(self, shard_fname):
+        shard_fname = os.path.basename(shard_fname)
+        return int(self.shard_rows[self.shard_to_id[shard_fname]]) if shard_fname in self.shard_to_id else 0
+
+    def get_rows_with_tags(self, shard_fname):
+        '''
+        Sorted rows of the tweets in shard_fname that contain at least one tag
+        '''
+        shard_fname = os.path.basename(shard_fname)
+        if not shard_fname in self.shard_to_id:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(self.postings_row[self.postings_shard == self.shard_to_id[shard_fname]])
+
+    def save(self, fname=TAGS_INVERTED_INDEX_FNAME):
+        tags_blob, tags_blob_offsets = cu.encode_strings(self.tags)
+        shards_blob, shards_blob_offsets = cu.encode_strings(self.shard_fnames)
+        inst.log(f'Writing tags inverted index ({len(self.tags)} tags, {len(self.postings_row)} postings) to {fname}')
+        np.savez(fname, tags_blob=tags_blob, tags_blob_offsets=tags_blob_offsets, tag_offsets=self.tag_offsets,
+                 postings_shard=self.postings_shard, postings_row=self.postings_row, shards_blob=shards_blob,
+                 shards_blob_offsets=shards_blob_offsets, shard_fingerprints=self.shard_fingerprints,
+                 shard_rows=self.shard_rows)
+
+    @staticmethod
+    def load(fname=TAGS_INVERTED_INDEX_FNAME):
+        inst.log(f'Reading tags inverted index from {fname}')
+        with np.load(fname) as data:
+            return TagsInvertedIndex(cu.decode_strings(data["tags_blob"], data["tags_blob_offsets"]),
+                                     data["tag_offsets"], data["postings_shard"], data["postings_row"],
+                                     cu.decode_strings(data["shards_blob"], data["shards_blob_offsets"]),
+                                     data["shard_fingerprints"], data["shard_rows"])
+
+
+@inst.timed_stage()
+def build_tags_inverted_index(shard_full_fnames, extract_tags_func):
+    '''
+    Builds the index in a single pass over the shards, each read in chunks (see cu.iter_shard_chunks()). extract_tags_func gets a column of texts and returns a series of
+    tag lists with the same index (e.g. hashtags_analysis.extract_hash_tags_batch)
+    '''
+    shard_tags, shard_ids, shard_rows = [], [], []
+    shard_rows_num = []
+    for shard_id, full_fname in enumerate(shard_full_fnames):
+        inst.log(f'Indexing tags of {full_fname}')
+        rows_num = 0
+        for df in cu.iter_shard_chunks(full_fname, columns=["t_text"]):  # The chunks are indexed by their rows in the shard
+            tags = extract_tags_func(df["t_text"]).explode().dropna()
+            tags = tags[~tags.reset_index().duplicated().values]  # A tag can come out of a text more than once
+            shard_tags.append(tags.values)
+            shard_ids.append(np.full(len(tags), shard_id, dtype=np.int32))
+            shard_rows.append(tags.index.values.astype(np.int64))
+            rows_num += len(df.index)
+        shard_rows_num.append(rows_num)
+
+    tag_ids, tags = pd.factorize(np.concatenate(shard_tags) if len(shard_tags) > 0 else np.empty(0, dtype=object),
+                                 sort=True)
+    postings_shard = np.concatenate(shard_ids) if len(shard_ids) > 0 else np.empty(0, dtype=np.int32)
+    postings_row = np.concatenate(shard_rows) if len(shard_rows) > 0 else np.empty(0, dtype=np.int64)
+    order = np.lexsort((postings_row, postings_shard, tag_ids))
+    tag_offsets = np.zeros(len(tags) + 1, dtype=np.int64)
+    tag_offsets[1:] = np.cumsum(np.bincount(tag_ids, minlength=len(tags)))
+
+    return TagsInvertedIndex(list(tags), tag_offsets, postings_shard[order], postings_row[order],
+                             [os.path.basename(f) for f in shard_full_fnames],
+                             np.array([cu.get_file_fingerprint(f) for f in shard_full_fnames], dtype=np.int64).reshape(-1, 2),
+                             np.array(shard_rows_num, dtype=np.int64))
+
+
+def get_tags_inverted_index(extract_tags_func, folder=cu.FINAL_REPORT_DATA_FOLDER, fname=TAGS_INVERTED_INDEX_FNAME):
+    '''
+    Loads the index from fname, (re)building it if it doesn't exist or if the shards in folder changed since it was built
+    '''
+    shard_full_fnames = cu.list_shard_files(folder)
+    if os.path.isfile(fname):
+        tags_index = TagsInvertedIndex.load(fname)
+        if tags_index.is_up_to_date(shard_full_fnames):
+            return tags_index
+        inst.log(f'Shards changed since {fname} was built, rebuilding it')
+    tags_index = build_tags_inverted_index(shard_full_fnames, extract_tags_func)
+    tags_index.save(fname)
+    return tags_index
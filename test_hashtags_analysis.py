@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import hashtags_analysis as ha
+
+'''
+extract_hash_tags_batch() has to return the tags of extract_hash_tags() for every text (the order of the tags within a
+list may differ, both come out of sets) - it's what the vocabulary, the tags inverted index, the hashtags cube and the
+arbitrators are built on
+'''
+
+TEXTS_CASES = {
+    "html_entities": ["&amp;brexit #a&amp;b #brexit&amp;", "#stop&amp;brexit", "#&amp;#8216brexit&amp;#8217 now"],
+    "unicode_escapes": ["#sunse\\u2026 #brexit\\u2019", "#good/#bad?:o\\", "#\\u05e9\\u05dc\\u05d5\\u05dd", "#지민 #brexit"],
+    "compound_tags": ["#a#b", "#x#y# #z", "#brexit#voteleave#", "#http://t.co#brexit #www.x#y"],
+    "separator_prefixes": ["#go_#brexit", "#we-#remain #stop-#brexit-#now", "#a_#b#c"],
+    "trailing_punctuation": ["#brexit! #leave’ #eu...", "#voteleave, #remain; #uk:", "#brexit? #brexit?!", "#'brexit'"],
+    "mentions": ["@#brexit @user #uk", "#brexit@user", "hi @user#brexit #eu@x"],
+    "empty_strings": ["", "#", "# ## ###", "no tags at all"],
+}
+
+
+def assert_batch_equals_single(texts):
+    texts = pd.Series(texts, dtype=object)
+    batch_tags = ha.extract_hash_tags_batch(texts)
+    assert batch_tags.index.equals(texts.index)
+    assert [sorted(tags) for tags in batch_tags.tolist()] == [sorted(tags) for tags in texts.apply(ha.extract_hash_tags).tolist()]
+
+
+@pytest.mark.parametrize("case", sorted(TEXTS_CASES))
+def test_batch_equals_single(case):
+    assert_batch_equals_single(TEXTS_CASES[case])
+
+
+def test_batch_equals_single_all_cases_at_once():
+    # The batch version processes every distinct tag once for all the texts, so the cases are also checked together
+    assert_batch_equals_single([text for case in sorted(TEXTS_CASES) for text in TEXTS_CASES[case]])
+
+
+def test_batch_keeps_index():
+    texts = pd.Series(["#a #b", "#c", "#a"], index=[10, 3, 7])
+    assert ha.extract_hash_tags_batch(texts).index.tolist() == [10, 3, 7]
+    assert_batch_equals_single(texts)
+
+
+def test_batch_non_str_cells():
+    texts = pd.Series(["#brexit", np.nan, None, 5, "#remain #eu"], dtype=object)
+    batch_tags = ha.extract_hash_tags_batch(texts)
+    assert [sorted(tags) for tags in batch_tags.tolist()] == [["brexit"], [], [], [], ["eu", "remain"]]
+    is_str = texts.apply(lambda text: isinstance(text, str))
+    assert_batch_equals_single(texts[is_str])
+
+
+def test_batch_empty_series():
+    batch_tags = ha.extract_hash_tags_batch(pd.Series([], dtype=object))
+    assert len(batch_tags) == 0
+    assert batch_tags.tolist() == pd.Series([], dtype=object).apply(ha.extract_hash_tags).tolist()
@@ -0,0 +1,82 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+import hashtags_vocabulary as hv
+
+'''
+HashtagsSketch has to bound the true count of every tag - [count - error, count] for the kept tags and at most
+get_min_count() for the others - whether the tags were counted in one sketch or in several sketches that were merged
+'''
+
+
+def get_tag_lists(seed, tweets_num=2000, tags_num=300):
+    rng = np.random.default_rng(seed)
+    tag_ids = np.minimum(rng.zipf(1.3, size=(tweets_num, 3)), tags_num)  # A long tail, like the hashtags' counts
+    return pd.Series([[f'tag{i}' for i in set(ids.tolist())] for ids in tag_ids], dtype=object)
+
+
+def get_true_counts(tag_lists):
+    return Counter(tag for tags in tag_lists for tag in tags)
+
+
+def assert_bounds(sketch, true_counts):
+    for tag, count in true_counts.items():
+        min_count, max_count = sketch.get_count_bounds(tag)
+        assert min_count <= count <= max_count, tag
+    assert sketch.get_min_count() <= sketch.total / sketch.capacity
+    assert len(sketch.tags) <= sketch.capacity
+
+
+def test_exact_below_capacity():
+    tag_lists = get_tag_lists(0)
+    sketch = hv.HashtagsSketch(capacity=1000)
+    sketch.count_tag_lists(tag_lists)
+    true_counts = get_true_counts(tag_lists)
+    assert sketch.get_min_count() == 0
+    assert all(sketch.get_count_bounds(tag) == (count, count) for tag, count in true_counts.items())
+    assert sketch.get_count_bounds("missing") == (0, 0)
+
+
+def test_bounds_of_full_sketch():
+    tag_lists = get_tag_lists(1)
+    sketch = hv.HashtagsSketch(capacity=20)
+    for start in range(0, len(tag_lists), 100):
+        sketch.count_tag_lists(tag_lists[start:start + 100])
+    assert sketch.get_min_count() > 0
+    assert_bounds(sketch, get_true_counts(tag_lists))
+
+
+def test_merged_sketches_bounds_and_commutative():
+    tag_lists = [get_tag_lists(seed) for seed in range(2, 5)]
+    sketches = []
+    for cur_tag_lists in tag_lists:
+        sketch = hv.HashtagsSketch(capacity=20)
+        sketch.count_tag_lists(cur_tag_lists)
+        sketches.append(sketch)
+    merged = hv.merge_sketches(sketches)
+    assert_bounds(merged, get_true_counts(pd.concat(tag_lists)))
+    reversed_merged = hv.merge_sketches(sketches[::-1])
+    assert merged.tags == reversed_merged.tags
+    assert merged.counts.tolist() == reversed_merged.counts.tolist()
+    assert merged.errors.tolist() == reversed_merged.errors.tolist()
+
+
+def test_exact_tags_counted_exactly(tmp_path):
+    tag_lists = get_tag_lists(5)
+    is_exact_tag = lambda tag: tag in {"tag1", "tag7", "tag250"}
+    sketch = hv.HashtagsSketch(capacity=10)
+    sketch.count_tag_lists(tag_lists, is_exact_tag)
+    true_counts = get_true_counts(tag_lists)
+    for tag in ["tag1", "tag7", "tag250"]:
+        assert sketch.get_count_bounds(tag) == (true_counts[tag], true_counts[tag])
+    assert not set(sketch.tags) & {"tag1", "tag7", "tag250"}
+    assert sketch.total == sum(count for tag, count in true_counts.items() if not is_exact_tag(tag))
+
+    fname = str(tmp_path / "sketch.npz")
+    sketch.save(fname)
+    loaded = hv.load_vocabulary_or_sketch(fname)
+    assert isinstance(loaded, hv.HashtagsSketch)
+    assert loaded.to_counter() == sketch.to_counter()
+    assert loaded.get_min_count() == sketch.get_min_count()
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+import pipeline as pl
+
+'''
+A stage is rebuilt only when it's stale - its inputs' content (or its stat_inputs' sizes and mtimes) changed, or its
+outputs were changed or deleted since it was built - or when it's forced. The stages are run serially here
+(max_parallel_stages=1), so the stage functions don't have to be picklable
+'''
+
+
+def read_file(fname):
+    with open(fname) as f:
+        return f.read()
+
+
+def write_file(fname, text):
+    with open(fname, "w") as f:
+        f.write(text)
+
+
+def upper_file(in_fname, out_fname):
+    write_file(out_fname, read_file(in_fname).upper())
+
+
+def count_chars(in_fname, out_fname):
+    write_file(out_fname, str(len(read_file(in_fname))))
+
+
+def list_dir(dir_name, out_fname):
+    write_file(out_fname, ",".join(sorted(os.listdir(dir_name))))
+
+
+def get_stages():
+    return [pl.PipelineStage("count", count_chars, ("upper.txt", "count.txt"), ["upper.txt"], ["count.txt"]),
+            pl.PipelineStage("upper", upper_file, ("in.txt", "upper.txt"), ["in.txt"], ["upper.txt"]),
+            pl.PipelineStage("listing", list_dir, ("fetched", "listing.txt"), outputs=["listing.txt"],
+                             stat_inputs=["fetched"])]
+
+
+def run(targets=None, force=False):
+    return sorted(pl.run_pipeline(get_stages(), targets, force, max_parallel_stages=1, state_dir="state", workers_num=1))
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_file("in.txt", "abc")
+    os.makedirs("fetched")
+    write_file(os.path.join("fetched", "1.json"), "[]")
+
+
+def touch(fname, mtime_delta_ns=10 ** 9):
+    stat = os.stat(fname)
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + mtime_delta_ns))
+
+
+def test_up_to_date_stages_not_rebuilt():
+    assert run() == ["count", "listing", "upper"]
+    assert read_file("count.txt") == "3"
+    assert run() == []
+
+
+def test_changed_input_rebuilds_dependent_stages():
+    run()
+    write_file("in.txt", "abcd")
+    assert run() == ["count", "upper"]
+    assert read_file("count.txt") == "4"
+
+
+def test_touched_input_with_same_content_not_rebuilt():
+    run()
+    touch("in.txt")
+    assert run() == []
+
+
+def test_changed_output_rebuilds_its_stage_only():
+    run()
+    write_file("upper.txt", "changed")
+    assert run() == ["upper"]  # Its output is the same as before, so count is still up to date
+    os.remove("count.txt")
+    assert run() == ["count"]
+
+
+def test_stat_inputs_fingerprinted_by_size_and_mtime():
+    run()
+    touch(os.path.join("fetched", "1.json"))
+    assert run() == ["listing"]
+    write_file(os.path.join("fetched", "2.json"), "[]")
+    assert run() == ["listing"]
+    assert read_file("listing.txt") == "1.json,2.json"
+
+
+def test_force_rebuilds_targets_only():
+    run()
+    assert run(targets=["count"], force=True) == ["count"]
+    assert run(force=True) == ["count", "listing", "upper"]
+
+
+def test_targets_build_their_dependencies():
+    assert run(targets=["count"]) == ["count", "upper"]
+    assert not os.path.exists("listing.txt")
+    with pytest.raises(ValueError):
+        run(targets=["no_such_stage"])
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+import processed_ids_index as pii
+
+'''
+The index has to hold every id that was added to it, across sessions: the ids are appended to the journal and replayed
+from it when the index is reopened, until compact() merges them into the sorted base
+'''
+
+
+def test_journal_replayed_on_reopen(tmp_path):
+    with pii.ProcessedIdsIndex.create(tmp_path, [5, 1, 3]) as index:
+        index.add([7, 2])
+        index.add(np.array([2, 9], dtype=np.int64))
+    with pii.ProcessedIdsIndex(tmp_path) as index:
+        assert index.contains([1, 2, 3, 4, 5, 7, 8, 9]).tolist() == [True, True, True, False, True, True, False, True]
+        assert "7" in index and not "8" in index and not "not an id" in index
+        assert np.load(os.path.join(tmp_path, pii.BASE_FNAME)).tolist() == [1, 3, 5]  # Only the journal was written
+
+
+def test_partial_journal_write_dropped(tmp_path):
+    with pii.ProcessedIdsIndex.create(tmp_path, []) as index:
+        index.add([11, 12])
+    with open(os.path.join(tmp_path, pii.JOURNAL_FNAME), "ab") as f:
+        f.write(np.array([13], dtype=pii.ID_DTYPE).tobytes()[:3])  # A crash in the middle of writing an id
+    with pii.ProcessedIdsIndex(tmp_path) as index:
+        assert index.contains([11, 12, 13]).tolist() == [True, True, False]
+        index.add([14])
+    with pii.ProcessedIdsIndex(tmp_path) as index:
+        assert index.contains([11, 12, 13, 14]).tolist() == [True, True, False, True]
+
+
+def test_pending_ids_merged_into_journal_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(pii, "MAX_PENDING_IDS", 3)
+    with pii.ProcessedIdsIndex.create(tmp_path, []) as index:
+        index.add([4, 2])
+        index.add([2, 6])
+        assert index.journal_ids.tolist() == [2, 4, 6] and len(index.pending_ids) == 0
+        index.add([1])
+        assert index.contains([1, 2, 3, 4, 5, 6]).tolist() == [True, True, False, True, False, True]
+
+
+def test_compact(tmp_path):
+    with pii.ProcessedIdsIndex.create(tmp_path, [10, 30]) as index:
+        index.add([20, 30, 40])
+        index.compact(min_journal_ids=10)  # Not enough ids in the journal yet
+        assert os.path.getsize(os.path.join(tmp_path, pii.JOURNAL_FNAME)) > 0
+        index.compact()
+        assert os.path.getsize(os.path.join(tmp_path, pii.JOURNAL_FNAME)) == 0
+        assert np.load(os.path.join(tmp_path, pii.BASE_FNAME)).tolist() == [10, 20, 30, 40]
+        index.add([50])  # The journal is reopened after the compaction
+    with pii.ProcessedIdsIndex(tmp_path) as index:
+        assert len(index) == 5
+        assert index.contains([10, 20, 30, 40, 50, 60]).tolist() == [True] * 5 + [False]